@@ -0,0 +1,312 @@
+"""
+User-private, on-disk caches for getawscreds.
+
+Everything lives below a directory that only the current user may read, and
+anything sensitive is encrypted at rest with a per-user key kept in that
+directory.
+"""
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from .config import get_home
+from .locking import atomic_write
+
+__all__ = (
+    'get_cache_dir',
+    'write_private_file',
+    'read_private_file',
+    'save_encrypted',
+    'load_encrypted',
+    'save_saml_assertion',
+    'load_saml_assertion',
+    'save_cookies',
+    'load_cookies',
+    'clear_cookies',
+    'save_role_catalog',
+    'load_role_catalog',
+    'save_duration_ceiling',
+    'load_duration_ceiling',
+    'save_form_template',
+    'load_form_template',
+    'clear_form_template',
+    'load_form_template_stats',
+)
+
+CACHE_DIR_ENV = 'GETAWSCREDS_CACHE_DIR'
+KEY_FILE_NAME = 'cache.key'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Same safety margin that get_longest_duration applies to the SAML deadline
+SAML_SAFETY_MARGIN = 600
+
+# Learn a role's session duration ceiling again after this many seconds, in case it was raised
+DURATION_CEILING_TTL = 7 * 86400
+
+# Fetch the IdP's login form again after this many seconds, even if its hidden inputs still work
+FORM_TEMPLATE_TTL = 6 * 3600
+
+
+def get_cache_dir():
+    '''
+    Get the directory where getawscreds keeps its caches, creating it if needed
+    '''
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        appdata_path = os.environ.get('APPDATA', None)
+        if appdata_path:
+            cache_dir = os.path.join(appdata_path, 'getawscreds', 'cache')
+        else:
+            cache_dir = os.path.join(get_home(), '.cache', 'getawscreds')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    return cache_dir
+
+
+def get_cache_path(kind, *parts):
+    '''
+    Map a kind of cache entry and the parts of its key to a file in the cache directory
+    '''
+    digest = hashlib.sha256('\0'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+    return os.path.join(get_cache_dir(), '%s-%s' % (kind, digest[:32]))
+
+
+def write_private_file(path, data):
+    '''
+    Atomically replace path with data, readable only by the current user
+    '''
+    atomic_write(path, data, new_mode=0o600, keep_mode=False)
+
+
+def read_private_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def get_cache_key():
+    '''
+    Return the per-user encryption key, generating it the first time it is needed
+    '''
+    path = os.path.join(get_cache_dir(), KEY_FILE_NAME)
+    key = read_private_file(path)
+    if key:
+        return key.strip()
+
+    from cryptography.fernet import Fernet
+    key = Fernet.generate_key()
+    try:
+        # an existing key is not replaced, so concurrent first runs agree on one key
+        atomic_write(path, key, new_mode=0o600, keep_mode=False, replace=False)
+    except FileExistsError:
+        key = read_private_file(path).strip()
+    return key
+
+
+def save_encrypted(path, value):
+    from cryptography.fernet import Fernet
+    token = Fernet(get_cache_key()).encrypt(json.dumps(value).encode('utf-8'))
+    write_private_file(path, token)
+
+
+def load_encrypted(path):
+    '''
+    Return the value saved at path, or None if it is missing or cannot be decrypted
+    '''
+    token = read_private_file(path)
+    if not token:
+        return None
+    from cryptography.fernet import Fernet, InvalidToken
+    try:
+        return json.loads(Fernet(get_cache_key()).decrypt(token).decode('utf-8'))
+    except (InvalidToken, ValueError):
+        return None
+
+
+def save_saml_assertion(fqdn, user, samlvalue, deadline):
+    '''
+    Remember the SAML assertion for this IdP and user until its deadline
+    '''
+    if isinstance(samlvalue, bytes):
+        samlvalue = samlvalue.decode('ascii')
+    save_encrypted(get_cache_path('saml', fqdn, user), {
+        'deadline': deadline.strftime(TIMESTAMP_FORMAT),
+        'saml': samlvalue,
+    })
+
+
+def load_saml_assertion(fqdn, user, margin=SAML_SAFETY_MARGIN, now=None):
+    '''
+    Return the cached SAML assertion for this IdP and user,
+    or None if there is none or it expires within margin seconds.
+    '''
+    entry = load_encrypted(get_cache_path('saml', fqdn, user))
+    if not entry:
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    deadline = datetime.strptime(entry['deadline'], TIMESTAMP_FORMAT)
+    if now >= deadline - timedelta(seconds=margin):
+        return None
+    return entry['saml']
+
+
+def save_cookies(fqdn, user, cookiejar):
+    '''
+    Remember the IdP's cookies, including session cookies such as SMSESSION
+    '''
+    cookies = []
+    for cookie in cookiejar:
+        cookies.append({
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'secure': cookie.secure,
+            'expires': cookie.expires,
+        })
+    save_encrypted(get_cache_path('cookies', fqdn, user), cookies)
+
+
+def load_cookies(fqdn, user):
+    '''
+    Return the saved cookies for this IdP and user as a list of dicts, leaving out expired ones
+    '''
+    cookies = load_encrypted(get_cache_path('cookies', fqdn, user))
+    if not cookies:
+        return []
+    now = time.time()
+    return [c for c in cookies if not c['expires'] or c['expires'] > now]
+
+
+def clear_cookies(fqdn, user):
+    '''
+    Forget the IdP's cookies, once the IdP no longer accepts the session they hold
+    '''
+    path = get_cache_path('cookies', fqdn, user)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def save_role_catalog(fqdn, user, pairs, now=None):
+    '''
+    Remember the (principal, role) pairs that this IdP offered the user, and when
+    '''
+    if now is None:
+        now = datetime.utcnow()
+    save_encrypted(get_cache_path('roles', fqdn, user), {
+        'saved': now.strftime(TIMESTAMP_FORMAT),
+        'roles': [list(pair) for pair in pairs],
+    })
+
+
+def load_role_catalog(fqdn, user):
+    '''
+    Return when the roles for this IdP and user were saved and the (principal, role) pairs,
+    or None if they were never saved
+    '''
+    entry = load_encrypted(get_cache_path('roles', fqdn, user))
+    if not entry:
+        return None
+    return datetime.strptime(entry['saved'], TIMESTAMP_FORMAT), [tuple(pair) for pair in entry['roles']]
+
+
+def save_duration_ceiling(role_arn, seconds, now=None):
+    '''
+    Remember the longest session duration that the role is believed to allow
+    '''
+    if now is None:
+        now = datetime.utcnow()
+    entry = {'role': role_arn, 'ceiling': seconds, 'learned': now.strftime(TIMESTAMP_FORMAT)}
+    write_private_file(get_cache_path('duration', role_arn), json.dumps(entry).encode('utf-8'))
+
+
+def load_duration_ceiling(role_arn, ttl=DURATION_CEILING_TTL, now=None):
+    '''
+    Return the learned session duration ceiling of the role,
+    or None if none was learned within the last ttl seconds
+    '''
+    data = read_private_file(get_cache_path('duration', role_arn))
+    if not data:
+        return None
+    try:
+        entry = json.loads(data.decode('utf-8'))
+        learned = datetime.strptime(entry['learned'], TIMESTAMP_FORMAT)
+        ceiling = int(entry['ceiling'])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    if now >= learned + timedelta(seconds=ttl):
+        return None
+    return ceiling
+
+
+def read_json(path):
+    data = read_private_file(path)
+    try:
+        return json.loads(data.decode('utf-8'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def write_json(path, value):
+    write_private_file(path, json.dumps(value).encode('utf-8'))
+
+
+def save_form_template(fqdn, form_data, now=None):
+    '''
+    Remember the hidden inputs of the IdP's login form, which hold no secrets
+    '''
+    if now is None:
+        now = datetime.utcnow()
+    write_json(get_cache_path('form', fqdn), {'saved': now.strftime(TIMESTAMP_FORMAT), 'inputs': form_data})
+
+
+def load_form_template(fqdn, ttl=FORM_TEMPLATE_TTL, now=None):
+    '''
+    Return the hidden inputs saved for the IdP's login form, or None if there are none
+    from the last ttl seconds, counting each as a hit or a miss
+    '''
+    entry = read_json(get_cache_path('form', fqdn))
+    if now is None:
+        now = datetime.utcnow()
+    inputs = None
+    try:
+        if now < datetime.strptime(entry['saved'], TIMESTAMP_FORMAT) + timedelta(seconds=ttl):
+            inputs = entry['inputs']
+    except (TypeError, KeyError, ValueError):
+        pass
+    count_form_template(fqdn, 'hits' if inputs is not None else 'misses')
+    return inputs
+
+
+def clear_form_template(fqdn):
+    '''
+    Forget the hidden inputs saved for the IdP's login form, once the IdP has refused them
+    '''
+    path = get_cache_path('form', fqdn)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def count_form_template(fqdn, outcome):
+    '''
+    Count one outcome of using the form template: hits, misses, or rejected when the IdP refused it
+    '''
+    path = get_cache_path('formstats', fqdn)
+    stats = load_form_template_stats(fqdn)
+    stats[outcome] += 1
+    write_json(path, stats)
+
+
+def load_form_template_stats(fqdn):
+    stats = {'hits': 0, 'misses': 0, 'rejected': 0}
+    saved = read_json(get_cache_path('formstats', fqdn))
+    if isinstance(saved, dict):
+        stats.update((key, saved[key]) for key in stats if isinstance(saved.get(key), int))
+    return stats
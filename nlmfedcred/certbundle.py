@@ -0,0 +1,250 @@
+"""
+Build the CA bundle used to validate SSL server certificates.
+
+The bundle holds the certifi certificates and any extra ones, such as the SSL
+interceptor's, each written once in canonical PEM and only while it is valid.
+Next to the bundle is an index of the SHA-256 fingerprints of its
+certificates, taken over their DER encoding, and a description of the certifi
+bundle it was built from. Building the bundle again only reads the index when
+nothing has changed, and the bundle is rewritten only when certifi, the extra
+certificates, or the bundle itself are different.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import warnings
+from datetime import datetime
+
+from .exceptions import CertificatesFileNotFound
+from .locking import atomic_write
+
+__all__ = (
+    'build_bundle',
+    'load_certificate_files',
+    'load_fingerprints',
+    'has_certificate',
+)
+
+PEM_BEGIN = '-----BEGIN CERTIFICATE-----'
+PEM_END = '-----END CERTIFICATE-----'
+INDEX_SUFFIX = '.index'
+CERT_EXTENSIONS = ('.pem', '.crt', '.cer', '.der')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+logger = logging.getLogger(__name__)
+
+
+def iter_pem_blocks(text):
+    '''
+    Yield each PEM certificate in text, from its BEGIN line to its END line
+    '''
+    pos = 0
+    while True:
+        start = text.find(PEM_BEGIN, pos)
+        if start < 0:
+            return
+        end = text.find(PEM_END, start)
+        if end < 0:
+            return
+        pos = end + len(PEM_END)
+        yield text[start:pos] + '\n'
+
+
+def pem_to_der(block):
+    body = block.strip()[len(PEM_BEGIN):-len(PEM_END)]
+    return base64.b64decode(''.join(body.split()), validate=True)
+
+
+def fingerprint(der):
+    return hashlib.sha256(der).hexdigest()
+
+
+def get_file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def get_certifi_source():
+    '''
+    Describe the certifi bundle, so that an update of certifi can be noticed
+    '''
+    import certifi
+    path = certifi.where()
+    if not os.path.exists(path):
+        raise CertificatesFileNotFound()
+    return {
+        'path': path,
+        'version': getattr(certifi, '__version__', None),
+        'signature': get_file_signature(path),
+    }
+
+
+def get_index_path(bundle_path):
+    return bundle_path + INDEX_SUFFIX
+
+
+def load_index(bundle_path):
+    '''
+    Return the bundle's index, or None if it is missing or does not describe the bundle as it is now
+    '''
+    try:
+        with open(get_index_path(bundle_path)) as f:
+            index = json.load(f)
+        if index['bundle'] != get_file_signature(bundle_path):
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return index
+
+
+def scan_fingerprints(text):
+    fingerprints = []
+    for block in iter_pem_blocks(text):
+        try:
+            fingerprints.append(fingerprint(pem_to_der(block)))
+        except (binascii.Error, ValueError):
+            continue
+    return fingerprints
+
+
+def read_bundle_certificates(text, path):
+    '''
+    Return the DER encoding of each certificate in a PEM bundle, skipping any that is malformed
+    '''
+    certs = []
+    for block in iter_pem_blocks(text):
+        try:
+            certs.append(pem_to_der(block))
+        except (binascii.Error, ValueError):
+            logger.warning('%s: skipping a malformed certificate', path)
+    return certs
+
+
+def der_to_pem(der):
+    encoded = base64.b64encode(der).decode('ascii')
+    lines = [encoded[i:i + 64] for i in range(0, len(encoded), 64)]
+    return '%s\n%s\n%s\n' % (PEM_BEGIN, '\n'.join(lines), PEM_END)
+
+
+def read_certificates(data):
+    '''
+    Return the DER encoding of each certificate in PEM or DER data
+    '''
+    if PEM_BEGIN.encode('ascii') in data:
+        return [pem_to_der(block) for block in iter_pem_blocks(data.decode('ascii', errors='replace'))]
+    return [data]
+
+
+def load_certificate_files(paths):
+    '''
+    Read the certificates in each file, or in each certificate file of a directory, as DER
+    '''
+    certs = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if os.path.splitext(n)[1].lower() in CERT_EXTENSIONS)
+            files = [os.path.join(path, n) for n in names]
+        else:
+            files = [path]
+        for filename in files:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            try:
+                ders = read_certificates(data)
+            except (binascii.Error, ValueError):
+                ders = [None]
+            if not ders or any(der is None or get_not_after(der) is None for der in ders):
+                raise ValueError('%s: not a PEM or DER certificate' % filename)
+            certs.extend(ders)
+    return certs
+
+
+def get_not_after(der):
+    '''
+    Return when the certificate expires as a naive UTC datetime, or None if it cannot be parsed
+    '''
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    try:
+        with warnings.catch_warnings():
+            # some long-lived roots in certifi have serial numbers that newer cryptography warns about
+            warnings.simplefilter('ignore')
+            cert = x509.load_der_x509_certificate(der, default_backend())
+    except ValueError:
+        return None
+    not_after = getattr(cert, 'not_valid_after_utc', None)
+    if not_after is not None:
+        return not_after.replace(tzinfo=None)
+    return cert.not_valid_after
+
+
+def build_bundle(bundle_path, extra_certs=(), now=None):
+    '''
+    Write the certifi certificates and the extra DER certificates to bundle_path,
+    leaving out duplicates and expired certificates, unless the bundle there was
+    already built from the same ones and nothing in it has expired since.
+
+    Returns True if the bundle was written, and False if it was up to date.
+    '''
+    if now is None:
+        now = datetime.utcnow()
+    source = get_certifi_source()
+    extra_fingerprints = [fingerprint(der) for der in extra_certs]
+
+    index = load_index(bundle_path)
+    if index is not None and index.get('source') == source and index.get('extra') == extra_fingerprints:
+        expires = index.get('expires')
+        if expires is None or now.strftime(TIMESTAMP_FORMAT) < expires:
+            return False
+
+    with open(source['path']) as f:
+        certs = read_bundle_certificates(f.read(), source['path'])
+    certs.extend(extra_certs)
+
+    fingerprints = []
+    seen = set()
+    parts = []
+    expires = None
+    for der in certs:
+        fp = fingerprint(der)
+        if fp in seen:
+            continue
+        seen.add(fp)
+        not_after = get_not_after(der)
+        if not_after is not None:
+            # a certificate that cannot be parsed is kept, since its expiry is unknown
+            if not_after <= now:
+                continue
+            if expires is None or not_after < expires:
+                expires = not_after
+        fingerprints.append(fp)
+        parts.append(der_to_pem(der))
+    atomic_write(bundle_path, ''.join(parts), new_mode=0o644)
+
+    index = {
+        'source': source,
+        'extra': extra_fingerprints,
+        'bundle': get_file_signature(bundle_path),
+        'expires': expires.strftime(TIMESTAMP_FORMAT) if expires else None,
+        'fingerprints': fingerprints,
+    }
+    atomic_write(get_index_path(bundle_path), json.dumps(index), new_mode=0o644)
+    return True
+
+
+def load_fingerprints(bundle_path):
+    '''
+    Return the set of fingerprints in the bundle, from its index when that is current
+    '''
+    index = load_index(bundle_path)
+    if index is not None:
+        return frozenset(index['fingerprints'])
+    with open(bundle_path) as f:
+        return frozenset(scan_fingerprints(f.read()))
+
+
+def has_certificate(bundle_path, pem):
+    return fingerprint(pem_to_der(pem)) in load_fingerprints(bundle_path)
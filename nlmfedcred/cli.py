@@ -2,16 +2,33 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import argparse
+import binascii
+import fnmatch
 import os
 import sys
-from base64 import b64decode
+import threading
+import time
+from datetime import datetime
 from getpass import getpass
 
-from . import fedcred
-from .config import parse_config, setup_certificates, update_aws_credentials
-from .idp import DEFAULT_IDP, make_idp
+from . import cache, credstore, daemon, failover, fedcred, singleflight
+from .config import (get_profile_expiration, get_profile_role_arn,
+                     list_profiles, parse_config, parse_duration,
+                     setup_certificates, update_aws_credential_process,
+                     update_aws_credentials, update_aws_profiles)
+from .deadline import Deadline
+from .exceptions import (DeadlineExceeded, IdPError, LockTimeout,
+                         LoginRequired, SharedLoginFailed, STSError)
+from .idp import DEFAULT_IDP, get_fqdn, make_idp, split_idps
+from .prefetch import LoginPrefetch
+from .roles import RoleIndex
 
 DEFAULT_PROFILE = 'default'
+DEFAULT_PROFILE_TEMPLATE = '{account}-{role}'
+DEFAULT_ROLES_MAX_AGE = 24
+
+# The share of the --deadline that NIH Login may use, leaving the rest for STS
+IDP_SHARE = 0.75
 if 'AWS_PROFILE' in os.environ:
     DEFAULT_PROFILE = os.environ['AWS_PROFILE']
 elif 'AWS_DEFAULT_PROFILE' in os.environ:
@@ -25,7 +42,8 @@ def parse_args(args):
     parser.add_argument('--password', metavar='PASSWORD', default=None,
                         help='You will be prompted to enter a password if none is provided')
     parser.add_argument('--role', '-r', metavar='NAME', default=None,
-                        help='Filters possible roles by match')
+                        help='Filters possible roles by match: a comma-separated list of names, '
+                             'globs, and exclusions starting with "!"')
     parser.add_argument('--region', metavar='REGION', default='us-east-1',
                         help='Specify AWS region (default "us-east-1")')
     parser.add_argument('--output', '-o', metavar='PATH', default=None,
@@ -34,23 +52,68 @@ def parse_args(args):
                         help='Path to multi-certificate PEM file used to validate SSL server certificates')
     parser.add_argument('--setupcerts', metavar='PATH', default=None,
                         help='Build a multi-certificate PEM bundle including certificate for NLM SSL interceptor')
+    parser.add_argument('--extra-certs', metavar='PATH', default=[], action='append',
+                        help='With --setupcerts, also add the PEM or DER certificates in this file or directory '
+                             '(may be repeated)')
     parser.add_argument('--samlout', '-s', metavar='PATH', default=None,
                         help='Debugging utility to save the SAML output')
     parser.add_argument('--shell', metavar='SHELL', default=None, choices=['bash', 'cmd'],
                         help="Choose either bash or cmd style output")
     parser.add_argument('--account', '-a', metavar='ACCOUNT', default=None,
-                        help='Account number filters possible roles by account number match')
+                        help='Account number filters possible roles by account number match, '
+                             'with lists, globs and exclusions as for --role')
     parser.add_argument('--profile', '-p', metavar='NAME', default=None,
                         nargs='?', const=DEFAULT_PROFILE,
-                        help='Specifies a section of $HOME/.getawscreds to use for your configuration')
+                        help='Specifies a section of $HOME/.getawscreds to use for your configuration, '
+                             'or several as a comma-separated list or a pattern such as "nlm-*"')
     parser.add_argument('--idp', metavar='FQDN', default=None,
-                        help='Specify FQDN to use when making federation calls')
-    parser.add_argument('--duration', metavar='SECONDS', default=None, type=int,
-                        help='Specify the duration of the temporary credentials')
+                        help='Specify FQDN to use when making federation calls, or several as a '
+                             'comma-separated list to use whichever answers first')
+    parser.add_argument('--duration', metavar='SECONDS', default=None, type=parse_duration,
+                        help='Specify the duration of the temporary credentials, or "max" for the longest '
+                             'that the role allows')
     parser.add_argument('--piv', default=None, action='store_true',
                         help='Request PIV login rather than username/password')
     parser.add_argument('--subject', metavar='NAME', default=None,
                         help='The Subject of the X.509 certificate on the SmartCard')
+    parser.add_argument('--cache', default=False, action='store_true',
+                        help='Reuse an encrypted, cached SAML assertion until it is about to expire')
+    parser.add_argument('--all-matching', default=False, action='store_true',
+                        help='Assume every matching role from a single login and save each as its own profile')
+    parser.add_argument('--profile-template', metavar='TEMPLATE', default=DEFAULT_PROFILE_TEMPLATE,
+                        help='Profile name for each role with --all-matching, using {account}, {role} '
+                             'and {profile} (default "%s")' % DEFAULT_PROFILE_TEMPLATE.replace('%', '%%'))
+    parser.add_argument('--max-workers', metavar='COUNT', default=8, type=int,
+                        help='How many roles to assume at once with --all-matching or several profiles '
+                             '(default 8)')
+    parser.add_argument('--credential-process', default=False, action='store_true',
+                        help='Print credentials as JSON for use as an AWS credential_process, '
+                             'reusing stored credentials until they are about to expire')
+    parser.add_argument('--setup-credential-process', default=False, action='store_true',
+                        help='Configure each profile in $HOME/.getawscreds as a credential_process in ~/.aws/config')
+    parser.add_argument('--daemon', default=False, action='store_true',
+                        help='Keep running and refresh the credentials of --profile, or of every profile in '
+                             '$HOME/.getawscreds, before they expire')
+    parser.add_argument('--serve-credentials', default=False, action='store_true',
+                        help='Serve credentials for --profile, or every profile, over the ECS container '
+                             'credentials protocol')
+    parser.add_argument('--listen', metavar='ADDRESS', default=None,
+                        help='HOST:PORT or unix:PATH to listen on with --serve-credentials '
+                             '(default "127.0.0.1:9911")')
+    parser.add_argument('--sts-transport', default='boto3', choices=fedcred.STS_TRANSPORTS,
+                        help='Call STS through boto3, or directly with requests, which starts faster '
+                             '(default "boto3")')
+    parser.add_argument('--list-roles', default=False, action='store_true',
+                        help='List the roles saved by your last login, without logging in')
+    parser.add_argument('--roles-max-age', metavar='HOURS', default=DEFAULT_ROLES_MAX_AGE, type=float,
+                        help='With --list-roles, warn that the saved roles may be out of date after this many '
+                             'hours (default %d)' % DEFAULT_ROLES_MAX_AGE)
+    parser.add_argument('--deadline', metavar='SECONDS', default=None, type=float,
+                        help='Give up if the credentials cannot be obtained within this many seconds, '
+                             'not counting time at the password prompt')
+    parser.add_argument('--min-remaining', metavar='MINUTES', default=None, type=int,
+                        help='Do nothing if the credentials saved for the profile are valid for at least '
+                             'this many more minutes')
     opts = parser.parse_args(args)
     return opts
 
@@ -86,39 +149,289 @@ def output_roles(authroles, stream=sys.stdout):
         stream.write('  %s\n' % pair[1])
 
 
-def main(args=None):
-    fedcred.set_default_creds()
+def format_age(seconds):
+    if seconds < 7200:
+        return '%d minutes' % (seconds // 60)
+    if seconds < 172800:
+        return '%d hours' % (seconds // 3600)
+    return '%d days' % (seconds // 86400)
 
-    if args is None:
-        args = sys.argv[:]
 
-    opts = parse_args(args[1:])
+def list_saved_roles(opts, now=None):
+    '''
+    Print the roles saved by the last login for the profile's IdP and user, without any network access
+    '''
+    config = parse_config(opts.profile, idp=opts.idp, username=opts.username, subject=opts.subject,
+                          use_cache=opts.cache)
+    fqdn = get_fqdn(get_idps(config)[0])
+    user = config.subject if opts.piv else config.username
+    catalog = cache.load_role_catalog(fqdn, user)
+    if catalog is None:
+        sys.stderr.write('No saved roles for %s at %s: log in once to save them\n' % (user, fqdn))
+        return 1
+    saved, pairs = catalog
+    if now is None:
+        now = datetime.utcnow()
+    age = (now - saved).total_seconds()
+    # only --account and --role narrow the list, since the profile's own role is already known
+    output_roles(fedcred.filter_role_pairs(pairs, account=opts.account, name=opts.role), sys.stdout)
+    sys.stderr.write('Roles saved %s ago by a login as %s at %s\n' % (format_age(age), user, fqdn))
+    if age > opts.roles_max_age * 3600:
+        sys.stderr.write('The saved roles may be out of date: log in again to refresh them\n')
+    return 0
 
-    if opts.setupcerts:
-        setup_certificates(opts.setupcerts)
-        print('Wrote certificate bundle to %s' % opts.setupcerts)
-        return 0
 
-    config = parse_config(
-        opts.profile,
-        opts.account,
-        opts.role,
-        opts.duration,
-        opts.idp,
-        opts.username,
-        ca_bundle=opts.ca_bundle,
-        subject=opts.subject,
-    )
+def profile_is_fresh(profile, minutes, path=None, now=None, account=None, role=None):
+    '''
+    Tell whether the credentials saved for profile remain valid for at least this many minutes,
+    and are for a role that the account and role selection allows
+    '''
+    expiration = get_profile_expiration(profile, path)
+    if expiration is None:
+        return False
+    if account or role:
+        role_arn = get_profile_role_arn(profile, path)
+        if role_arn is None or not RoleIndex([(None, role_arn)]).filter(account, role):
+            return False
+    if now is None:
+        now = datetime.utcnow()
+    return (expiration - now).total_seconds() >= minutes * 60
+
+
+def make_profile_name(template, role_arn, profile=None):
+    account, resource = role_arn.split(':')[4:6]
+    name = resource.rsplit('/', 1)[-1]
+    return template.format(account=account, role=name, profile=profile or DEFAULT_PROFILE)
+
+
+def assume_all_roles(opts, config, authroles, samlvalue, deadline=None, client=None):
+    profiles = [make_profile_name(opts.profile_template, pair[1], opts.profile) for pair in authroles]
+    if len(set(profiles)) != len(profiles):
+        sys.stderr.write('Profile template "%s" gives more than one role the same name\n' % opts.profile_template)
+        return 1
+
+    results = fedcred.assume_roles_with_saml(authroles, samlvalue, opts.region, config.duration, opts.max_workers,
+                                             opts.sts_transport, deadline, client)
+
+    profile_creds = []
+    failed = 0
+    for profile, pair, result in zip(profiles, authroles, results):
+        if isinstance(result, Exception):
+            sys.stderr.write('Unable to assume %s: %s\n' % (pair[1], result))
+            failed += 1
+        else:
+            profile_creds.append((profile, result))
+    if profile_creds:
+        try:
+            update_aws_profiles(opts.region, profile_creds, opts.output)
+        except LockTimeout as e:
+            sys.stderr.write('%s\n' % e)
+            return 1
+    return 1 if failed else 0
+
+
+def login_with_saved_session(idp, user, deadline=None, cafile=None, idps=None):
+    '''
+    Get a SAML assertion through the IdP session saved by an earlier password login,
+    or None if there is no saved session or the IdP no longer accepts it.
+
+    The session is saved under the endpoint that the password login went through,
+    so it is only tried there: the first of idps with a saved session.
+    '''
+    for endpoint in idps if idps else [idp]:
+        cookies = cache.load_cookies(get_fqdn(endpoint), user)
+        if cookies:
+            break
+    else:
+        return None
+    session = fedcred.make_session(cookies, deadline, cafile)
+    samlvalue = fedcred.get_saml_assertion_from_session(endpoint, session)
+    if samlvalue is None:
+        # the next run should not pay for trying the same session again
+        cache.clear_cookies(get_fqdn(endpoint), user)
+    return samlvalue
+
+
+def login_with_password(username, password, idp, save_session=False, deadline=None, idps=None, prefetched=None,
+                        cafile=None):
+    '''
+    Log in with a password, through whichever of idps answers first when there are several.
+    The saved session is kept under that endpoint, since its cookies may be good only there.
+
+    prefetched is the (idp, session, form_data) of a login form that was already fetched.
+    '''
+    def make_session():
+        return fedcred.make_session(deadline=deadline, cafile=cafile)
+
+    if prefetched is not None:
+        endpoint, session, form_data = prefetched
+    elif idps and len(idps) > 1:
+        endpoint, session, r = failover.race_login_form(idps, make_session)
+        form_data = fedcred.parse_hidden_inputs(endpoint, r)
+    else:
+        endpoint = idp
+        session = make_session()
+        form_data = None
+    samlvalue = fedcred.get_saml_assertion(username, password, endpoint, session=session, form_data=form_data,
+                                           use_template=True)
+    if save_session and samlvalue != 'US-EN':
+        cache.save_cookies(get_fqdn(endpoint), username, session.cookies)
+    return samlvalue
+
+
+# Logins for different IdPs run at the same time, but only one of them may prompt at once
+PROMPT_LOCK = threading.Lock()
+
+
+def is_profile_list(value):
+    return ',' in value or any(c in value for c in '*?[')
+
+
+def expand_profiles(value, use_cache=False):
+    '''
+    Expand a comma-separated list of profile names and patterns into profile names
+    '''
+    available = None
+    profiles = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if any(c in item for c in '*?['):
+            if available is None:
+                available = list_profiles(use_cache=use_cache)
+            matches = fnmatch.filter(available, item)
+        else:
+            matches = [item]
+        for profile in matches:
+            if profile not in profiles:
+                profiles.append(profile)
+    return profiles
+
+
+def get_idps(config):
+    '''
+    Return the IdP endpoints of the profile, the first of which identifies the IdP in the caches
+    '''
     if config.idp is None:
-        idp = DEFAULT_IDP
+        return [DEFAULT_IDP]
+    return [make_idp(fqdn) for fqdn in split_idps(config.idp)]
+
+
+def make_login(opts, idp, config, idps=None):
+    def login():
+        if opts.piv:
+            return fedcred.get_saml_assertion_piv(config.subject, idp)
+        if opts.cache:
+            samlvalue = login_with_saved_session(idp, config.username, cafile=config.ca_bundle, idps=idps)
+            if samlvalue is not None:
+                return samlvalue
+        if opts.password is not None:
+            password = opts.password
+        elif sys.stdin.isatty():
+            with PROMPT_LOCK:
+                password = getpass('Enter Password for %s at %s: ' % (config.username, get_fqdn(idp)))
+        else:
+            raise LoginRequired('no terminal to ask for the password of %s' % config.username)
+        samlvalue = login_with_password(config.username, password, idp, save_session=opts.cache, idps=idps,
+                                        cafile=config.ca_bundle)
+        if samlvalue == 'US-EN':
+            raise LoginRequired('No SAML Binding: could it be an invalid password?')
+        return samlvalue
+    return login
+
+
+def make_refreshers(opts):
+    '''
+    Build a refresher for each profile named by --profile, or for every profile in
+    $HOME/.getawscreds, sharing one assertion source between profiles with the same idp, user
+    and CA bundle. Each profile verifies servers against its own CA bundle.
+    '''
+    profiles = expand_profiles(opts.profile, opts.cache) if opts.profile else list_profiles(use_cache=opts.cache)
+    sources = {}
+    refreshers = []
+    for profile in profiles:
+        config = parse_config(profile, opts.account, opts.role, opts.duration, opts.idp, opts.username,
+                              ca_bundle=opts.ca_bundle, subject=opts.subject, use_cache=opts.cache)
+        idps = get_idps(config)
+        idp = idps[0]
+        user = config.subject if opts.piv else config.username
+        key = (get_fqdn(idp), user, config.ca_bundle)
+        if key not in sources:
+            sources[key] = daemon.AssertionSource(idp, user, make_login(opts, idp, config, idps),
+                                                  use_cache=opts.cache)
+        refreshers.append(daemon.ProfileRefresher(profile, config, sources[key], opts.region, opts.output,
+                                                  opts.sts_transport))
+
+    os.environ.pop('AWS_DEFAULT_PROFILE', None)
+    os.environ.pop('AWS_PROFILE', None)
+    return refreshers
+
+
+def run_daemon(opts):
+    scheduler = daemon.RefreshScheduler(make_refreshers(opts))
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def refresh_profiles(opts):
+    refreshers = make_refreshers(opts)
+    if not refreshers:
+        sys.stderr.write('No profiles match %s\n' % opts.profile)
+        return 1
+    if opts.min_remaining is not None:
+        refreshers = [r for r in refreshers
+                      if not profile_is_fresh(r.profile, opts.min_remaining, opts.output,
+                                              account=r.config.account, role=r.config.role)]
+        if not refreshers:
+            return 0
+    failed = daemon.refresh_all(refreshers, max_workers=opts.max_workers)
+    return 1 if failed else 0
+
+
+def run_credentials_server(opts):
+    from . import server
+    listen = opts.listen if opts.listen else server.DEFAULT_LISTEN
+    refreshers = make_refreshers(opts)
+    provider = server.CredentialProvider(refreshers)
+    token = os.environ.get('AWS_CONTAINER_AUTHORIZATION_TOKEN')
+    if not token:
+        token = binascii.hexlify(os.urandom(32)).decode('ascii')
+    httpd = server.make_server(listen, provider, token, refreshers[0].profile)
+    if listen.startswith('unix:'):
+        sys.stderr.write('Serving credentials on Unix domain socket %s\n' % listen[5:])
     else:
-        idp = make_idp(config.idp)
+        host, port = httpd.server_address[:2]
+        print('export AWS_CONTAINER_CREDENTIALS_FULL_URI="http://%s:%d/%s"' % (host, port, refreshers[0].profile))
+    print('export AWS_CONTAINER_AUTHORIZATION_TOKEN="%s"' % token)
+    sys.stdout.flush()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+    return 0
+
 
+def save_cached_assertion(idp, user, assertion):
+    try:
+        deadline = assertion.deadline
+    except (TypeError, ValueError, IndexError, SyntaxError):
+        # Without a usable deadline we cannot know when to stop reusing it
+        return
+    cache.save_saml_assertion(get_fqdn(idp), user, assertion.samlvalue, deadline)
+
+
+def get_credentials(opts, config, idp, store_key=None, idps=None):
+    '''
+    Log in, or reuse a cached assertion, assume the role and output the credentials
+    '''
     username = config.username
-    if opts.password is not None:
-        password = opts.password
-    elif not opts.piv:
-        password = getpass('Enter Password: ')
+    cache_user = config.subject if opts.piv else username
 
     if config.ca_bundle:
         os.environ['REQUESTS_CA_BUNDLE'] = config.ca_bundle
@@ -128,37 +441,70 @@ def main(args=None):
     os.environ.pop('AWS_DEFAULT_PROFILE', None)
     os.environ.pop('AWS_PROFILE', None)
 
-    if opts.piv:
-        if sys.platform != 'win32':
-            sys.stderr.write('PIV login is not supported on Linux or MacOS\n')
-            return 1
-        if config.subject is None:
-            sys.stderr.write('Specify a subject for SmartCard authentication\n')
+    deadline = Deadline(opts.deadline)
+    samlvalue = None
+    fresh_login = True
+    if opts.cache:
+        samlvalue = cache.load_saml_assertion(get_fqdn(idp), cache_user)
+        fresh_login = samlvalue is None
+        if samlvalue is None and not opts.piv:
+            samlvalue = login_with_saved_session(idp, username, deadline.split(IDP_SHARE), idps=idps)
+
+    prefetch = None
+    if samlvalue is None and not opts.piv:
+        if opts.password is not None:
+            password = opts.password
+        else:
+            if sys.stdin.isatty():
+                # fetch the login form and set up STS while the user types
+                prefetch = LoginPrefetch(idp, opts.region, opts.sts_transport, idps, deadline.split(IDP_SHARE))
+                prefetch.start()
+            started = time.monotonic()
+            password = getpass('Enter Password: ')
+            deadline.extend(time.monotonic() - started)
+
+    if samlvalue is None:
+        if opts.piv:
+            if sys.platform != 'win32':
+                sys.stderr.write('PIV login is not supported on Linux or MacOS\n')
+                return 1
+            if config.subject is None:
+                sys.stderr.write('Specify a subject for SmartCard authentication\n')
+                return 1
+            samlvalue = fedcred.get_saml_assertion_piv(config.subject, idp)
+        else:
+            idp_deadline = deadline.split(IDP_SHARE)
+            prefetched = prefetch.form(idp_deadline) if prefetch is not None else None
+            samlvalue = login_with_password(username, password, idp, save_session=opts.cache,
+                                            deadline=idp_deadline, idps=idps, prefetched=prefetched)
+        if samlvalue == 'US-EN':
+            sys.stderr.write('No SAML Binding: could it be an invalid password?\n')
             return 1
-        samlvalue = fedcred.get_saml_assertion_piv(config.subject, idp)
-    else:
-        samlvalue = fedcred.get_saml_assertion(username, password, idp)
-    if samlvalue == 'US-EN':
-        sys.stderr.write('No SAML Binding: could it be an invalid password?\n')
-        return 1
+    assertion = fedcred.SamlAssertion(samlvalue)
+    if opts.cache and fresh_login:
+        save_cached_assertion(idp, cache_user, assertion)
 
     if opts.samlout is not None:
-        xmlvalue = b64decode(samlvalue)
         with open(opts.samlout, 'wb') as f:
-            f.write(xmlvalue)
+            f.write(assertion.xml)
         print('Saml output saved without processing')
         return 0
+    if fresh_login:
+        cache.save_role_catalog(get_fqdn(idp), cache_user, assertion.role_pairs)
 
+    sts_client = prefetch.sts_client(deadline) if prefetch is not None else None
     principal = None
     role = None
 
-    authroles = fedcred.get_filtered_role_pairs(samlvalue, account=config.account, name=config.role)
-    if len(authroles) == 1:
+    authroles = assertion.filter_role_pairs(account=config.account, name=config.role)
+    if opts.all_matching and len(authroles) > 0:
+        return assume_all_roles(opts, config, authroles, samlvalue, deadline, sts_client)
+    elif len(authroles) == 1:
         principal = authroles[0][0]
         role = authroles[0][1]
     elif len(authroles) == 0:
         if opts.account is not None or opts.role is not None:
-            authroles = fedcred.get_filtered_role_pairs(samlvalue)
+            authroles = assertion.role_pairs
             if len(authroles) == 0:
                 sys.stderr.write('No roles found')
             else:
@@ -168,13 +514,26 @@ def main(args=None):
             sys.stderr.write('No roles found\n')
         return 1
     else:
-        sys.stderr.write("Multiple potential roles found. Use --account or --role argument to limit to one.\n")
-        output_roles(authroles)
+        sys.stderr.write("Multiple potential roles found. Use --account or --role argument to limit to one, or --all-matching to save them all.\n")
+        output_roles(authroles, sys.stderr if opts.credential_process else sys.stdout)
         return 1
 
     duration = config.duration
-    creds = fedcred.assume_role_with_saml(role, principal, samlvalue, opts.region, duration)
-    if opts.shell:
+    creds = fedcred.assume_role_with_saml(role, principal, samlvalue, opts.region, duration, client=sts_client,
+                                          transport=opts.sts_transport, deadline=deadline)
+    if store_key is not None:
+        # publish them to the runs waiting for this login
+        credstore.save_credentials(*store_key, creds)
+    return output_credentials(opts, creds)
+
+
+def output_credentials(opts, creds):
+    '''
+    Print the credentials for credential_process or a shell, or save them to the profile
+    '''
+    if opts.credential_process:
+        print(credstore.credential_process_json(creds))
+    elif opts.shell:
         if opts.output:
             os.umask(int('0077', 8))
             stream = open(opts.output, 'w')
@@ -183,9 +542,135 @@ def main(args=None):
         output_creds(opts.shell, opts.region, creds, stream)
     else:
         profile = opts.profile if opts.profile else 'default'
-        update_aws_credentials(opts.region, creds, profile, opts.output)
+        try:
+            update_aws_credentials(opts.region, creds, profile, opts.output)
+        except LockTimeout as e:
+            sys.stderr.write('%s\n' % e)
+            return 1
     return 0
 
 
+def run_login(opts, config, idp, store_key=None, idps=None):
+    '''
+    Run get_credentials, reporting network, NIH Login and STS failures without a traceback
+    '''
+    try:
+        return get_credentials(opts, config, idp, store_key, idps)
+    except (IOError, IdPError, DeadlineExceeded, STSError) as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+
+
+def main(args=None):
+    fedcred.set_default_creds()
+
+    if args is None:
+        args = sys.argv[:]
+
+    opts = parse_args(args[1:])
+
+    if opts.all_matching and (opts.shell or opts.credential_process):
+        sys.stderr.write('--all-matching saves profiles and cannot be combined with --shell or --credential-process\n')
+        return 1
+    if opts.credential_process and opts.shell:
+        sys.stderr.write('--credential-process cannot be combined with --shell\n')
+        return 1
+
+    if opts.setupcerts:
+        try:
+            written = setup_certificates(opts.setupcerts, opts.extra_certs)
+        except (IOError, ValueError) as e:
+            sys.stderr.write('%s\n' % e)
+            return 1
+        if written:
+            print('Wrote certificate bundle to %s' % opts.setupcerts)
+        else:
+            print('Certificate bundle %s is up to date' % opts.setupcerts)
+        return 0
+
+    if opts.setup_credential_process:
+        update_aws_credential_process(list_profiles())
+        return 0
+
+    if opts.list_roles:
+        return list_saved_roles(opts)
+
+    if opts.min_remaining is not None:
+        conflicts = (opts.shell, opts.all_matching, opts.credential_process, opts.samlout, opts.daemon,
+                     opts.serve_credentials)
+        if any(conflicts):
+            sys.stderr.write('--min-remaining checks a saved profile and cannot be combined with --shell, '
+                             '--all-matching, --credential-process, --samlout, --daemon or '
+                             '--serve-credentials\n')
+            return 1
+        if not (opts.profile and is_profile_list(opts.profile)):
+            profile = opts.profile if opts.profile else 'default'
+            config = parse_config(opts.profile, opts.account, opts.role, use_cache=opts.cache)
+            if profile_is_fresh(profile, opts.min_remaining, opts.output, account=config.account, role=config.role):
+                sys.stderr.write('Profile "%s" is valid for at least %d more minutes\n'
+                                 % (profile, opts.min_remaining))
+                return 0
+
+    if opts.daemon or opts.serve_credentials:
+        if opts.shell or opts.all_matching or opts.credential_process or (opts.daemon and opts.serve_credentials):
+            sys.stderr.write('--daemon and --serve-credentials cannot be combined with each other, --shell, '
+                             '--all-matching or --credential-process\n')
+            return 1
+        if opts.serve_credentials:
+            return run_credentials_server(opts)
+        return run_daemon(opts)
+
+    if opts.profile and is_profile_list(opts.profile):
+        if opts.shell or opts.all_matching or opts.credential_process or opts.samlout:
+            sys.stderr.write('Several profiles are saved to the credentials file and cannot be combined with '
+                             '--shell, --all-matching, --credential-process or --samlout\n')
+            return 1
+        return refresh_profiles(opts)
+
+    config = parse_config(
+        opts.profile,
+        opts.account,
+        opts.role,
+        opts.duration,
+        opts.idp,
+        opts.username,
+        ca_bundle=opts.ca_bundle,
+        subject=opts.subject,
+        # credential_process runs once per AWS command, and keeps an encrypted store anyway
+        use_cache=opts.cache or opts.credential_process,
+    )
+    idps = get_idps(config)
+    idp = idps[0]
+
+    cache_user = config.subject if opts.piv else config.username
+    if opts.all_matching or opts.samlout or not (opts.cache or opts.credential_process):
+        # sharing a login publishes the credentials to the cache directory, so only do it when caching
+        return run_login(opts, config, idp, idps=idps)
+
+    # Processes that need the same credentials at the same time share one login
+    store_key = (get_fqdn(idp), cache_user, config.account, config.role, opts.region, config.duration)
+    if opts.credential_process:
+        def published():
+            return credstore.load_credentials(*store_key)
+    else:
+        # only a login that is running now, since credentials of earlier runs were not asked for
+        since = time.time()
+
+        def published():
+            return credstore.load_credentials(*store_key, since=since)
+    flight = singleflight.SingleFlight(cache.get_cache_path('flight', *store_key))
+    try:
+        creds = flight.join(published)
+    except (LockTimeout, SharedLoginFailed) as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    if creds is not None:
+        return output_credentials(opts, creds)
+    try:
+        return run_login(opts, config, idp, store_key, idps)
+    finally:
+        flight.release()
+
+
 if __name__ == '__main__':
     main()
@@ -1,27 +1,39 @@
-import hashlib
+import json
 import os
-import shutil
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from configparser import ConfigParser
-from io import StringIO
+from datetime import datetime
 
-import certifi
-import six
-
-from .exceptions import CertificatesFileNotFound, ProfileNotFound
+from .certbundle import (build_bundle, has_certificate, load_certificate_files,
+                         pem_to_der)
+from .exceptions import ProfileNotFound
+from .inifile import update_sections
+from .locking import FileLock, atomic_write
 
 __all__ = (
     'Config',
     'parse_config',
+    'list_profiles',
     'get_user',
     'get_home',
     'get_aws_config_path',
     'get_aws_credentials_path',
     'update_aws_credentials',
+    'update_aws_profiles',
+    'update_aws_credential_process',
+    'get_profile_expiration',
+    'get_profile_role_arn',
 )
 
 
+# A duration of "max" asks for the longest session that the role and the assertion allow
+DURATION_MAX = 'max'
+
 Config = namedtuple('Config', ('account', 'role', 'duration', 'idp', 'username', 'subject', 'ca_bundle'))
+CONFIG_KEYS = Config._fields
+
+# Compiled profiles by (aws config path, getawscreds config path)
+CONFIG_SNAPSHOTS = {}
 
 
 def parse_config(
@@ -33,64 +45,144 @@ def parse_config(
         username=None,
         ca_bundle=None,
         subject=None,
-        inipath=None):
+        inipath=None,
+        use_cache=False):
 
-    defaults = None
-    awspath = get_aws_config_path()
-    if os.path.exists(awspath):
-        preconfig = ConfigParser()
-        preconfig.read(awspath)
-        defaults = preconfig['default']
-
-    if inipath is None:
-        inipath = get_awscreds_config_path()
+    sections = load_config_snapshot(inipath, use_cache)['sections']
 
-    config = ConfigParser(defaults=defaults)
-    config.read(inipath)
-
-    if profile is not None and profile in config:
+    if profile is not None and profile in sections:
         section = profile
     elif profile is None or profile == 'default':
         section = 'DEFAULT'
     else:
         raise ProfileNotFound("Profile '{}' not found in confuguration".format(profile))
+    values = sections[section]
 
     if account is None:
-        account = config.get(section, 'account', fallback=None)
+        account = values['account']
     if account is not None:
         account = str(account)
 
     if role is None:
-        role = config.get(section, 'role', fallback=None)
+        role = values['role']
     if role is not None:
         role = str(role)
 
     if duration is None:
-        duration = config.get(section, 'duration', fallback=3600)
-        duration = int(duration)
+        duration = values['duration']
+        if duration is None:
+            duration = 3600
+    duration = parse_duration(duration)
 
     if idp is None:
-        idp = config.get(section, 'idp', fallback=None)
+        idp = values['idp']
     if idp is not None:
         idp = str(idp)
 
     if subject is None:
-        subject = config.get(section, 'subject', fallback=None)
+        subject = values['subject']
     if subject is not None:
         subject = str(subject)
 
     if ca_bundle is None:
-        ca_bundle = config.get(section, 'ca_bundle', fallback=None)
+        ca_bundle = values['ca_bundle']
     if ca_bundle is not None:
         ca_bundle = str(ca_bundle)
 
     if username is None:
-        username = config.get(section, 'username', fallback=get_user())
+        username = values['username']
+        if username is None:
+            username = get_user()
         username = str(username)
 
     return Config(account, role, duration, idp, username, subject, ca_bundle)
 
 
+def parse_duration(value):
+    '''
+    Convert a duration from the command line or a profile to seconds, or to DURATION_MAX
+    '''
+    if isinstance(value, str) and value.strip().lower() == DURATION_MAX:
+        return DURATION_MAX
+    return int(value)
+
+
+def list_profiles(inipath=None, use_cache=False):
+    '''
+    List the named profiles in $HOME/.getawscreds, starting with the default profile
+    '''
+    order = load_config_snapshot(inipath, use_cache)['order']
+    return ['default'] + [section for section in order if section != 'default']
+
+
+def get_file_signature(path):
+    '''
+    Identify the version of a file by its inode, size and modification time
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def compile_config(awspath, inipath):
+    '''
+    Resolve the settings of every profile, with the [default] section of ~/.aws/config as defaults
+    '''
+    defaults = None
+    if os.path.exists(awspath):
+        preconfig = ConfigParser()
+        preconfig.read(awspath)
+        if 'default' in preconfig:
+            defaults = preconfig['default']
+
+    config = ConfigParser(defaults=defaults)
+    config.read(inipath)
+
+    sections = {}
+    for section in ['DEFAULT'] + config.sections():
+        sections[section] = dict((key, config.get(section, key, fallback=None)) for key in CONFIG_KEYS)
+    return {'sections': sections, 'order': config.sections()}
+
+
+def load_config_snapshot(inipath=None, use_cache=False):
+    '''
+    Return the compiled profiles, compiling them again only when one of the files has changed.
+
+    Snapshots are kept in memory. With use_cache they are also kept in the cache
+    directory, so that a new process checks the files with one stat each and
+    reads one small file.
+    '''
+    awspath = get_aws_config_path()
+    if inipath is None:
+        inipath = get_awscreds_config_path()
+    signature = [get_file_signature(awspath), get_file_signature(inipath)]
+
+    key = (awspath, inipath)
+    snapshot = CONFIG_SNAPSHOTS.get(key)
+    if snapshot is not None and snapshot['signature'] == signature:
+        return snapshot
+    if not use_cache:
+        snapshot = compile_config(awspath, inipath)
+        snapshot['signature'] = signature
+        CONFIG_SNAPSHOTS[key] = snapshot
+        return snapshot
+
+    from . import cache
+    path = cache.get_cache_path('config', awspath, inipath)
+    try:
+        snapshot = json.loads(cache.read_private_file(path).decode('utf-8'))
+    except (AttributeError, ValueError):
+        snapshot = None
+    if snapshot is None or snapshot.get('signature') != signature:
+        snapshot = compile_config(awspath, inipath)
+        snapshot['signature'] = signature
+        cache.write_private_file(path, json.dumps(snapshot).encode('utf-8'))
+    CONFIG_SNAPSHOTS[key] = snapshot
+    return snapshot
+
+
 def get_user():
     '''
     Get the current username in a way that should work in Linux, OS X, and Windows
@@ -141,34 +233,21 @@ def get_awscreds_config_path():
     return os.path.join(get_home(), '.getawscreds')
 
 
-def setup_certificates(bundle_path):
+def setup_certificates(bundle_path, extra_paths=()):
     """
     Copy the certificates in certifi package to our own name
-    Append our SSL interceptors certificate to the set of certificates in certifi
+    Append our SSL interceptors certificate to the set of certificates in certifi,
+    along with any certificates in the files or directories of extra_paths
     Define REQUESTS_CA_BUNDLE to point towards that.
-    """
-    certifi_bundle = certifi.where()
-    if not os.path.exists(certifi_bundle):
-        raise CertificatesFileNotFound()
-    shutil.copyfile(certifi_bundle, bundle_path)
-    our_cert_data = nlmsecpalo_cert()
-    assure_cert_in_bundle(our_cert_data, bundle_path)
-
 
-def assure_cert_in_bundle(cert_data, bundle_path):
-    if not certsfile_hascert(bundle_path, cert_data):
-        with open(bundle_path, 'a') as f:
-            f.write(cert_data)
-
-
-def checksum(certdata):
-    return hashlib.md5(certdata.encode('ascii')).hexdigest()
+    Returns False without writing anything when the bundle is already up to date.
+    """
+    extra_certs = [pem_to_der(nlmsecpalo_cert())] + load_certificate_files(extra_paths)
+    return build_bundle(bundle_path, extra_certs)
 
 
 def certsfile_hascert(path, certdata):
-    oursum = checksum(certdata)
-    matching_certs = list(filter(lambda c: c == oursum, map(checksum, enum_certs(path))))
-    return len(matching_certs) > 0
+    return has_certificate(path, certdata)
 
 
 def nlmsecpalo_cert():
@@ -176,35 +255,95 @@ def nlmsecpalo_cert():
         return cert_file.read()
 
 
-def enum_certs(path):
-    with open(path, 'r') as cert_file:
-        buf = StringIO()
-        for line in cert_file:
-            s = line.rstrip()
-            if s == '-----BEGIN CERTIFICATE-----':
-                buf = StringIO()
-            buf.write(six.text_type(line))
-            if s == '-----END CERTIFICATE-----':
-                certificate = buf.getvalue()
-                buf = StringIO()
-                yield certificate
+def update_aws_credentials(region, creds, profile='default', path=None):
+    update_aws_profiles(region, [(profile, creds)], path)
 
 
-def update_aws_credentials(region, creds, profile='default', path=None):
-    config = ConfigParser()
-    if not path:
-        path = get_aws_credentials_path()
+def read_text(path):
+    '''
+    Read a config file that may not exist yet
+    '''
+    try:
+        with open(path) as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return ''
+
+
+def update_file(path, updates, replace=True):
+    '''
+    Apply update_sections to the file under its lock, replacing it atomically
+    '''
     dirname = os.path.dirname(path)
-    if os.path.isdir(dirname):
-        config.read(path)
-    else:
+    if not os.path.isdir(dirname):
         os.mkdir(dirname)
-    config.remove_section(profile)
-    config.add_section(profile)
-    config.set(profile, 'region', region)
-    config.set(profile, 'aws_access_key_id', creds.access_key)
-    config.set(profile, 'aws_secret_access_key', creds.secret_key)
-    config.set(profile, 'aws_session_token', creds.session_token)
-    print('Updating profile "%s" in ~/.aws/credentials' % profile)
-    with open(path, 'w') as fp:
-        config.write(fp)
+    with FileLock(path):
+        atomic_write(path, update_sections(read_text(path), updates, replace))
+
+
+def update_aws_profiles(region, profile_creds, path=None):
+    '''
+    Save several (profile, creds) pairs to the AWS credentials file in one pass,
+    leaving other profiles and comments as they are
+    '''
+    if not path:
+        path = get_aws_credentials_path()
+    updates = OrderedDict()
+    for profile, creds in profile_creds:
+        updates[profile] = [
+            ('region', region),
+            ('aws_access_key_id', creds.access_key),
+            ('aws_secret_access_key', creds.secret_key),
+            ('aws_session_token', creds.session_token),
+        ]
+        if creds.expiration is not None:
+            from .credstore import format_expiration
+            updates[profile].append(('aws_expiration', format_expiration(creds.expiration)))
+        if creds.role_arn is not None:
+            updates[profile].append(('aws_role_arn', creds.role_arn))
+        print('Updating profile "%s" in ~/.aws/credentials' % profile)
+    update_file(path, updates)
+
+
+def get_saved_value(profile, key, path=None):
+    if not path:
+        path = get_aws_credentials_path()
+    credentials = ConfigParser()
+    credentials.read(path)
+    return credentials.get(profile, key, raw=True, fallback=None)
+
+
+def get_profile_role_arn(profile='default', path=None):
+    '''
+    Return the ARN of the role whose credentials are saved for profile, or None if it was not recorded
+    '''
+    return get_saved_value(profile, 'aws_role_arn', path)
+
+
+def get_profile_expiration(profile='default', path=None):
+    '''
+    Return when the credentials saved for profile expire, as a naive UTC datetime,
+    or None if the profile or its expiration is missing
+    '''
+    from .cache import TIMESTAMP_FORMAT
+    value = get_saved_value(profile, 'aws_expiration', path)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def update_aws_credential_process(profiles, command='getawscreds', path=None):
+    '''
+    Point each profile in the AWS config file at getawscreds as its credential_process
+    '''
+    if not path:
+        path = get_aws_config_path()
+    updates = OrderedDict()
+    for profile in profiles:
+        section = profile if profile == 'default' else 'profile %s' % profile
+        updates[section] = [('credential_process', '%s --credential-process --profile %s' % (command, profile))]
+        print('Updating profile "%s" in ~/.aws/config' % profile)
+    update_file(path, updates, replace=False)
@@ -0,0 +1,89 @@
+"""
+Encrypted store of temporary AWS credentials, used by credential_process mode.
+
+The AWS CLI runs the credential_process command before every single command,
+so reading from this store must stay cheap: it only needs the cache helpers
+and must not import boto3, bs4 or lxml.
+"""
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+from . import cache
+from .fedcred import Credentials
+
+__all__ = (
+    'save_credentials',
+    'load_credentials',
+    'format_expiration',
+    'credential_process_json',
+)
+
+# Fall back to a fresh login when the stored credentials expire within this many seconds
+EXPIRY_MARGIN = 300
+
+
+def get_store_path(fqdn, user, account, role, region, duration):
+    return cache.get_cache_path('creds', fqdn, user, account, role, region, duration)
+
+
+def to_utc(expiration):
+    '''
+    Convert an expiration to a naive datetime in UTC, as used elsewhere in this package
+    '''
+    if expiration.tzinfo is not None:
+        expiration = expiration.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiration
+
+
+def format_expiration(expiration):
+    return to_utc(expiration).strftime(cache.TIMESTAMP_FORMAT)
+
+
+def save_credentials(fqdn, user, account, role, region, duration, creds):
+    if creds.expiration is None:
+        # without an expiration there is no way to know when to stop serving them
+        return
+    cache.save_encrypted(get_store_path(fqdn, user, account, role, region, duration), {
+        'access_key': creds.access_key,
+        'secret_key': creds.secret_key,
+        'session_token': creds.session_token,
+        'expiration': format_expiration(creds.expiration),
+        'saved': time.time(),
+        'role_arn': creds.role_arn,
+    })
+
+
+def load_credentials(fqdn, user, account, role, region, duration, margin=EXPIRY_MARGIN, now=None, since=None):
+    '''
+    Return the stored Credentials, or None if there are none or they expire within margin seconds.
+    With since, a time.time(), credentials saved before then are also left out.
+    '''
+    entry = cache.load_encrypted(get_store_path(fqdn, user, account, role, region, duration))
+    if not entry:
+        return None
+    if since is not None:
+        if entry.get('saved', 0) < since:
+            return None
+    if now is None:
+        now = datetime.utcnow()
+    expiration = datetime.strptime(entry['expiration'], cache.TIMESTAMP_FORMAT)
+    if now >= expiration - timedelta(seconds=margin):
+        return None
+    return Credentials(entry['access_key'], entry['secret_key'], entry['session_token'], expiration,
+                       entry.get('role_arn'))
+
+
+def credential_process_json(creds):
+    '''
+    Format credentials as the JSON document expected from an AWS credential_process
+    '''
+    document = {
+        'Version': 1,
+        'AccessKeyId': creds.access_key,
+        'SecretAccessKey': creds.secret_key,
+        'SessionToken': creds.session_token,
+    }
+    if creds.expiration is not None:
+        document['Expiration'] = format_expiration(creds.expiration)
+    return json.dumps(document)
@@ -0,0 +1,255 @@
+"""
+Keep the credentials for several profiles fresh from one long-running process.
+
+Each profile is refreshed ahead of its expiration, reusing the SAML assertion
+for its IdP and user until that expires too, so that NIH Login is only asked
+for a new assertion when one is actually needed.
+"""
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+
+from . import cache, credstore, fedcred
+from .config import update_aws_credentials
+from .exceptions import LoginRequired
+from .idp import get_fqdn
+
+__all__ = (
+    'AssertionSource',
+    'ProfileRefresher',
+    'RefreshScheduler',
+    'refresh_all',
+)
+
+logger = logging.getLogger(__name__)
+
+# Refresh once this fraction of the credentials' lifetime has passed
+REFRESH_FRACTION = 0.8
+
+# How long to wait before trying again after a failed refresh
+RETRY_DELAY = 300
+
+
+class AssertionSource(object):
+    '''
+    Hands out the SAML assertion for one IdP and user, logging in again only when it has expired.
+
+    login is called with no arguments and returns a new base64 SAML assertion;
+    it may raise LoginRequired when nobody is available to authenticate.
+    '''
+
+    def __init__(self, idp, user, login, use_cache=True):
+        self.idp = idp
+        self.user = user
+        self.login = login
+        self.use_cache = use_cache
+        self.assertion = None
+        self.lock = threading.Lock()
+
+    def is_valid(self, assertion, now=None):
+        try:
+            assertion.get_longest_duration(now)
+        except (ValueError, IndexError):
+            return False
+        return True
+
+    def get(self, now=None):
+        with self.lock:
+            if self.assertion is not None and self.is_valid(self.assertion, now):
+                return self.assertion
+            samlvalue = None
+            if self.use_cache:
+                samlvalue = cache.load_saml_assertion(get_fqdn(self.idp), self.user, now=now)
+            fresh_login = samlvalue is None
+            if fresh_login:
+                logger.info('Logging in to %s as %s', get_fqdn(self.idp), self.user)
+                samlvalue = self.login()
+            assertion = fedcred.SamlAssertion(samlvalue)
+            if not self.is_valid(assertion, now):
+                raise LoginRequired('NIH Login returned an assertion that is already expired')
+            if fresh_login:
+                cache.save_role_catalog(get_fqdn(self.idp), self.user, assertion.role_pairs)
+            if self.use_cache and fresh_login:
+                cache.save_saml_assertion(get_fqdn(self.idp), self.user, samlvalue, assertion.deadline)
+            self.assertion = assertion
+            return assertion
+
+
+class ProfileRefresher(object):
+    '''
+    Assumes the role for one named profile and saves the credentials
+    '''
+
+    def __init__(self, profile, config, source, region, path=None, transport='boto3'):
+        self.profile = profile
+        self.config = config
+        self.source = source
+        self.region = region
+        self.path = path
+        self.transport = transport
+
+    def assume(self, client=None):
+        '''
+        Assume the profile's role and return the credentials without saving them
+        '''
+        assertion = self.source.get()
+        authroles = assertion.filter_role_pairs(account=self.config.account, name=self.config.role)
+        if len(authroles) != 1:
+            raise ValueError('profile %s: expected one matching role, found %d' % (self.profile, len(authroles)))
+        principal, role = authroles[0]
+        if client is None:
+            client = self.make_sts_client()
+        return fedcred.assume_role_with_saml(role, principal, assertion.samlvalue, self.region,
+                                             self.config.duration, client=client, transport=self.transport)
+
+    def make_sts_client(self):
+        return fedcred.make_sts_client(self.region, self.transport, cafile=self.config.ca_bundle)
+
+    def refresh(self):
+        creds = self.assume()
+        self.save(creds)
+        return creds
+
+    def save(self, creds):
+        update_aws_credentials(self.region, creds, self.profile, self.path)
+        credstore.save_credentials(get_fqdn(self.source.idp), self.source.user, self.config.account,
+                                   self.config.role, self.region, self.config.duration, creds)
+
+    def next_refresh_delay(self, creds, now=None):
+        '''
+        Seconds from now until these credentials should be replaced
+        '''
+        if creds.expiration is None:
+            lifetime = fedcred.get_nominal_duration(self.config.duration)
+        else:
+            if now is None:
+                now = datetime.utcnow()
+            lifetime = (credstore.to_utc(creds.expiration) - now).total_seconds()
+        return max(0, lifetime * REFRESH_FRACTION)
+
+
+class RefreshScheduler(object):
+    '''
+    Runs each refresher when it is due, sleeping until the earliest one rather than polling
+    '''
+
+    def __init__(self, refreshers, clock=time.time, notify=None):
+        self.refreshers = dict((r.profile, r) for r in refreshers)
+        self.clock = clock
+        self.notify = notify if notify else self.notify_stderr
+        self.queue = []
+        self.counter = itertools.count()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        for profile in self.refreshers:
+            self.schedule(profile, 0)
+
+    def notify_stderr(self, profile, message):
+        sys.stderr.write('%s: %s\n' % (profile, message))
+
+    def schedule(self, profile, delay):
+        heapq.heappush(self.queue, (self.clock() + delay, next(self.counter), profile))
+        self.wakeup.set()
+
+    def run_pending(self):
+        '''
+        Refresh every profile that is due, and return the seconds until the next one is
+        '''
+        while self.queue and self.queue[0][0] <= self.clock():
+            _, _, profile = heapq.heappop(self.queue)
+            refresher = self.refreshers[profile]
+            try:
+                creds = refresher.refresh()
+            except LoginRequired as e:
+                self.notify(profile, 'a new login is needed: %s' % e)
+                self.schedule(profile, RETRY_DELAY)
+            except Exception as e:
+                self.notify(profile, 'refresh failed: %s' % e)
+                self.schedule(profile, RETRY_DELAY)
+            else:
+                delay = refresher.next_refresh_delay(creds)
+                logger.info('%s: refreshed, next refresh in %d seconds', profile, delay)
+                self.schedule(profile, delay)
+        if not self.queue:
+            return None
+        return max(0, self.queue[0][0] - self.clock())
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.clear()
+            delay = self.run_pending()
+            if self.stopped:
+                break
+            self.wakeup.wait(delay)
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+
+def refresh_all(refreshers, max_workers=8, notify=None):
+    '''
+    Refresh every profile once, and return the profiles that failed.
+
+    Each assertion source logs in once, with different sources logging in at
+    the same time, and each profile's role is assumed as soon as its source has
+    an assertion. Profiles are saved one at a time, as their credentials arrive.
+    '''
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    if notify is None:
+        def notify(profile, message):
+            sys.stderr.write('%s: %s\n' % (profile, message))
+
+    groups = {}
+    for refresher in refreshers:
+        groups.setdefault(id(refresher.source), []).append(refresher)
+
+    # Share one STS client per region, transport and CA bundle, since creating boto3 clients is not thread safe
+    def client_key(refresher):
+        return (refresher.region, refresher.transport, refresher.config.ca_bundle)
+
+    clients = {}
+    for refresher in refreshers:
+        if client_key(refresher) not in clients:
+            clients[client_key(refresher)] = refresher.make_sts_client()
+
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    failed = []
+
+    async def refresh(refresher):
+        client = clients[client_key(refresher)]
+        try:
+            creds = await loop.run_in_executor(executor, refresher.assume, client)
+            # Saving on the event loop's thread keeps writes to the credentials file from overlapping
+            refresher.save(creds)
+        except Exception as e:
+            notify(refresher.profile, 'refresh failed: %s' % e)
+            failed.append(refresher.profile)
+
+    async def refresh_group(members):
+        source = members[0].source
+        try:
+            await loop.run_in_executor(executor, source.get)
+        except Exception as e:
+            for refresher in members:
+                notify(refresher.profile, 'login failed: %s' % e)
+                failed.append(refresher.profile)
+            return
+        await asyncio.gather(*[refresh(r) for r in members])
+
+    async def refresh_groups():
+        await asyncio.gather(*[refresh_group(m) for m in groups.values()])
+
+    try:
+        loop.run_until_complete(refresh_groups())
+    finally:
+        executor.shutdown()
+        loop.close()
+    return [r.profile for r in refreshers if r.profile in failed]
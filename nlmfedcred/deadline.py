@@ -0,0 +1,69 @@
+"""
+Time budgets for the network calls of a login.
+
+A Deadline is the time left for a whole run, set with --deadline, and can be
+split so that one phase, such as the NIH Login exchange, cannot use up the
+time that a later phase, such as the call to STS, still needs. Without a
+budget a Deadline never runs out, and requests are only bounded by their
+connect and read timeouts.
+"""
+import time
+
+from .exceptions import DeadlineExceeded
+
+__all__ = (
+    'Deadline',
+)
+
+# Seconds to wait for a connection, and then for each read of the response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+
+
+class Deadline(object):
+    '''
+    The time left for a run, or for one phase of it
+    '''
+
+    def __init__(self, seconds=None, clock=time.monotonic):
+        self.clock = clock
+        self.expires = None if seconds is None else clock() + seconds
+
+    def remaining(self):
+        '''
+        Seconds left, which may be negative, or None if there is no budget
+        '''
+        if self.expires is None:
+            return None
+        return self.expires - self.clock()
+
+    def check(self, what='the credentials were obtained'):
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded('The deadline ran out before %s' % what)
+        return remaining
+
+    def extend(self, seconds):
+        '''
+        Give back time that was not spent on the network, such as time at the password prompt
+        '''
+        if self.expires is not None:
+            self.expires += seconds
+
+    def split(self, share):
+        '''
+        Return the deadline for a phase that may use this share of the time left
+        '''
+        remaining = self.remaining()
+        if remaining is None:
+            return Deadline(None, self.clock)
+        return Deadline(max(0, remaining) * share, self.clock)
+
+    def timeout(self, connect=CONNECT_TIMEOUT, read=READ_TIMEOUT):
+        '''
+        Return the (connect, read) timeouts for the next request, no longer than the time left
+        '''
+        remaining = self.check()
+        if remaining is None:
+            return (connect, read)
+        return (min(connect, remaining), min(read, remaining))
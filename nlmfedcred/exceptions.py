@@ -12,3 +12,55 @@ class ProfileNotFound(Exception):
     The profile you named does not exist in $HOME/.getawscreds
     """
     pass
+
+
+# Define a class for when a fresh login is needed but cannot be done
+class LoginRequired(Exception):
+    """
+    A new SAML assertion is needed, but nobody is available to authenticate
+    """
+    pass
+
+
+# Define a class for errors returned by AWS STS
+class STSError(Exception):
+    """
+    AWS STS rejected a request, for example with a ValidationError or AccessDenied
+    """
+
+    def __init__(self, code, message):
+        super().__init__('%s: %s' % (code, message))
+        self.code = code
+        self.message = message
+
+
+# Define a class for when another process holds a file lock for too long
+class LockTimeout(Exception):
+    """
+    Another getawscreds is still updating the file after the lock wait ran out
+    """
+    pass
+
+
+# Define a class for when the process doing a shared login fails
+class SharedLoginFailed(Exception):
+    """
+    Another getawscreds was doing the same login for this one, and it failed
+    """
+    pass
+
+
+# Define a class for errors returned by NIH Login
+class IdPError(Exception):
+    """
+    NIH Login answered with an HTTP error or a page without what was expected
+    """
+    pass
+
+
+# Define a class for when the --deadline runs out
+class DeadlineExceeded(Exception):
+    """
+    The time allowed for getting the credentials ran out
+    """
+    pass
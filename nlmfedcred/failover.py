@@ -0,0 +1,157 @@
+"""
+Log in through whichever of several NIH Login endpoints answers first.
+
+A profile may list several endpoints of the same IdP, such as
+"idp = auth1.nih.gov, auth2.nih.gov". The login form is requested from the
+endpoint that has recently done best, and from the next one as well whenever
+those already asked have failed or have not answered within a short head
+start. The login goes on with the first endpoint to return the form.
+
+The latency and recent failures of each endpoint are kept in the cache
+directory, so that the next run asks the best endpoint first and, while all
+is well, asks only that one.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+from . import cache
+from .exceptions import IdPError
+from .idp import get_fqdn
+
+__all__ = (
+    'load_stats',
+    'order_idps',
+    'race_login_form',
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for an endpoint before also asking the next one
+HEDGE_DELAY = 1.0
+
+# Weight of the newest latency in each endpoint's moving average
+LATENCY_WEIGHT = 0.3
+
+# Assumed latency of an endpoint that has not been asked yet
+UNKNOWN_LATENCY = 1.0
+
+# Seconds added to an endpoint's score for each recent failure, and how long a failure counts
+FAILURE_PENALTY = 30.0
+FAILURE_MEMORY = 600
+
+
+def get_stats_path():
+    return cache.get_cache_path('idpstats', 'endpoints')
+
+
+def load_stats():
+    '''
+    Return the stats of every endpoint by FQDN: latency, failures, and last_failure as a time.time()
+    '''
+    data = cache.read_private_file(get_stats_path())
+    try:
+        stats = json.loads(data.decode('utf-8'))
+    except (AttributeError, ValueError):
+        return {}
+    return stats if isinstance(stats, dict) else {}
+
+
+def save_stats(stats):
+    cache.write_private_file(get_stats_path(), json.dumps(stats).encode('utf-8'))
+
+
+def record_result(stats, fqdn, latency=None, now=None):
+    '''
+    Record an answer from the endpoint after latency seconds, or a failure when latency is None
+    '''
+    if now is None:
+        now = time.time()
+    entry = stats.setdefault(fqdn, {'latency': None, 'failures': 0, 'last_failure': None})
+    if latency is None:
+        entry['failures'] += 1
+        entry['last_failure'] = now
+    else:
+        previous = entry['latency']
+        entry['latency'] = latency if previous is None else previous + LATENCY_WEIGHT * (latency - previous)
+        entry['failures'] = 0
+
+
+def get_score(entry, now):
+    if not entry:
+        return UNKNOWN_LATENCY
+    score = entry['latency'] if entry['latency'] is not None else UNKNOWN_LATENCY
+    if entry['failures'] and entry['last_failure'] and now - entry['last_failure'] < FAILURE_MEMORY:
+        score += FAILURE_PENALTY * entry['failures']
+    return score
+
+
+def order_idps(idps, stats, now=None):
+    '''
+    Order the endpoints best first, keeping the listed order between equally good ones
+    '''
+    if now is None:
+        now = time.time()
+    return sorted(idps, key=lambda idp: get_score(stats.get(get_fqdn(idp)), now))
+
+
+def race_login_form(idps, make_session, hedge_delay=HEDGE_DELAY):
+    '''
+    GET the login form from the endpoints, best first, and return the (idp, session, response)
+    of the first one to answer it. make_session is called for a new session for each endpoint.
+
+    Raises the last error, or IdPError, when every endpoint fails.
+    '''
+    stats = load_stats()
+    ordered = order_idps(idps, stats)
+    results = queue.Queue()
+
+    def fetch(idp):
+        session = make_session()
+        started = time.monotonic()
+        try:
+            r = session.get(idp.form_url)
+        except Exception as e:
+            results.put((idp, session, None, e, None))
+        else:
+            results.put((idp, session, r, None, time.monotonic() - started))
+
+    def start_next():
+        idp = ordered[len(started)]
+        logger.debug('Asking %s for the login form', get_fqdn(idp))
+        started.append(idp)
+        # a slow endpoint that loses the race must not keep the process alive
+        thread = threading.Thread(target=fetch, args=(idp,))
+        thread.daemon = True
+        thread.start()
+
+    started = []
+    start_next()
+    pending = 1
+    winner = None
+    error = None
+    while pending:
+        try:
+            idp, session, r, e, latency = results.get(timeout=hedge_delay if len(started) < len(ordered) else None)
+        except queue.Empty:
+            start_next()
+            pending += 1
+            continue
+        pending -= 1
+        if e is None and r.ok:
+            record_result(stats, get_fqdn(idp), latency)
+            winner = (idp, session, r)
+            break
+        error = e if e is not None else IdPError('%s returned HTTP %d for the login form'
+                                                 % (get_fqdn(idp), r.status_code))
+        logger.info('%s', error)
+        record_result(stats, get_fqdn(idp))
+        if len(started) < len(ordered):
+            start_next()
+            pending += 1
+    save_stats(stats)
+    if winner is None:
+        raise error
+    return winner
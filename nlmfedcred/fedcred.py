@@ -3,20 +3,26 @@ from __future__ import print_function, unicode_literals
 
 import logging
 import os
-import re
 import sys
 from base64 import b64decode
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-import boto3
-import requests
-from bs4 import BeautifulSoup
-from lxml import etree
+from . import cache
+from .config import DURATION_MAX, get_home
+from .exceptions import IdPError, STSError
+from .htmlform import find_input_value, get_first_input_value, get_form_inputs
+from .idp import get_fqdn
+from .roles import RoleIndex
 
-from .config import get_home
+# boto3, requests and lxml are imported where they are used, so that
+# paths which never touch the network or the assertion (such as --help,
+# --setupcerts and credential_process cache hits) do not pay for importing them.
 
-Credentials = namedtuple('Credentials', ['access_key', 'secret_key', 'session_token'])
+Credentials = namedtuple('Credentials', ['access_key', 'secret_key', 'session_token', 'expiration', 'role_arn'])
+Credentials.__new__.__defaults__ = (None, None)
 
 
 logger = logging.getLogger(__name__)
@@ -36,131 +42,393 @@ def set_default_creds():
         os.environ.setdefault('AWS_SECRET_ACCESS_KEY', '9999999999999999')
 
 
-def get_hidden_inputs(session, idp):
-    if session is None:
-        session = requests.session()
-    r = session.get(idp.form_url)
-    assert r.ok
+def make_session(cookies=None, deadline=None, cafile=None):
+    '''
+    Make a requests session, optionally holding cookies saved by cache.save_cookies,
+    that verifies servers against cafile, or by default the bundle that requests would use
+    '''
+    import requests
 
-    soup = BeautifulSoup(r.content, 'lxml')
-    form = soup.find_all('form')[0]
+    from . import transport
+    session = transport.make_session(cafile, deadline)
+    for cookie in cookies or ():
+        session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+    return session
 
-    form_data = {}
-    for i in form.find_all('input'):
-        if 'name' in i.attrs and 'value' in i.attrs:
-            form_data[i.attrs['name']] = i.attrs['value']
 
-    return form_data
+def get_saml_assertion_from_session(idp, session):
+    '''
+    Get a SAML assertion from an existing IdP session, without a password.
+
+    Returns None when the IdP does not accept the session and asks for a login instead.
+    '''
+    r = session.get(idp.form_url)
+    if not r.ok:
+        return None
+    return find_input_value(r.content, 'SAMLResponse')
+
+
+def get_hidden_inputs(session, idp):
+    if session is None:
+        session = make_session()
+    return parse_hidden_inputs(idp, session.get(idp.form_url))
 
 
-def get_saml_assertion(username, password, idp, session=None):
+def parse_hidden_inputs(idp, r):
     '''
-    Authenticate against the IdP, and get the SAML assertion
+    Return the hidden inputs of the login form in the IdP's response to a GET of its form_url,
+    and keep them as the template for logins that skip the GET
     '''
-    if session is None:
-        session = requests.session()
-    form_data = get_hidden_inputs(session, idp)
+    if not r.ok:
+        raise IdPError('%s returned HTTP %d for the login form' % (get_fqdn(idp), r.status_code))
+    form_data = get_form_inputs(r.content)
+    cache.save_form_template(get_fqdn(idp), form_data)
+    return form_data
+
+
+def post_login(session, idp, username, password, form_data):
+    form_data = dict(form_data)
     form_data['USER'] = username
     form_data['PASSWORD'] = password
     r = session.post(idp.login_url, form_data)
 
     if not r.ok:
-        return r.status_code
+        raise IdPError('%s returned HTTP %d for the login' % (get_fqdn(idp), r.status_code))
+
+    samlvalue = get_first_input_value(r.content)
+    if samlvalue is None:
+        raise IdPError('%s returned a page without a SAML assertion' % get_fqdn(idp))
+    return samlvalue
+
 
-    soup = BeautifulSoup(r.content, 'lxml')
-    samlinput = soup.find('input')
+def get_saml_assertion(username, password, idp, session=None, form_data=None, use_template=False):
+    '''
+    Authenticate against the IdP, and get the SAML assertion.
 
-    assert samlinput
-    samlvalue = samlinput.attrs['value']
+    form_data holds the hidden inputs of the login form when they were already fetched with session.
+    With use_template, the hidden inputs saved from an earlier login are posted without
+    fetching the form. If the IdP refuses them, the template is dropped and the form is
+    fetched, which saves a new one. The password is posted again only if the form's hidden
+    inputs have changed, so that a wrong password is not sent twice.
+    '''
+    if session is None:
+        session = make_session()
+    from_template = False
+    if form_data is None and use_template:
+        form_data = cache.load_form_template(get_fqdn(idp))
+        from_template = form_data is not None
+    if form_data is None:
+        form_data = get_hidden_inputs(session, idp)
+    rejected = None
+    try:
+        samlvalue = post_login(session, idp, username, password, form_data)
+    except IdPError as e:
+        if not from_template:
+            raise
+        # a stale template may also be answered with an error or a page that is not the login form
+        samlvalue, rejected = None, e
+
+    # the IdP answers a login it does not accept with its login form, whose first input is SMLOCALE
+    if from_template and (rejected is not None or samlvalue == 'US-EN'):
+        cache.count_form_template(get_fqdn(idp), 'rejected')
+        cache.clear_form_template(get_fqdn(idp))
+        fresh_data = get_hidden_inputs(session, idp)
+        if fresh_data != form_data:
+            logger.debug('The hidden inputs of the login form at %s have changed', get_fqdn(idp))
+            samlvalue = post_login(session, idp, username, password, fresh_data)
+        elif rejected is not None:
+            raise rejected
     return samlvalue
 
 
+SAML_NAMESPACES = {
+    'p': 'urn:oasis:names:tc:SAML:2.0:protocol',
+    'a': 'urn:oasis:names:tc:SAML:2.0:assertion'
+}
+ROLE_ATTRIBUTE_NAME = 'https://aws.amazon.com/SAML/Attributes/Role'
+
+AUTHN_STATEMENT_XPATH = '/p:Response/a:Assertion/a:AuthnStatement'
+ATTRIBUTE_STATEMENT_XPATH = '/p:Response/a:Assertion/a:AttributeStatement'
+ATTRIBUTE_XPATH = 'a:Attribute'
+ATTRIBUTE_VALUE_XPATH = 'a:AttributeValue'
+
+
+@lru_cache(maxsize=None)
+def saml_xpath(expr):
+    '''
+    Compile each XPath expression once per process, the first time it is needed
+    '''
+    from lxml import etree
+    return etree.XPath(expr, namespaces=SAML_NAMESPACES)
+
+
+class SamlAssertion(object):
+    '''
+    A base64 encoded SAML assertion that is decoded and parsed at most once.
+
+    Each property is computed the first time it is used and then remembered.
+    '''
+
+    def __init__(self, samlvalue):
+        self.samlvalue = samlvalue
+        self._xml = None
+        self._tree = None
+        self._deadline = None
+        self._role_pairs = None
+        self._role_index = None
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = b64decode(self.samlvalue)
+        return self._xml
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            from lxml import etree
+            self._tree = etree.fromstring(self.xml, etree.XMLParser(resolve_entities=False))
+        return self._tree
+
+    @property
+    def deadline(self):
+        if self._deadline is None:
+            authorization = saml_xpath(AUTHN_STATEMENT_XPATH)(self.tree)[0]
+            deadline = authorization.get('SessionNotOnOrAfter')
+            if not deadline:
+                raise ValueError('The SAML Credentials have no expiration timestamp')
+            self._deadline = datetime.strptime(deadline, '%Y-%m-%dT%H:%M:%SZ')
+        return self._deadline
+
+    @property
+    def longest_duration(self):
+        return self.get_longest_duration()
+
+    def get_longest_duration(self, now=None):
+        if not now:
+            now = datetime.utcnow()
+        deadline = self.deadline - timedelta(seconds=600)
+        if now >= deadline:
+            raise ValueError('The credential is expired or will expire in the next 10 minutes')
+        return int((deadline - now).total_seconds())
+
+    @property
+    def role_pairs(self):
+        if self._role_pairs is None:
+            stmt = saml_xpath(ATTRIBUTE_STATEMENT_XPATH)(self.tree)[0]
+            pairs = []
+            for a in saml_xpath(ATTRIBUTE_XPATH)(stmt):
+                if a.get('Name') == ROLE_ATTRIBUTE_NAME:
+                    for value in saml_xpath(ATTRIBUTE_VALUE_XPATH)(a):
+                        pair_list = value.text.split(',')
+                        if len(pair_list) == 2:
+                            pairs.append((pair_list[0], pair_list[1]))
+                        else:
+                            logger.warning('%s: saml:AttributeValue should encode a pincipal arn and role arn',
+                                           value.text)
+            self._role_pairs = tuple(pairs)
+        return list(self._role_pairs)
+
+    @property
+    def role_index(self):
+        if self._role_index is None:
+            self._role_index = RoleIndex(self.role_pairs)
+        return self._role_index
+
+    def filter_role_pairs(self, account=None, name=None):
+        if not account and not name:
+            return self.role_pairs
+        return self.role_index.filter(account, name)
+
+
+def as_saml_assertion(samlvalue):
+    if isinstance(samlvalue, SamlAssertion):
+        return samlvalue
+    return parse_saml_assertion(samlvalue)
+
+
+@lru_cache(maxsize=4)
+def parse_saml_assertion(samlvalue):
+    '''
+    Return a SamlAssertion for samlvalue, reusing the one built for the same value recently
+    '''
+    return SamlAssertion(samlvalue)
+
+
 def get_deadline(samlvalue):
-    namespaces = {
-        'p': 'urn:oasis:names:tc:SAML:2.0:protocol',
-        'a': 'urn:oasis:names:tc:SAML:2.0:assertion'
-    }
-    tree = etree.fromstring(b64decode(samlvalue), etree.XMLParser(resolve_entities=False))
-    authorization = tree.xpath('/p:Response/a:Assertion/a:AuthnStatement', namespaces=namespaces)[0]
-    deadline = authorization.get('SessionNotOnOrAfter')
-    if not deadline:
-        raise ValueError('The SAML Credentials have no expiration timestamp')
-    return datetime.strptime(deadline, '%Y-%m-%dT%H:%M:%SZ')
+    return as_saml_assertion(samlvalue).deadline
 
 
 def get_longest_duration(samlvalue, now=None):
-    if not now:
-        now = datetime.utcnow()
-    deadline = get_deadline(samlvalue) - timedelta(seconds=600)
-    if now >= deadline:
-        raise ValueError('The credential is expired or will expire in the next 10 minutes')
-    return (deadline - now).seconds
+    return as_saml_assertion(samlvalue).get_longest_duration(now)
 
 
 def get_role_pairs(samlvalue):
-    namespaces = {
-        'p': 'urn:oasis:names:tc:SAML:2.0:protocol',
-        'a': 'urn:oasis:names:tc:SAML:2.0:assertion'
-    }
-    tree = etree.fromstring(b64decode(samlvalue), etree.XMLParser(resolve_entities=False))
-    stmt = tree.xpath('/p:Response/a:Assertion/a:AttributeStatement', namespaces=namespaces)[0]
-    pairs = []
-    for a in stmt.xpath('a:Attribute', namespaces=namespaces):
-        if a.get('Name') == 'https://aws.amazon.com/SAML/Attributes/Role':
-            for value in a.xpath('a:AttributeValue', namespaces=namespaces):
-                pair_list = value.text.split(',')
-                if len(pair_list) == 2:
-                    pairs.append((pair_list[0], pair_list[1]))
-                else:
-                    logger.warning('%s: saml:AttributeValue should encode a pincipal arn and role arn')
-    return pairs
-
-
-def build_filter_expr(account, name):
-    arn_expr = 'arn:aws:iam::{:s}'.format(account if account else '[^:]+')
-    if name is not None:
-        arn_expr += ':role/(nlm_aws_)?{:s}$'.format(name)
-    return arn_expr
+    return as_saml_assertion(samlvalue).role_pairs
 
 
 def filter_role_pairs(pairs, account=None, name=None):
     if not account and not name:
         logger.debug('No account or role filtering')
         return pairs
-    arn_expr = build_filter_expr(account, name)
-    logger.debug("Filtering role pairs by '%s'", arn_expr)
-    filtered_pairs = []
-    for pair in pairs:
-        role = pair[1]
-        if re.match(arn_expr, role):
-            filtered_pairs.append(pair)
-        else:
-            logger.debug('principal %s, role %s: does not match filter', pair[0], pair[1])
-    return filtered_pairs
+    return RoleIndex(pairs).filter(account, name)
 
 
 def get_filtered_role_pairs(samlvalue, account=None, name=None):
-    return filter_role_pairs(get_role_pairs(samlvalue), account, name)
+    return as_saml_assertion(samlvalue).filter_role_pairs(account, name)
 
 
 def make_creds_from_response(q):
     assert q and 'Credentials' in q
     raw = q['Credentials']
-    creds = Credentials(raw['AccessKeyId'], raw['SecretAccessKey'], raw['SessionToken'])
+    creds = Credentials(raw['AccessKeyId'], raw['SecretAccessKey'], raw['SessionToken'], raw.get('Expiration'))
     return creds
 
 
-def assume_role_with_saml(role_arn, principal_arn, samlvalue, region, duration=None):
+STS_TRANSPORTS = ('boto3', 'requests')
+
+# Limits that STS puts on DurationSeconds
+MIN_DURATION = 900
+MAX_DURATION = 43200
+DEFAULT_DURATION = 3600
+
+# Settings of a role's MaxSessionDuration to try with --duration max, longest first.
+# Every role allows DEFAULT_DURATION.
+DURATION_STEPS = (43200, 28800, 21600, 14400, 7200, 3600)
+
+
+def make_sts_client(region, transport='boto3', deadline=None, cafile=None):
     '''
-    Use the SAML assertion to assume a role.
+    Make the client used to call STS: a boto3 client, or a requests session for the Query API
     '''
+    if transport == 'requests':
+        return make_session(deadline=deadline, cafile=cafile)
+    import boto3
+    from botocore.config import Config
+
+    from .deadline import Deadline
+    from .transport import MAX_ATTEMPTS
+    connect_timeout, read_timeout = (deadline or Deadline()).timeout()
+    config = Config(connect_timeout=connect_timeout, read_timeout=read_timeout,
+                    retries={'max_attempts': MAX_ATTEMPTS, 'mode': 'standard'})
     set_default_creds()
-    client = boto3.client(service_name='sts', region_name=region)
+    kwargs = {'verify': cafile} if cafile else {}
+    return boto3.client(service_name='sts', region_name=region, config=config, **kwargs)
+
+
+def assume_role_with_saml(role_arn, principal_arn, samlvalue, region, duration=None, client=None,
+                          transport='boto3', deadline=None):
+    '''
+    Use the SAML assertion to assume a role.
+    '''
     if duration is None:
-        duration = 3600
+        duration = DEFAULT_DURATION
+    elif duration == DURATION_MAX:
+        return assume_role_with_max_duration(role_arn, principal_arn, samlvalue, region, client, transport,
+                                             deadline)
+    if client is None:
+        client = make_sts_client(region, transport, deadline)
+    if transport == 'requests':
+        from . import sts
+        creds = sts.assume_role_with_saml(role_arn, principal_arn, samlvalue, region, duration, session=client)
+    else:
+        q = client.assume_role_with_saml(RoleArn=role_arn,
+                                         PrincipalArn=principal_arn,
+                                         SAMLAssertion=samlvalue,
+                                         DurationSeconds=duration)
+        creds = make_creds_from_response(q)
+    # remember which role they are for, so that saved credentials can be checked against a request
+    return creds._replace(role_arn=role_arn)
+
+
+def is_duration_error(error):
+    '''
+    Tell whether STS rejected a request because the role does not allow its DurationSeconds
+    '''
+    if isinstance(error, STSError):
+        code, message = error.code, error.message
+    else:
+        # botocore's ClientError
+        response = getattr(error, 'response', None)
+        if not isinstance(response, dict):
+            return False
+        code = response.get('Error', {}).get('Code')
+        message = response.get('Error', {}).get('Message')
+    return code == 'ValidationError' and 'durationseconds' in (message or '').lower()
+
+
+def step_down_duration(duration):
+    for step in DURATION_STEPS:
+        if step < duration:
+            return step
+    return DEFAULT_DURATION
+
+
+def get_max_duration(role_arn, samlvalue, now=None):
+    '''
+    Return the longest duration that both the assertion and what is known of the role allow
+    '''
+    ceiling = cache.load_duration_ceiling(role_arn, now=now) or MAX_DURATION
+    duration = min(ceiling, MAX_DURATION, get_longest_duration(samlvalue, now))
+    return max(duration, MIN_DURATION)
+
+
+def assume_role_with_max_duration(role_arn, principal_arn, samlvalue, region, client=None, transport='boto3',
+                                  deadline=None):
+    '''
+    Assume the role for as long as it allows, learning its ceiling when STS refuses the duration.
 
-    q = client.assume_role_with_saml(RoleArn=role_arn,
-                                     PrincipalArn=principal_arn,
-                                     SAMLAssertion=samlvalue,
-                                     DurationSeconds=duration)
-    return make_creds_from_response(q)
+    After a refusal the role is assumed again once for the next shorter step,
+    and if STS refuses that too, for DEFAULT_DURATION, which every role allows.
+    The duration that STS accepted is remembered as the role's ceiling, so that
+    later logins ask for it straight away.
+    '''
+    if client is None:
+        client = make_sts_client(region, transport, deadline)
+    duration = get_max_duration(role_arn, samlvalue)
+    durations = [duration]
+    for shorter in (step_down_duration(duration), DEFAULT_DURATION):
+        if shorter < durations[-1]:
+            durations.append(shorter)
+    for attempt, duration in enumerate(durations):
+        try:
+            creds = assume_role_with_saml(role_arn, principal_arn, samlvalue, region, duration, client, transport)
+        except Exception as e:
+            if duration <= DEFAULT_DURATION or not is_duration_error(e):
+                raise
+            logger.info('%s does not allow sessions of %d seconds', role_arn, duration)
+            continue
+        if attempt > 0:
+            cache.save_duration_ceiling(role_arn, duration)
+        return creds
+
+
+def get_nominal_duration(duration):
+    '''
+    The lifetime to expect of credentials that came without an expiration
+    '''
+    return DEFAULT_DURATION if duration == DURATION_MAX else duration
+
+
+def assume_roles_with_saml(pairs, samlvalue, region, duration=None, max_workers=8, transport='boto3',
+                           deadline=None, client=None):
+    '''
+    Use one SAML assertion to assume every (principal, role) pair concurrently.
+
+    Returns a list in the same order as pairs, holding either the Credentials
+    or the exception raised while assuming that role.
+    '''
+    # boto3 clients are thread-safe, but creating them from the default session is not
+    if client is None:
+        client = make_sts_client(region, transport, deadline)
+
+    def assume(pair):
+        try:
+            return assume_role_with_saml(pair[1], pair[0], samlvalue, region, duration, client=client,
+                                         transport=transport)
+        except Exception as e:
+            logger.debug('role %s: %s', pair[1], e)
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pairs)))) as executor:
+        return list(executor.map(assume, pairs))
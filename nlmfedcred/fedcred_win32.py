@@ -1,9 +1,8 @@
-
-from bs4 import BeautifulSoup
 from six.moves.urllib.parse import quote_plus, urlsplit, urlunsplit
 
-import pythoncom
-import win32com.client
+from .htmlform import find_target, get_first_input_value
+
+# the pywin32 COM modules are imported when a PIV login happens
 
 # We pretend to be Chrome 79 just to make sure
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.88 Safari/537.36'
@@ -20,13 +19,6 @@ def win32_get(session, url, cert=None):
     return session.ResponseText
 
 
-def find_target(soup):
-    target_input = soup.find('input', attrs={'name': 'TARGET'})
-    if not target_input:
-        target_input = soup.find('input', attrs={'name': 'target'})
-    return target_input.get('value') if target_input else None
-
-
 def process_redirector_target(target):
     if target.startswith('-SM-'):
         target = target[4:]
@@ -59,24 +51,21 @@ def process_redirector_target(target):
 
 def get_saml_assertion_piv(subject, idp, session=None):
     if session is None:
+        import pythoncom
+        import win32com.client
         pythoncom.CoInitialize()
         session = win32com.client.Dispatch('WinHttp.WinHttpRequest.5.1')
 
     body = win32_get(session, idp.form_url)
-    soup = BeautifulSoup(body, 'lxml')
-    target = find_target(soup)
+    target = find_target(body)
 
     cert = 'CURRENT_USER\\MY\\' + subject
     piv_url = idp.piv_url + '?TARGET=' + target
     body = win32_get(session, piv_url, cert=cert)
-    soup = BeautifulSoup(body, 'lxml')
-    target = find_target(soup)
+    target = find_target(body)
 
     url = process_redirector_target(target)
     body = win32_get(session, url)
-    soup = BeautifulSoup(body, 'lxml')
-    samlinput = soup.find('input')
-
-    assert samlinput
-    samlvalue = samlinput.attrs['value']
+    samlvalue = get_first_input_value(body)
+    assert samlvalue is not None
     return samlvalue
@@ -0,0 +1,156 @@
+"""
+Read the few <input> values the login flow needs from an IdP page.
+
+The IdP pages are only ever searched for a handful of <input> attributes, so
+instead of building a whole document tree these parsers watch the tag events
+from html.parser and stop as soon as they have what they came for.
+"""
+from html.parser import HTMLParser
+
+__all__ = (
+    'get_form_inputs',
+    'get_first_input_value',
+    'find_target',
+    'find_input_value',
+)
+
+
+class StopParsing(Exception):
+    pass
+
+
+class InputParser(HTMLParser):
+    '''
+    Calls handle_input for each <input> tag, noting whether it is inside a <form>
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms_seen = 0
+        self.in_form = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'form':
+            self.forms_seen += 1
+            self.in_form = True
+            self.handle_form_start()
+        elif tag == 'input':
+            self.handle_input(dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'form' and self.in_form:
+            self.in_form = False
+            self.handle_form_end()
+
+    def handle_form_start(self):
+        pass
+
+    def handle_form_end(self):
+        pass
+
+    def handle_input(self, attrs):
+        pass
+
+    def parse(self, html):
+        if isinstance(html, bytes):
+            html = html.decode('utf-8', errors='replace')
+        try:
+            self.feed(html)
+            self.close()
+        except StopParsing:
+            pass
+        return self
+
+
+class FormInputsParser(InputParser):
+    def __init__(self):
+        super().__init__()
+        self.inputs = {}
+
+    def handle_form_start(self):
+        if self.forms_seen > 1:
+            raise StopParsing()
+
+    def handle_form_end(self):
+        raise StopParsing()
+
+    def handle_input(self, attrs):
+        # a bare attribute such as <input name="x" value> has the value None
+        if self.in_form and 'name' in attrs and 'value' in attrs:
+            self.inputs[attrs['name'] or ''] = attrs['value'] or ''
+
+
+class FirstInputParser(InputParser):
+    def __init__(self):
+        super().__init__()
+        self.attrs = None
+
+    def handle_input(self, attrs):
+        self.attrs = attrs
+        raise StopParsing()
+
+
+class NamedInputParser(InputParser):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.value = None
+
+    def handle_input(self, attrs):
+        if attrs.get('name') == self.name:
+            self.value = attrs.get('value') or ''
+            raise StopParsing()
+
+
+class TargetParser(InputParser):
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def handle_input(self, attrs):
+        name = attrs.get('name')
+        if name in ('TARGET', 'target') and name not in self.values:
+            self.values[name] = attrs.get('value') or ''
+            if name == 'TARGET':
+                raise StopParsing()
+
+
+def get_form_inputs(html):
+    '''
+    Return the name and value of every <input> in the first <form> that has both
+    '''
+    parser = FormInputsParser().parse(html)
+    if parser.forms_seen == 0:
+        raise ValueError('The page has no form')
+    return parser.inputs
+
+
+def get_first_input_value(html):
+    '''
+    Return the value of the first <input> on the page, which on the IdP's
+    auto-post page is the SAMLResponse, or None if there is no input
+    '''
+    attrs = FirstInputParser().parse(html).attrs
+    if attrs is None or 'value' not in attrs:
+        return None
+    return attrs['value'] or ''
+
+
+def find_target(html):
+    '''
+    Return the value of the input named TARGET, or else of one named target
+    '''
+    values = TargetParser().parse(html).values
+    if 'TARGET' in values:
+        return values['TARGET']
+    return values.get('target')
+
+
+def find_input_value(html, name):
+    '''
+    Return the value of the first input with this name, or None if there is none
+    '''
+    return NamedInputParser(name).parse(html).value
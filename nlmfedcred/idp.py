@@ -27,3 +27,14 @@ def make_idp(fqdn):
         query = FORM_URL_QUERY
     form_url = urlunsplit(['https', fqdn, path, query, ''])
     return IDP(form_url, LOGIN_URL_FORMAT % fqdn, PIV_URL_FORMAT % fqdn)
+
+
+def split_idps(value):
+    '''
+    Split a comma-separated list of IdP endpoints, such as "auth1.nih.gov, auth2.nih.gov"
+    '''
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def get_fqdn(idp):
+    return urlsplit(idp.form_url).netloc
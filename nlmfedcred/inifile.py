@@ -0,0 +1,136 @@
+"""
+Edit sections of an INI file such as ~/.aws/credentials in place.
+
+ConfigParser rewrites the whole file from its parsed form, which drops every
+comment and costs time in proportion to the number of profiles. The editor
+here scans the text once, noting where each section's lines start and end,
+and splices new key lines into only the sections being updated. Everything
+else, including comments, blank lines and the order of sections, is copied
+through unchanged.
+"""
+import re
+from collections import OrderedDict, namedtuple
+
+__all__ = (
+    'find_sections',
+    'update_sections',
+)
+
+SECTION_RE = re.compile(r'\s*\[([^\]]+)\]')
+KEY_RE = re.compile(r'([^=:\s][^=:]*?)\s*[=:]')
+
+# A section's lines run from its header to the line before the next header.
+# body_end stops after the last key line, so that comments and blank lines
+# leading up to the next header stay with that header.
+Section = namedtuple('Section', ('name', 'start', 'body_end', 'end'))
+
+
+def is_comment_or_blank(line):
+    stripped = line.strip()
+    return not stripped or stripped[0] in '#;'
+
+
+def find_sections(lines):
+    '''
+    Return a Section of line numbers for each section header in lines
+    '''
+    sections = []
+    name = None
+    start = body_end = 0
+    for i, line in enumerate(lines):
+        match = SECTION_RE.match(line)
+        if match:
+            if name is not None:
+                sections.append(Section(name, start, body_end, i))
+            name = match.group(1).strip()
+            start = i
+            body_end = i + 1
+        elif name is not None and not is_comment_or_blank(line):
+            body_end = i + 1
+    if name is not None:
+        sections.append(Section(name, start, body_end, len(lines)))
+    return sections
+
+
+def parse_key(line):
+    if line[:1].isspace() or is_comment_or_blank(line):
+        return None
+    match = KEY_RE.match(line)
+    if not match:
+        return None
+    # ConfigParser folds keys to lower case
+    return match.group(1).strip().lower()
+
+
+def format_item(key, value):
+    return '%s = %s\n' % (key, value)
+
+
+def edit_section(lines, items, replace):
+    '''
+    Rewrite the body lines of one section, keeping its comments
+    '''
+    pending = OrderedDict((key.lower(), (key, value)) for key, value in items)
+    result = []
+    skipping = False
+    last_key_line = 0
+    for line in lines:
+        key = parse_key(line)
+        if key is None:
+            # continuation lines belong to the key above them
+            if skipping and line[:1].isspace() and line.strip():
+                continue
+            result.append(line)
+            continue
+        skipping = False
+        if key in pending:
+            # the new value replaces the old one's continuation lines too
+            result.append(format_item(*pending.pop(key)))
+            skipping = True
+        elif replace:
+            skipping = True
+            continue
+        else:
+            result.append(line)
+        last_key_line = len(result)
+    result[last_key_line:last_key_line] = [format_item(k, v) for k, v in pending.values()]
+    return result
+
+
+def update_sections(text, updates, replace=True):
+    '''
+    Return text with each section in updates set to its (key, value) items.
+
+    updates maps section names to lists of items, and sections that do not yet
+    exist are appended in the order given. With replace, keys that are not in
+    the items are removed from the section, as if it had been written anew;
+    otherwise they are kept.
+    '''
+    lines = text.splitlines(True)
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+
+    result = []
+    pos = 0
+    seen = set()
+    for section in find_sections(lines):
+        if section.name not in updates:
+            continue
+        result.extend(lines[pos:section.start])
+        if section.name not in seen:
+            seen.add(section.name)
+            result.append(lines[section.start])
+            result.extend(edit_section(lines[section.start + 1:section.body_end],
+                                       updates[section.name], replace))
+        # else a duplicate header, which ConfigParser would reject, is dropped
+        pos = section.body_end
+    result.extend(lines[pos:])
+
+    for name, items in updates.items():
+        if name in seen:
+            continue
+        if result and result[-1].strip():
+            result.append('\n')
+        result.append('[%s]\n' % name)
+        result.extend(format_item(k, v) for k, v in items)
+    return ''.join(result)
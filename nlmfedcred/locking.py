@@ -0,0 +1,115 @@
+"""
+Safe updates to files that several getawscreds processes may write at once.
+
+A read-modify-write of ~/.aws/credentials holds an advisory lock on a
+companion ".lock" file, so concurrent runs take turns instead of losing each
+other's profiles, and the new contents replace the old with an atomic rename,
+so readers see either the old file or the new one and never a partial write.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from .exceptions import LockTimeout
+
+__all__ = (
+    'FileLock',
+    'atomic_write',
+)
+
+# How long to wait for another process to finish with a file
+LOCK_TIMEOUT = 30
+LOCK_POLL_INTERVAL = 0.05
+
+if sys.platform == 'win32':
+    import msvcrt
+
+    def try_lock(fd):
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def unlock(fd):
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def try_lock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (BlockingIOError, PermissionError):
+            return False
+        return True
+
+    def unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock(object):
+    '''
+    Exclusive advisory lock for updating path, held with a "with" block.
+
+    Raises LockTimeout if another process holds the lock for longer than timeout seconds.
+    '''
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = path + '.lock'
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = time.monotonic() + self.timeout
+        while not try_lock(fd):
+            if time.monotonic() >= deadline:
+                os.close(fd)
+                raise LockTimeout('Timed out after %d seconds waiting for %s' % (self.timeout, self.path))
+            time.sleep(LOCK_POLL_INTERVAL)
+        self.fd = fd
+
+    def release(self):
+        # the lock file is left in place: removing it would let a waiter lock a file that is gone
+        unlock(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def atomic_write(path, data, new_mode=0o600, keep_mode=True, replace=True):
+    '''
+    Replace path with data, text or bytes, keeping its permissions, so that it is never seen half written.
+
+    A file that does not exist yet, or any file when keep_mode is false, gets new_mode.
+    Without replace, an existing file is kept and FileExistsError raised, so that
+    concurrent writers agree on whichever file was written first.
+    '''
+    dirname = os.path.dirname(os.path.abspath(path))
+    mode = new_mode
+    if keep_mode:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            pass
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(tmppath, mode)
+        if replace:
+            os.replace(tmppath, path)
+        else:
+            os.link(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
@@ -0,0 +1,112 @@
+"""
+Do the network work of a password login while the user is typing the password.
+
+Fetching the login form, with its TLS handshake, and setting up the STS client
+do not depend on the password, so they run on background threads that start
+just before the prompt. By the time the password is entered, the login can
+POST it straight away on the session that fetched the form, and the STS client
+is ready.
+"""
+import logging
+import threading
+import time
+
+from . import failover, fedcred
+from .idp import get_fqdn
+
+__all__ = (
+    'LoginPrefetch',
+)
+
+logger = logging.getLogger(__name__)
+
+# Hidden inputs fetched longer ago than this are not trusted to still be accepted
+MAX_FORM_AGE = 300
+
+
+class LoginPrefetch(object):
+    '''
+    Fetches the login form and makes the STS client, each on its own background thread,
+    so that the login waits only for the form and never for boto3 to load.
+
+    Either result is None when its work failed, so that the login does it again in the usual way.
+    '''
+
+    def __init__(self, idp, region, transport='boto3', idps=None, deadline=None, clock=time.monotonic):
+        self.idp = idp
+        self.idps = idps if idps else [idp]
+        self.region = region
+        self.transport = transport
+        self.deadline = deadline
+        self.clock = clock
+        self.fetched = None
+        self.form_result = None
+        self.client = None
+        self.form_thread = threading.Thread(target=self.run_form)
+        self.sts_thread = threading.Thread(target=self.run_sts)
+        # the prompt may be abandoned, and must not wait for the network
+        self.form_thread.daemon = True
+        self.sts_thread.daemon = True
+
+    def start(self):
+        self.form_thread.start()
+        self.sts_thread.start()
+        return self
+
+    def run_form(self):
+        try:
+            self.form_result = self.fetch_form()
+            self.fetched = self.clock()
+        except Exception as e:
+            logger.debug('Fetching the login form ahead of the password failed: %s', e)
+
+    def run_sts(self):
+        try:
+            self.client = fedcred.make_sts_client(self.region, self.transport, self.deadline)
+        except Exception as e:
+            logger.debug('Making the STS client ahead of the password failed: %s', e)
+
+    def fetch_form(self):
+        def make_session():
+            return fedcred.make_session(deadline=self.deadline)
+
+        if len(self.idps) > 1:
+            endpoint, session, r = failover.race_login_form(self.idps, make_session)
+        else:
+            endpoint = self.idps[0]
+            session = make_session()
+            r = session.get(endpoint.form_url)
+        logger.debug('Fetched the login form of %s', get_fqdn(endpoint))
+        return endpoint, session, fedcred.parse_hidden_inputs(endpoint, r)
+
+    def form(self, deadline=None):
+        '''
+        Return the (idp, session, form_data) of the fetched login form, or None if it is not usable.
+        The session's deadline is replaced by deadline, since the prompt took some of the old one.
+        '''
+        self.form_thread.join()
+        if self.form_result is None or self.clock() - self.fetched > MAX_FORM_AGE:
+            return None
+        endpoint, session, form_data = self.form_result
+        if deadline is not None:
+            session.deadline = deadline
+        return endpoint, session, form_data
+
+    def sts_client(self, deadline=None):
+        '''
+        Return the STS client, bounded by deadline rather than by the deadline before the prompt
+        '''
+        self.sts_thread.join()
+        if self.client is None or deadline is None or deadline.remaining() is None:
+            # without a deadline the client made ahead has the usual timeouts, which still apply
+            return self.client
+        if self.transport == 'requests':
+            self.client.deadline = deadline
+            return self.client
+        # boto3 fixes a client's timeouts when it is made, so make it again now. The client made
+        # ahead has already imported boto3 and loaded the STS model, which makes this one quick.
+        try:
+            return fedcred.make_sts_client(self.region, self.transport, deadline)
+        except Exception as e:
+            logger.debug('Making the STS client for the deadline failed: %s', e)
+            return self.client
@@ -0,0 +1,187 @@
+"""
+Select roles from the role pairs of a SAML assertion.
+
+A RoleIndex parses each role ARN once and indexes the roles by account, so a
+selection only looks at the accounts it names. Selections are comma-separated
+lists, and an item starting with "!" excludes what it matches. An account item
+is an exact account number or a glob such as "2*". A role name item is a
+regular expression, as it has always been, or a glob when it starts with
+"glob:", such as "glob:nlm_aws_*". The "nlm_aws_" prefix of role names is
+optional. Commas inside brackets, braces or parentheses, as in "x{1,3}", do
+not separate items.
+"""
+import fnmatch
+import logging
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+__all__ = (
+    'RoleArn',
+    'RoleIndex',
+    'parse_role_arn',
+)
+
+logger = logging.getLogger(__name__)
+
+GLOB_CHARS = '*?['
+GLOB_PREFIX = 'glob:'
+ROLE_PREFIX = 'nlm_aws_'
+OPENING = '([{'
+CLOSING = ')]}'
+
+# path is everything between "role/" and the name, such as "" or "/service-role/"
+RoleArn = namedtuple('RoleArn', ('account', 'path', 'name'))
+
+# exact is a frozenset of values, or None when the filter uses patterns
+Filter = namedtuple('Filter', ('exact', 'include', 'exclude'))
+
+
+def parse_role_arn(arn):
+    '''
+    Split arn:aws:iam::ACCOUNT:role/PATH/NAME into a RoleArn, or return None if it is not a role ARN
+    '''
+    parts = arn.split(':', 5)
+    if len(parts) != 6 or not parts[5].startswith('role/'):
+        return None
+    path, _, name = parts[5][4:].rpartition('/')
+    return RoleArn(parts[4], path + '/', name)
+
+
+def split_list(spec):
+    '''
+    Split spec at the commas that are not inside brackets, braces or parentheses
+    '''
+    items = []
+    depth = 0
+    start = 0
+    escaped = False
+    for i, c in enumerate(spec):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in OPENING:
+            depth += 1
+        elif c in CLOSING:
+            depth = max(0, depth - 1)
+        elif c == ',' and depth == 0:
+            items.append(spec[start:i])
+            start = i + 1
+    items.append(spec[start:])
+    return items
+
+
+def split_items(spec):
+    if spec is None:
+        return ()
+    if isinstance(spec, str):
+        spec = split_list(spec)
+    return tuple(item.strip() for item in spec if item and item.strip())
+
+
+def is_glob(item):
+    return any(c in item for c in GLOB_CHARS)
+
+
+@lru_cache(maxsize=256)
+def compile_account_filter(items):
+    include = []
+    exclude = []
+    exact = set()
+    for item in items:
+        negate = item.startswith('!')
+        if negate:
+            item = item[1:]
+        pattern = re.compile(fnmatch.translate(item) if is_glob(item) else re.escape(item))
+        (exclude if negate else include).append(pattern)
+        if not negate and not is_glob(item):
+            exact.add(item)
+    if not include or len(exact) != len(include):
+        exact = None
+    return Filter(frozenset(exact) if exact is not None else None, tuple(include), tuple(exclude))
+
+
+@lru_cache(maxsize=256)
+def compile_name_filter(items):
+    include = []
+    exclude = []
+    for item in items:
+        negate = item.startswith('!')
+        if negate:
+            item = item[1:]
+        if item.startswith(GLOB_PREFIX):
+            expr = fnmatch.translate(item[len(GLOB_PREFIX):])
+        else:
+            expr = '(?:%s)' % item
+        pattern = re.compile('(?:%s)?%s' % (ROLE_PREFIX, expr))
+        (exclude if negate else include).append(pattern)
+    return Filter(None, tuple(include), tuple(exclude))
+
+
+def matches(patterns, *values):
+    return any(p.fullmatch(value) for p in patterns for value in values)
+
+
+def filter_allows(compiled, *values):
+    if compiled.include and not matches(compiled.include, *values):
+        return False
+    return not matches(compiled.exclude, *values)
+
+
+class RoleIndex(object):
+    '''
+    The role pairs of an assertion, parsed once and indexed by account
+    '''
+
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+        self.roles = []
+        self.by_account = {}
+        for i, pair in enumerate(self.pairs):
+            role = parse_role_arn(pair[1])
+            if role is None:
+                logger.warning('%s: not a role ARN', pair[1])
+            else:
+                self.by_account.setdefault(role.account, []).append(i)
+            self.roles.append(role)
+
+    def accounts(self):
+        return sorted(self.by_account)
+
+    def select_accounts(self, account):
+        '''
+        Return the positions of the roles in the selected accounts, in order
+        '''
+        items = split_items(account)
+        if not items:
+            return range(len(self.pairs))
+        compiled = compile_account_filter(items)
+        if compiled.exact is not None:
+            candidates = [a for a in compiled.exact if a in self.by_account]
+        else:
+            candidates = self.by_account
+        positions = []
+        for a in candidates:
+            if filter_allows(compiled, a):
+                positions.extend(self.by_account[a])
+        return sorted(positions)
+
+    def name_allowed(self, compiled, role):
+        if role is None:
+            return False
+        # a name may be matched by itself or together with the role's path
+        return filter_allows(compiled, role.name, role.path[1:] + role.name)
+
+    def filter(self, account=None, name=None):
+        '''
+        Return the pairs whose roles are in the selected accounts and have the selected names
+        '''
+        positions = self.select_accounts(account)
+        items = split_items(name)
+        if items:
+            compiled = compile_name_filter(items)
+            positions = [i for i in positions if self.name_allowed(compiled, self.roles[i])]
+        result = [self.pairs[i] for i in positions]
+        logger.debug('Selected %d of %d roles by account %s and name %s', len(result), len(self.pairs), account, name)
+        return result
@@ -0,0 +1,183 @@
+"""
+Serve credentials over the ECS container credentials protocol.
+
+Processes that set AWS_CONTAINER_CREDENTIALS_FULL_URI and
+AWS_CONTAINER_AUTHORIZATION_TOKEN fetch their credentials with one local HTTP
+GET. The credentials are held in memory and renewed through the profile's
+refresher when they come close to expiring.
+"""
+import hmac
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from . import credstore, fedcred
+from .exceptions import LoginRequired
+
+__all__ = (
+    'CredentialProvider',
+    'make_server',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LISTEN = '127.0.0.1:9911'
+
+# botocore starts refreshing container credentials 15 minutes before they
+# expire, so hand out credentials that have comfortably longer than that left.
+REFRESH_MARGIN = 20 * 60
+
+
+class CredentialProvider(object):
+    '''
+    Holds the credentials of each profile in memory and renews them on demand.
+
+    Requests for the same profile that arrive while it is being renewed wait
+    for that renewal rather than starting their own.
+    '''
+
+    def __init__(self, refreshers, margin=REFRESH_MARGIN):
+        self.refreshers = dict((r.profile, r) for r in refreshers)
+        self.margin = margin
+        self.creds = {}
+        self.locks = dict((profile, threading.Lock()) for profile in self.refreshers)
+
+    def __contains__(self, profile):
+        return profile in self.refreshers
+
+    def get_fresh(self, profile, now):
+        entry = self.creds.get(profile)
+        if entry is not None and now < entry[1] - timedelta(seconds=self.margin):
+            return entry[0]
+        return None
+
+    def get(self, profile, now=None):
+        if profile not in self.refreshers:
+            raise KeyError(profile)
+        if now is None:
+            now = datetime.utcnow()
+        creds = self.get_fresh(profile, now)
+        if creds is not None:
+            return creds
+        with self.locks[profile]:
+            # another request may have renewed them while we waited
+            creds = self.get_fresh(profile, now)
+            if creds is not None:
+                return creds
+            refresher = self.refreshers[profile]
+            creds = refresher.assume()
+            if creds.expiration is not None:
+                expiration = credstore.to_utc(creds.expiration)
+            else:
+                expiration = datetime.utcnow() + timedelta(seconds=fedcred.get_nominal_duration(refresher.config.duration))
+            self.creds[profile] = (creds, expiration)
+            return creds
+
+
+class CredentialsHandler(BaseHTTPRequestHandler):
+    '''
+    Answers GET / with the default profile and GET /<profile> with a named one
+    '''
+
+    def address_string(self):
+        # Unix domain sockets have no client address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+    def send_json(self, status, document):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        token = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            self.send_json(401, {'Code': 'AccessDenied', 'Message': 'Invalid authorization token'})
+            return
+        profile = self.path.split('?', 1)[0].strip('/') or self.server.default_profile
+        if profile not in self.server.provider:
+            self.send_json(404, {'Code': 'NotFound', 'Message': 'No such profile: %s' % profile})
+            return
+        try:
+            creds = self.server.provider.get(profile)
+        except LoginRequired as e:
+            self.send_json(503, {'Code': 'LoginRequired', 'Message': str(e)})
+            return
+        except Exception as e:
+            logger.exception('profile %s: unable to refresh credentials', profile)
+            self.send_json(500, {'Code': 'RefreshFailed', 'Message': str(e)})
+            return
+        document = {
+            'AccessKeyId': creds.access_key,
+            'SecretAccessKey': creds.secret_key,
+            'Token': creds.session_token,
+        }
+        if creds.expiration is not None:
+            document['Expiration'] = credstore.format_expiration(creds.expiration)
+        self.send_json(200, document)
+
+
+class ThreadingCredentialsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    '''
+    Remove a socket left behind by a server that is no longer running
+    '''
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return
+    except OSError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        logger.info('Removing stale socket %s', path)
+        os.unlink(path)
+    finally:
+        probe.close()
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class ThreadingUnixCredentialsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            remove_stale_socket(self.server_address)
+            socketserver.UnixStreamServer.server_bind(self)
+            # only the user may connect and be handed credentials
+            os.chmod(self.server_address, 0o600)
+else:
+    ThreadingUnixCredentialsServer = None
+
+
+def make_server(listen, provider, token, default_profile):
+    '''
+    Listen on "host:port", or on a Unix domain socket given as "unix:PATH"
+    '''
+    if listen.startswith('unix:'):
+        if ThreadingUnixCredentialsServer is None:
+            raise ValueError('Unix domain sockets are not supported on this platform')
+        server = ThreadingUnixCredentialsServer(listen[5:], CredentialsHandler)
+    else:
+        host, _, port = listen.rpartition(':')
+        server = ThreadingCredentialsServer((host or '127.0.0.1', int(port)), CredentialsHandler)
+    server.provider = provider
+    server.token = token
+    server.default_profile = default_profile
+    return server
@@ -0,0 +1,148 @@
+"""
+Let one of many concurrent getawscreds processes do a login for all of them.
+
+The first process to create the lock file for a key does the network work and
+publishes the result, for example to the credentials store; the others wait
+for the lock and read what it published. The lock file holds the host name
+and PID of its owner, so that a lock left behind by a process that died can
+be recognized and taken over.
+"""
+import logging
+import os
+import socket
+import sys
+import time
+
+from .exceptions import LockTimeout, SharedLoginFailed
+
+__all__ = (
+    'SingleFlight',
+)
+
+logger = logging.getLogger(__name__)
+
+# Long enough for the process doing the work to be prompted for a password
+FLIGHT_TIMEOUT = 120
+FLIGHT_POLL_INTERVAL = 0.1
+
+
+if sys.platform == 'win32':
+    def pid_alive(pid):
+        # os.kill(pid, 0) would terminate the process on Windows
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return True
+            return code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+else:
+    def pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+
+class SingleFlight(object):
+    '''
+    A lock file that decides which process does the work for a key
+    '''
+
+    def __init__(self, path, timeout=FLIGHT_TIMEOUT, poll=FLIGHT_POLL_INTERVAL):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self.owner = '%s %d' % (socket.gethostname(), os.getpid())
+
+    def try_acquire(self):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        return True
+
+    def read_owner(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def is_stale(self, owner):
+        '''
+        Whether the lock belongs to a process on this host that no longer runs
+        '''
+        host, _, pid = owner.rpartition(' ')
+        if host != socket.gethostname() or not pid.isdigit():
+            # another host's processes, or a lock still being written, cannot be checked
+            return False
+        return not pid_alive(int(pid))
+
+    def break_stale(self, owner):
+        # Move the lock aside first, so that only one waiter can take it over
+        aside = '%s.%d' % (self.path, os.getpid())
+        try:
+            os.rename(self.path, aside)
+        except FileNotFoundError:
+            return
+        try:
+            with open(aside) as f:
+                if f.read() != owner:
+                    # a new owner took the lock in the meantime, so give it back
+                    os.link(aside, self.path)
+                else:
+                    logger.info('Removed the lock of a process that is gone: %s', owner)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(aside)
+
+    def join(self, published):
+        '''
+        Return the result that published() finds, waiting for another process
+        that is producing it, or return None once this process holds the lock
+        and has to do the work itself, after which it must call release().
+
+        Raises LockTimeout if the other process takes too long, and
+        SharedLoginFailed if it finishes without publishing anything.
+        '''
+        deadline = time.monotonic() + self.timeout
+        waited_for = None
+        while True:
+            result = published()
+            if result is not None:
+                return result
+            if self.try_acquire():
+                if waited_for is None:
+                    return None
+                # the other process finished without a result; repeating its login could lock the account
+                self.release()
+                raise SharedLoginFailed('Another getawscreds doing the same login failed (%s)' % waited_for)
+            owner = self.read_owner()
+            if owner is None:
+                continue
+            if self.is_stale(owner):
+                self.break_stale(owner)
+                waited_for = None
+                continue
+            waited_for = owner
+            if time.monotonic() >= deadline:
+                raise LockTimeout('Timed out after %d seconds waiting for the login by %s' % (self.timeout, owner))
+            time.sleep(self.poll)
+
+    def release(self):
+        if self.read_owner() == self.owner:
+            os.remove(self.path)
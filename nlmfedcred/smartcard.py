@@ -6,12 +6,8 @@ from datetime import datetime
 from getpass import getpass
 from pathlib import Path
 
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
-from cryptography.x509.oid import NameOID
-from PyKCS11 import (CKA_CLASS, CKA_ID, CKA_VALUE, CKF_RW_SESSION,
-                     CKF_SERIAL_SESSION, CKO_CERTIFICATE, PyKCS11Lib)
+# cryptography and PyKCS11 are imported by the commands that use them,
+# so that "smartcard -h" and argument errors start quickly.
 
 
 def find_pkcs11_library(raw_path=None):
@@ -32,6 +28,11 @@ def find_pkcs11_library(raw_path=None):
 
 
 def read_certs(pin, path):
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from PyKCS11 import (CKA_CLASS, CKA_ID, CKA_VALUE, CKF_RW_SESSION,
+                         CKF_SERIAL_SESSION, CKO_CERTIFICATE, PyKCS11Lib)
+
     pkcs11 = PyKCS11Lib()
     pkcs11.load(path)
     slot = pkcs11.getSlotList(tokenPresent=False)[0]
@@ -52,6 +53,7 @@ def read_certs(pin, path):
 
 
 def read_certs_command(opts):
+    from cryptography.x509.oid import NameOID
     path = find_pkcs11_library(opts.lib)
     pin = getpass('Enter PIN: ')
     certs = read_certs(pin, path)
@@ -85,6 +87,8 @@ def get_public_key(pin, path, cert_num):
 
 
 def export_pubkey_command(opts):
+    from cryptography.hazmat.primitives.serialization import (Encoding,
+                                                              PublicFormat)
     pin = getpass('Enter PIN: ')
     pubkey = get_public_key(pin, find_pkcs11_library(opts.lib), opts.cert)
     format = opts.format
@@ -105,6 +109,7 @@ def export_pubkey_command(opts):
 
 
 def setup_command(opts):
+    from cryptography.x509.oid import NameOID
     if sys.platform != 'win32':
         print('PIV login is only supported on Windows', file=sys.stderr)
         return 0
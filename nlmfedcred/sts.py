@@ -0,0 +1,80 @@
+"""
+Call AssumeRoleWithSAML through the STS Query API without boto3.
+
+STS accepts AssumeRoleWithSAML unsigned, so a single form POST over requests
+does the same job as a boto3 client without loading botocore or its models.
+"""
+from datetime import datetime
+
+from .exceptions import STSError
+from .fedcred import Credentials
+
+__all__ = (
+    'get_sts_url',
+    'assume_role_with_saml',
+)
+
+STS_API_VERSION = '2011-06-15'
+STS_NAMESPACES = {'sts': 'https://sts.amazonaws.com/doc/2011-06-15/'}
+
+
+def get_sts_url(region):
+    if region.startswith('cn-'):
+        return 'https://sts.%s.amazonaws.com.cn/' % region
+    return 'https://sts.%s.amazonaws.com/' % region
+
+
+def parse_timestamp(value):
+    # STS sends timestamps such as 2019-11-09T13:34:41Z, sometimes with fractional seconds
+    value = value.strip().rstrip('Z').split('.')[0]
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_response(content):
+    from lxml import etree
+    tree = etree.fromstring(content, etree.XMLParser(resolve_entities=False))
+    raw = tree.find('.//sts:Credentials', namespaces=STS_NAMESPACES)
+    if raw is None:
+        raise STSError('MalformedResponse', 'AssumeRoleWithSAML response has no Credentials')
+
+    def text(name):
+        return raw.findtext('sts:' + name, namespaces=STS_NAMESPACES)
+
+    return Credentials(text('AccessKeyId'), text('SecretAccessKey'), text('SessionToken'),
+                       parse_timestamp(text('Expiration')))
+
+
+def parse_error(status_code, content):
+    from lxml import etree
+    try:
+        tree = etree.fromstring(content, etree.XMLParser(resolve_entities=False))
+    except etree.XMLSyntaxError:
+        return STSError('HTTP%d' % status_code, 'STS returned an unexpected response')
+    error = tree.find('.//{*}Error')
+    if error is None:
+        return STSError('HTTP%d' % status_code, 'STS returned an unexpected response')
+    return STSError(error.findtext('{*}Code'), error.findtext('{*}Message'))
+
+
+def assume_role_with_saml(role_arn, principal_arn, samlvalue, region, duration=3600, session=None):
+    '''
+    Use the SAML assertion to assume a role, returning Credentials that include the expiration
+    '''
+    if session is None:
+        from .transport import make_session
+        session = make_session()
+    if isinstance(samlvalue, bytes):
+        samlvalue = samlvalue.decode('ascii')
+    data = {
+        'Action': 'AssumeRoleWithSAML',
+        'Version': STS_API_VERSION,
+        'RoleArn': role_arn,
+        'PrincipalArn': principal_arn,
+        'SAMLAssertion': samlvalue,
+        'DurationSeconds': str(duration),
+    }
+    # the same assertion may be presented again, so a failed call can simply be tried again
+    r = session.post(get_sts_url(region), data=data, idempotent=True)
+    if not r.ok:
+        raise parse_error(r.status_code, r.content)
+    return parse_response(r.content)
@@ -28,3 +28,31 @@ def samldata_sysop():
     samlout_path = os.path.join(DATA_DIR, 'samlout-sysop.b64')
     with open(samlout_path, 'rb') as f:
         return f.read()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    # Never read or write the real user's cache while testing
+    path = tmpdir.join('cache')
+    monkeypatch.setenv('GETAWSCREDS_CACHE_DIR', str(path))
+    return path
+
+
+def read_page(name):
+    with open(os.path.join(DATA_DIR, name), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def login_page():
+    return read_page('idp-login-form.html')
+
+
+@pytest.fixture(scope='module')
+def saml_post_page():
+    return read_page('idp-saml-post.html')
+
+
+@pytest.fixture(scope='module')
+def piv_redirect_page():
+    return read_page('idp-piv-redirect.html')
@@ -0,0 +1,94 @@
+"""
+Test the user-private, encrypted on-disk caches
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+from nlmfedcred import cache
+
+
+def test_cache_dir_created(cache_dir):
+    path = cache.get_cache_dir()
+    assert path == str(cache_dir)
+    assert os.path.isdir(path)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='POSIX permissions only')
+def test_private_file_permissions(cache_dir):
+    path = os.path.join(cache.get_cache_dir(), 'secret')
+    cache.write_private_file(path, b'hello')
+    assert cache.read_private_file(path) == b'hello'
+    assert os.stat(path).st_mode & 0o077 == 0
+
+
+def test_encrypted_at_rest(cache_dir):
+    path = cache.get_cache_path('test', 'a', 'b')
+    cache.save_encrypted(path, {'value': 'plaintext-marker'})
+    assert b'plaintext-marker' not in cache.read_private_file(path)
+    assert cache.load_encrypted(path) == {'value': 'plaintext-marker'}
+
+
+def test_key_is_stable(cache_dir):
+    assert cache.get_cache_key() == cache.get_cache_key()
+
+
+def test_corrupt_entry_is_a_miss(cache_dir):
+    path = cache.get_cache_path('test', 'corrupt')
+    cache.write_private_file(path, b'not a fernet token')
+    assert cache.load_encrypted(path) is None
+
+
+def test_saml_round_trip(cache_dir, samldata):
+    now = datetime(2017, 9, 29, 10, 0, 0)
+    deadline = now + timedelta(hours=4)
+    cache.save_saml_assertion('authtest.nih.gov', 'markfu', samldata, deadline)
+    assert cache.load_saml_assertion('authtest.nih.gov', 'markfu', now=now) == samldata.decode('ascii')
+    assert cache.load_saml_assertion('authtest.nih.gov', 'other', now=now) is None
+    assert cache.load_saml_assertion('auth.nih.gov', 'markfu', now=now) is None
+
+
+def test_saml_expires_with_margin(cache_dir, samldata):
+    now = datetime(2017, 9, 29, 10, 0, 0)
+    deadline = now + timedelta(seconds=cache.SAML_SAFETY_MARGIN)
+    cache.save_saml_assertion('authtest.nih.gov', 'markfu', samldata, deadline)
+    assert cache.load_saml_assertion('authtest.nih.gov', 'markfu', now=now) is None
+    assert cache.load_saml_assertion('authtest.nih.gov', 'markfu', margin=0, now=now) is not None
+
+
+def test_cookies_round_trip(cache_dir):
+    from requests.cookies import RequestsCookieJar
+    jar = RequestsCookieJar()
+    jar.set('SMSESSION', 'session-marker', domain='authtest.nih.gov', path='/')
+    jar.set('OLD', 'gone', domain='authtest.nih.gov', path='/', expires=1)
+    cache.save_cookies('authtest.nih.gov', 'user', jar)
+
+    cookies = cache.load_cookies('authtest.nih.gov', 'user')
+    assert [c['name'] for c in cookies] == ['SMSESSION']
+    assert cookies[0]['value'] == 'session-marker'
+    assert cache.load_cookies('authtest.nih.gov', 'other') == []
+    assert b'session-marker' not in cache.read_private_file(cache.get_cache_path('cookies', 'authtest.nih.gov', 'user'))
+
+    cache.clear_cookies('authtest.nih.gov', 'user')
+    assert cache.load_cookies('authtest.nih.gov', 'user') == []
+    cache.clear_cookies('authtest.nih.gov', 'user')
+
+
+def test_role_catalog_round_trip(cache_dir):
+    pairs = [('arn:aws:iam::1:saml-provider/x', 'arn:aws:iam::1:role/a')]
+    saved = datetime(2030, 1, 2, 3, 4, 5)
+    assert cache.load_role_catalog('idp.example.com', 'someone') is None
+    cache.save_role_catalog('idp.example.com', 'someone', pairs, now=saved)
+    assert cache.load_role_catalog('idp.example.com', 'someone') == (saved, pairs)
+    assert cache.load_role_catalog('idp.example.com', 'other') is None
+
+
+def test_form_template_expires(cache_dir):
+    saved = datetime(2030, 1, 2, 3, 4, 5)
+    cache.save_form_template('idp.example.com', {'SMENC': 'ISO-8859-1'}, now=saved)
+    assert cache.load_form_template('idp.example.com', now=saved) == {'SMENC': 'ISO-8859-1'}
+    later = saved + timedelta(seconds=cache.FORM_TEMPLATE_TTL)
+    assert cache.load_form_template('idp.example.com', now=later) is None
+    assert cache.load_form_template_stats('idp.example.com') == {'hits': 1, 'misses': 1, 'rejected': 0}
@@ -0,0 +1,142 @@
+"""
+Test building the CA bundle and its fingerprint index
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import certifi
+
+from nlmfedcred import certbundle
+from nlmfedcred.cli import main
+from nlmfedcred.config import (certsfile_hascert, nlmsecpalo_cert,
+                               setup_certificates)
+
+
+def test_bundle_has_certifi_and_our_cert(tmpdir):
+    bundle = str(tmpdir.join('bundle.pem'))
+    assert setup_certificates(bundle) is True
+    with open(certifi.where()) as f:
+        certifi_count = len(list(certbundle.iter_pem_blocks(f.read())))
+    fingerprints = certbundle.load_fingerprints(bundle)
+    assert len(fingerprints) == certifi_count + 1
+    assert certsfile_hascert(bundle, nlmsecpalo_cert())
+
+
+def test_unchanged_bundle_is_not_rewritten(tmpdir, mocker):
+    bundle = str(tmpdir.join('bundle.pem'))
+    setup_certificates(bundle)
+    atomic_write = mocker.spy(certbundle, 'atomic_write')
+    assert setup_certificates(bundle) is False
+    assert atomic_write.call_count == 0
+
+
+def test_index_answers_membership(tmpdir, mocker):
+    bundle = str(tmpdir.join('bundle.pem'))
+    setup_certificates(bundle)
+    scan = mocker.spy(certbundle, 'scan_fingerprints')
+    assert certsfile_hascert(bundle, nlmsecpalo_cert())
+    assert scan.call_count == 0
+
+
+def test_rebuilt_when_certifi_changes(tmpdir, mocker):
+    bundle = str(tmpdir.join('bundle.pem'))
+    setup_certificates(bundle)
+    source = certbundle.get_certifi_source()
+    source['version'] = '1999.01.01'
+    mocker.patch('nlmfedcred.certbundle.get_certifi_source', return_value=source)
+    assert setup_certificates(bundle) is True
+    with open(bundle + '.index') as f:
+        assert json.load(f)['source']['version'] == '1999.01.01'
+
+
+def test_rebuilt_when_bundle_is_edited(tmpdir):
+    bundle = str(tmpdir.join('bundle.pem'))
+    setup_certificates(bundle)
+    with open(bundle, 'w') as f:
+        f.write('')
+    os.utime(bundle, ns=(0, 0))
+    assert not certsfile_hascert(bundle, nlmsecpalo_cert())
+    assert setup_certificates(bundle) is True
+    assert certsfile_hascert(bundle, nlmsecpalo_cert())
+
+
+def test_extra_cert_already_in_certifi_is_not_duplicated(tmpdir):
+    with open(certifi.where()) as f:
+        first = next(certbundle.iter_pem_blocks(f.read()))
+    bundle = str(tmpdir.join('bundle.pem'))
+    # the same certificate with different line breaks
+    der = certbundle.pem_to_der(first)
+    certbundle.build_bundle(bundle, certbundle.read_certificates(first.replace('\n', '\r\n').encode('ascii')))
+    assert certbundle.load_fingerprints(bundle) == frozenset(certbundle.scan_fingerprints(open(bundle).read()))
+    with open(bundle) as f:
+        assert f.read().count(certbundle.der_to_pem(der)) == 1
+
+
+def make_cert(common_name, not_before, not_after):
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import Encoding
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(not_before).not_valid_after(not_after)
+            .sign(key, hashes.SHA256(), default_backend()))
+    return cert.public_bytes(Encoding.DER)
+
+
+def test_extra_certs_from_directory(tmpdir):
+    now = datetime.utcnow()
+    valid = make_cert('valid', now - timedelta(days=1), now + timedelta(days=30))
+    expired = make_cert('expired', now - timedelta(days=30), now - timedelta(days=1))
+    certsdir = tmpdir.mkdir('certs')
+    certsdir.join('valid.der').write_binary(valid)
+    certsdir.join('valid-again.pem').write(certbundle.der_to_pem(valid).replace('\n', '\r\n'))
+    certsdir.join('expired.crt').write(certbundle.der_to_pem(expired))
+    certsdir.join('README.txt').write('not a certificate')
+
+    bundle = str(tmpdir.join('bundle.pem'))
+    assert main(['dummy', '--setupcerts', bundle, '--extra-certs', str(certsdir)]) == 0
+
+    fingerprints = certbundle.load_fingerprints(bundle)
+    assert certbundle.fingerprint(valid) in fingerprints
+    assert certbundle.fingerprint(expired) not in fingerprints
+    with open(bundle) as f:
+        assert f.read().count(certbundle.der_to_pem(valid)) == 1
+
+
+def test_rebuilt_when_a_certificate_expires(tmpdir):
+    now = datetime.utcnow()
+    soon = make_cert('soon', now - timedelta(days=1), now + timedelta(hours=1))
+    bundle = str(tmpdir.join('bundle.pem'))
+    assert certbundle.build_bundle(bundle, [soon], now=now) is True
+    assert certbundle.build_bundle(bundle, [soon], now=now) is False
+    assert certbundle.build_bundle(bundle, [soon], now=now + timedelta(hours=2)) is True
+    assert certbundle.fingerprint(soon) not in certbundle.load_fingerprints(bundle)
+
+
+def test_bad_extra_cert_is_an_error(tmpdir):
+    bad = tmpdir.join('bad.pem')
+    bad.write('-----BEGIN CERTIFICATE-----\n!!!!\n-----END CERTIFICATE-----\n')
+    assert main(['dummy', '--setupcerts', str(tmpdir.join('bundle.pem')), '--extra-certs', str(bad)]) == 1
+
+
+def test_malformed_certifi_block_is_skipped(tmpdir, mocker, caplog):
+    now = datetime.utcnow()
+    valid = make_cert('valid', now - timedelta(days=1), now + timedelta(days=30))
+    certifi_path = tmpdir.join('cacert.pem')
+    certifi_path.write('-----BEGIN CERTIFICATE-----\n!!!!\n-----END CERTIFICATE-----\n' + certbundle.der_to_pem(valid))
+    mocker.patch('nlmfedcred.certbundle.get_certifi_source', return_value={
+        'path': str(certifi_path), 'version': None, 'signature': certbundle.get_file_signature(str(certifi_path)),
+    })
+
+    bundle = str(tmpdir.join('bundle.pem'))
+    assert certbundle.build_bundle(bundle) is True
+    assert certbundle.load_fingerprints(bundle) == frozenset([certbundle.fingerprint(valid)])
+    assert 'malformed certificate' in caplog.text
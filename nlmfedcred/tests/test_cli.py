@@ -1,8 +1,18 @@
+import json
 import os
+import threading
+import time
+from base64 import b64encode
+from configparser import ConfigParser
+from datetime import datetime, timedelta
 
-from nlmfedcred.cli import main, output_creds
+from requests.cookies import RequestsCookieJar
+
+from nlmfedcred import cache, fedcred
+from nlmfedcred.cli import (expand_profiles, main, make_profile_name,
+                            output_creds)
 from nlmfedcred.fedcred import Credentials
-from nlmfedcred.idp import DEFAULT_IDP
+from nlmfedcred.idp import DEFAULT_IDP, get_fqdn, make_idp
 
 SBOX_MLB_CONFIG = """# awscreds config
 [DEFAULT]
@@ -55,6 +65,14 @@ def test_samlout(tmpdir, mocker, samldata):
     assert os.environ['REQUESTS_CA_BUNDLE'] == 'test-bundle.pem'
 
 
+def test_samlout_writes_unparsable_assertion(tmpdir, mocker):
+    samlout = tmpdir.join('samlout.xml')
+    mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=b64encode(b'<Response/>'))
+
+    assert main(['dummy', '--password', 'fake password', '--samlout', str(samlout)]) == 0
+    assert samlout.read_binary() == b'<Response/>'
+
+
 def test_bad_password(mocker):
     args = [
         'dummy',
@@ -178,3 +196,431 @@ def test_default_profile(tmpdir, mocker, samldata):
     assert assume_role.call_count == 1
     assert output_creds_mm.call_count == 0
     assert save_creds.called_once_with('us-east-1', expected_credentials, 'default', None)
+
+
+def test_cached_assertion_skips_login(tmpdir, mocker, samldata):
+    args = [
+        'dummy',
+        '--cache',
+        '--shell', 'bash',
+        '--output', str(tmpdir.join('awscreds.sh')),
+        '--account', '070163433501',
+        '--role', 'nlm_aws_users',
+    ]
+    getpass = mocker.patch('nlmfedcred.cli.getpass', return_value='fake password')
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch.object(fedcred.SamlAssertion, 'deadline', new_callable=mocker.PropertyMock,
+                        return_value=datetime.utcnow() + timedelta(hours=1))
+    expected_credentials = Credentials(access_key='7777', secret_key='8888', session_token='9999')
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+
+    assert main(args) == 0
+    assert main(args) == 0
+
+    assert getpass.call_count == 1
+    assert get_saml_assertion.call_count == 1
+    assert assume_role.call_count == 2
+
+
+def test_make_profile_name():
+    role_arn = 'arn:aws:iam::070163433501:role/path/nlm_aws_admins'
+    assert make_profile_name('{account}-{role}', role_arn) == '070163433501-nlm_aws_admins'
+    assert make_profile_name('{profile}-{account}', role_arn, 'prod') == 'prod-070163433501'
+
+
+def test_all_matching(tmpdir, mocker, samldata):
+    output_file = str(tmpdir.join('credentials'))
+    args = [
+        'dummy',
+        '--password', 'fake password',
+        '--account', '070163433501',
+        '--all-matching',
+        '--output', output_file,
+    ]
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch('nlmfedcred.cli.fedcred.make_sts_client', return_value=None)
+    expected_credentials = Credentials(access_key='7777', secret_key='8888', session_token='9999')
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+
+    rc = main(args)
+
+    assert rc == 0
+    assert get_saml_assertion.call_count == 1
+    assert assume_role.call_count == 3
+    config = ConfigParser()
+    config.read(output_file)
+    assert len(config.sections()) == 3
+    assert '070163433501-nlm_aws_admins' in config
+    assert config['070163433501-nlm_aws_admins']['aws_access_key_id'] == '7777'
+
+
+def test_all_matching_partial_failure(tmpdir, mocker, samldata):
+    output_file = str(tmpdir.join('credentials'))
+    args = [
+        'dummy',
+        '--password', 'fake password',
+        '--account', '070163433501',
+        '--all-matching',
+        '--output', output_file,
+    ]
+    mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch('nlmfedcred.cli.fedcred.make_sts_client', return_value=None)
+    expected_credentials = Credentials(access_key='7777', secret_key='8888', session_token='9999')
+
+    def assume(role_arn, *args, **kwargs):
+        if role_arn.endswith('nlm_aws_admins'):
+            raise RuntimeError('AccessDenied')
+        return expected_credentials
+
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', side_effect=assume)
+    write_error = mocker.patch('nlmfedcred.cli.sys.stderr.write', return_value=0)
+
+    rc = main(args)
+
+    assert rc == 1
+    assert write_error.call_count == 1
+    config = ConfigParser()
+    config.read(output_file)
+    assert len(config.sections()) == 2
+    assert '070163433501-nlm_aws_admins' not in config
+
+
+def test_credential_process(mocker, capsys, samldata):
+    args = [
+        'dummy',
+        '--credential-process',
+        '--password', 'fake password',
+        '--account', '070163433501',
+        '--role', 'nlm_aws_users',
+    ]
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    expiration = datetime.utcnow() + timedelta(hours=1)
+    expected_credentials = Credentials('7777', '8888', '9999', expiration)
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+    save_creds = mocker.patch('nlmfedcred.cli.update_aws_credentials', return_value=0)
+
+    assert main(args) == 0
+    first = json.loads(capsys.readouterr().out)
+    assert main(args) == 0
+    second = json.loads(capsys.readouterr().out)
+
+    assert first == second
+    assert first['AccessKeyId'] == '7777'
+    assert first['Expiration'] == expiration.strftime('%Y-%m-%dT%H:%M:%SZ')
+    assert get_saml_assertion.call_count == 1
+    assert assume_role.call_count == 1
+    assert save_creds.call_count == 0
+
+
+def test_daemon_shares_logins(tmpdir, mocker):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(SBOX_MLB_CONFIG + '\n[sbox-other]\nidp = auth7.nih.gov\naccount = 123456789012\n')
+    mocker.patch('nlmfedcred.config.get_awscreds_config_path', return_value=str(inipath))
+    scheduler = mocker.patch('nlmfedcred.cli.daemon.RefreshScheduler')
+
+    rc = main(['dummy', '--daemon'])
+
+    assert rc == 0
+    refreshers = scheduler.call_args[0][0]
+    assert [r.profile for r in refreshers] == ['default', 'sbox-mlb', 'sbox-other']
+    assert refreshers[1].source is refreshers[2].source
+    assert refreshers[0].source is not refreshers[1].source
+    assert scheduler.return_value.run.call_count == 1
+
+
+def test_saved_session_skips_password(tmpdir, mocker, samldata):
+    jar = RequestsCookieJar()
+    jar.set('SMSESSION', 'session', domain=get_fqdn(DEFAULT_IDP), path='/')
+    cache.save_cookies(get_fqdn(DEFAULT_IDP), 'markfu', jar)
+    args = [
+        'dummy',
+        '--cache',
+        '--username', 'markfu',
+        '--shell', 'bash',
+        '--output', str(tmpdir.join('awscreds.sh')),
+        '--account', '070163433501',
+        '--role', 'nlm_aws_users',
+    ]
+    getpass = mocker.patch('nlmfedcred.cli.getpass', return_value='fake password')
+    from_session = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion_from_session', return_value=samldata)
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    expected_credentials = Credentials(access_key='7777', secret_key='8888', session_token='9999')
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+
+    assert main(args) == 0
+    assert from_session.call_count == 1
+    assert from_session.call_args[0][1].cookies['SMSESSION'] == 'session'
+    assert getpass.call_count == 0
+    assert get_saml_assertion.call_count == 0
+
+
+def test_rejected_session_asks_for_password(tmpdir, mocker, samldata):
+    args = [
+        'dummy',
+        '--cache',
+        '--username', 'markfu',
+        '--shell', 'bash',
+        '--output', str(tmpdir.join('awscreds.sh')),
+        '--account', '070163433501',
+        '--role', 'nlm_aws_users',
+    ]
+    getpass = mocker.patch('nlmfedcred.cli.getpass', return_value='fake password')
+    mocker.patch('nlmfedcred.cli.cache.load_cookies', return_value=[{
+        'name': 'SMSESSION', 'value': 'stale', 'domain': 'example.com', 'path': '/', 'secure': True, 'expires': None,
+    }])
+    from_session = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion_from_session', return_value=None)
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    save_cookies = mocker.patch('nlmfedcred.cli.cache.save_cookies')
+    clear_cookies = mocker.patch('nlmfedcred.cli.cache.clear_cookies')
+    expected_credentials = Credentials(access_key='7777', secret_key='8888', session_token='9999')
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+
+    assert main(args) == 0
+    clear_cookies.assert_called_once_with(get_fqdn(DEFAULT_IDP), 'markfu')
+    assert from_session.call_count == 1
+    assert getpass.call_count == 1
+    assert get_saml_assertion.call_count == 1
+    assert save_cookies.call_count == 1
+
+
+def test_expand_profiles(tmpdir, mocker):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(SBOX_MLB_CONFIG + '\n[sbox-other]\nidp = auth7.nih.gov\n')
+    mocker.patch('nlmfedcred.config.get_awscreds_config_path', return_value=str(inipath))
+    assert expand_profiles('sbox-*') == ['sbox-mlb', 'sbox-other']
+    assert expand_profiles('default,sbox-*,sbox-mlb') == ['default', 'sbox-mlb', 'sbox-other']
+    assert expand_profiles('nomatch*') == []
+
+
+def test_several_profiles_refresh_together(tmpdir, mocker):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(SBOX_MLB_CONFIG + '\n[sbox-other]\nidp = auth7.nih.gov\naccount = 123456789012\n')
+    mocker.patch('nlmfedcred.config.get_awscreds_config_path', return_value=str(inipath))
+    refresh_all = mocker.patch('nlmfedcred.cli.daemon.refresh_all', return_value=[])
+
+    assert main(['dummy', '-p', 'default,sbox-*']) == 0
+
+    refreshers = refresh_all.call_args[0][0]
+    assert [r.profile for r in refreshers] == ['default', 'sbox-mlb', 'sbox-other']
+    assert refreshers[1].source is refreshers[2].source
+    assert main(['dummy', '-p', 'sbox-*', '--shell', 'bash']) == 1
+
+
+def test_refreshers_keep_overrides_and_bundles(tmpdir, mocker):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(SBOX_MLB_CONFIG + '\n[sbox-other]\nidp = auth7.nih.gov\nca_bundle = interceptor.pem\n')
+    mocker.patch('nlmfedcred.config.get_awscreds_config_path', return_value=str(inipath))
+    mocker.patch.dict(os.environ, clear=False)
+    os.environ.pop('REQUESTS_CA_BUNDLE', None)
+    refresh_all = mocker.patch('nlmfedcred.cli.daemon.refresh_all', return_value=[])
+
+    assert main(['dummy', '-p', 'sbox-*', '--role', 'nlm_aws_power_user']) == 0
+
+    refreshers = refresh_all.call_args[0][0]
+    assert [r.config.role for r in refreshers] == ['nlm_aws_power_user', 'nlm_aws_power_user']
+    assert [r.config.ca_bundle for r in refreshers] == [None, 'interceptor.pem']
+    assert refreshers[0].source is not refreshers[1].source
+    assert 'REQUESTS_CA_BUNDLE' not in os.environ
+
+
+def test_concurrent_credential_process_logs_in_once(mocker, samldata):
+    args = [
+        'dummy',
+        '--credential-process',
+        '--password', 'fake password',
+        '--account', '070163433501',
+        '--role', 'nlm_aws_users',
+    ]
+
+    def slow_login(*args, **kwargs):
+        time.sleep(0.3)
+        return samldata
+
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', side_effect=slow_login)
+    expected_credentials = Credentials('7777', '8888', '9999', datetime.utcnow() + timedelta(hours=1))
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(main(args))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [0] * 5
+    assert get_saml_assertion.call_count == 1
+    assert assume_role.call_count == 1
+
+
+def test_concurrent_shell_runs_log_in_once(tmpdir, mocker, samldata):
+    def args(n):
+        return ['dummy', '--shell', 'bash', '--output', str(tmpdir.join('awscreds%d.sh' % n)), '--cache',
+                '--password', 'fake password', '--account', '070163433501', '--role', 'nlm_aws_users']
+
+    def slow_login(*args, **kwargs):
+        time.sleep(0.3)
+        return samldata
+
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', side_effect=slow_login)
+    expected_credentials = Credentials('7777', '8888', '9999', datetime.utcnow() + timedelta(hours=1))
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml', return_value=expected_credentials)
+
+    results = []
+    threads = [threading.Thread(target=lambda n=n: results.append(main(args(n)))) for n in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [0] * 5
+    assert get_saml_assertion.call_count == 1
+    assert assume_role.call_count == 1
+    for n in range(5):
+        assert 'AWS_SESSION_TOKEN="9999"' in tmpdir.join('awscreds%d.sh' % n).read()
+
+    # a later run asks for new credentials rather than taking the published ones
+    assert main(args(0)) == 0
+    assert assume_role.call_count == 2
+
+
+def test_shell_run_without_cache_saves_no_credentials(tmpdir, mocker, cache_dir, samldata):
+    args = ['dummy', '--shell', 'bash', '--output', str(tmpdir.join('awscreds.sh')),
+            '--password', 'fake password', '--account', '070163433501', '--role', 'nlm_aws_users']
+    mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml',
+                 return_value=Credentials('7777', '8888', '9999', datetime.utcnow() + timedelta(hours=1)))
+
+    assert main(args) == 0
+    assert 'AWS_SESSION_TOKEN="9999"' in tmpdir.join('awscreds.sh').read()
+    assert not cache_dir.listdir(lambda p: p.basename.startswith(('creds-', 'flight-')))
+
+
+def test_list_roles_without_login(tmpdir, mocker, capsys, samldata):
+    args = ['dummy', '--shell', 'bash', '--output', str(tmpdir.join('awscreds.sh')),
+            '--account', '070163433501', '--role', 'nlm_aws_users']
+    mocker.patch('nlmfedcred.cli.getpass', return_value='fake password')
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml',
+                 return_value=Credentials(access_key='7777', secret_key='8888', session_token='9999'))
+
+    assert main(['dummy', '--list-roles']) == 1
+    assert main(args) == 0
+    capsys.readouterr()
+
+    assert main(['dummy', '--list-roles']) == 0
+    out, err = capsys.readouterr()
+    roles = fedcred.get_role_pairs(samldata)
+    assert all(pair[1] in out for pair in roles)
+    assert 'may be out of date' not in err
+    assert get_saml_assertion.call_count == 1
+
+
+def test_list_roles_marks_stale_catalog(mocker, capsys, samldata):
+    saved = datetime.utcnow() - timedelta(hours=30)
+    cache.save_role_catalog(get_fqdn(DEFAULT_IDP), 'someone', fedcred.get_role_pairs(samldata), now=saved)
+    assert main(['dummy', '--list-roles', '--username', 'someone', '--roles-max-age', '48']) == 0
+    assert 'may be out of date' not in capsys.readouterr().err
+    assert main(['dummy', '--list-roles', '--username', 'someone']) == 0
+    assert 'may be out of date' in capsys.readouterr().err
+
+
+def test_min_remaining_skips_login(tmpdir, mocker, samldata):
+    credentials = str(tmpdir.join('credentials'))
+    args = ['dummy', '--output', credentials, '--account', '070163433501', '--role', 'nlm_aws_users',
+            '--min-remaining', '30']
+    getpass = mocker.patch('nlmfedcred.cli.getpass', return_value='fake password')
+    mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    expiration = datetime.utcnow() + timedelta(minutes=20)
+    role_arn = 'arn:aws:iam::070163433501:role/nlm_aws_users'
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml',
+                               return_value=Credentials('7777', '8888', '9999', expiration, role_arn))
+
+    # valid for less than 30 minutes, so log in each time
+    assert main(args) == 0
+    assert main(args) == 0
+    assert getpass.call_count == 2
+
+    assume_role.return_value = Credentials('7777', '8888', '9999', expiration + timedelta(hours=1), role_arn)
+    assert main(args) == 0
+    assert main(args) == 0
+    assert getpass.call_count == 3
+    assert assume_role.call_count == 3
+
+    # the saved credentials are for another account than the one asked for
+    other = ['dummy', '--output', credentials, '--account', '999999999999', '--min-remaining', '30']
+    assert main(other) == 1
+    assert getpass.call_count == 4
+
+
+def test_idp_server_error_is_reported(tmpdir, mocker, capsys, login_page):
+    args = ['dummy', '--password', 'fake password', '--shell', 'bash', '--output', str(tmpdir.join('awscreds.sh')),
+            '--account', '070163433501', '--role', 'nlm_aws_users']
+    session = mocker.Mock()
+    session.get.return_value = mocker.Mock(ok=True, content=login_page)
+    session.post.return_value = mocker.Mock(ok=False, status_code=503)
+    mocker.patch('nlmfedcred.fedcred.make_session', return_value=session)
+
+    assert main(args) == 1
+    out, err = capsys.readouterr()
+    assert 'HTTP 503 for the login' in err
+
+
+def test_several_idps_race_for_the_form(tmpdir, mocker, samldata, login_page):
+    args = ['dummy', '--idp', 'auth1.example.com, auth2.example.com', '--password', 'fake password',
+            '--shell', 'bash', '--output', str(tmpdir.join('awscreds.sh')),
+            '--account', '070163433501', '--role', 'nlm_aws_users']
+    winner = make_idp('auth2.example.com')
+    response = mocker.Mock(ok=True, content=login_page)
+    race = mocker.patch('nlmfedcred.cli.failover.race_login_form', return_value=(winner, mocker.Mock(), response))
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml',
+                 return_value=Credentials(access_key='7777', secret_key='8888', session_token='9999'))
+
+    assert main(args) == 0
+    assert [get_fqdn(idp) for idp in race.call_args[0][0]] == ['auth1.example.com', 'auth2.example.com']
+    assert get_saml_assertion.call_args[0][2] == winner
+    assert 'SMENC' in get_saml_assertion.call_args[1]['form_data']
+
+
+def test_session_saved_under_the_winning_endpoint(tmpdir, mocker, samldata, login_page):
+    args = ['dummy', '--idp', 'auth1.example.com, auth2.example.com', '--password', 'fake password', '--cache',
+            '--username', 'markfu', '--shell', 'bash', '--output', str(tmpdir.join('awscreds.sh')),
+            '--account', '070163433501', '--role', 'nlm_aws_users']
+    winner = make_idp('auth2.example.com')
+    jar = RequestsCookieJar()
+    jar.set('SMSESSION', 'session', domain='auth2.example.com', path='/')
+    response = mocker.Mock(ok=True, content=login_page)
+    mocker.patch('nlmfedcred.cli.failover.race_login_form', return_value=(winner, mocker.Mock(cookies=jar), response))
+    mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml',
+                 return_value=Credentials(access_key='7777', secret_key='8888', session_token='9999'))
+
+    assert main(args) == 0
+    assert cache.load_cookies('auth1.example.com', 'markfu') == []
+    assert [c['name'] for c in cache.load_cookies('auth2.example.com', 'markfu')] == ['SMSESSION']
+
+    mocker.patch('nlmfedcred.cli.cache.load_saml_assertion', return_value=None)
+    from_session = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion_from_session', return_value=samldata)
+    assert main(args) == 0
+    assert get_fqdn(from_session.call_args[0][0]) == 'auth2.example.com'
+
+
+def test_prefetch_used_at_the_prompt(tmpdir, mocker, samldata):
+    args = ['dummy', '--shell', 'bash', '--output', str(tmpdir.join('awscreds.sh')),
+            '--account', '070163433501', '--role', 'nlm_aws_users']
+    mocker.patch('nlmfedcred.cli.sys.stdin.isatty', return_value=True)
+    mocker.patch('nlmfedcred.cli.getpass', return_value='fake password')
+    session = mocker.Mock()
+    client = mocker.Mock()
+    fetch = mocker.patch('nlmfedcred.cli.LoginPrefetch').return_value
+    fetch.form.return_value = (DEFAULT_IDP, session, {'SMENC': 'ISO-8859-1'})
+    fetch.sts_client.return_value = client
+    get_saml_assertion = mocker.patch('nlmfedcred.cli.fedcred.get_saml_assertion', return_value=samldata)
+    assume_role = mocker.patch('nlmfedcred.cli.fedcred.assume_role_with_saml',
+                               return_value=Credentials(access_key='7777', secret_key='8888', session_token='9999'))
+
+    assert main(args) == 0
+    assert fetch.start.call_count == 1
+    assert get_saml_assertion.call_args[1]['session'] is session
+    assert get_saml_assertion.call_args[1]['form_data'] == {'SMENC': 'ISO-8859-1'}
+    assert assume_role.call_args[1]['client'] is client
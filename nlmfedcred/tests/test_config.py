@@ -2,12 +2,19 @@
 Test ability to parse configuration files
 """
 import os
+from configparser import ConfigParser
+from datetime import datetime, timezone
 
 import pytest
 
-from nlmfedcred.config import (get_home, get_user, parse_config,
-                               setup_certificates)
+from nlmfedcred import config as config_module
+from nlmfedcred.config import (get_home, get_profile_expiration,
+                               get_profile_role_arn, get_user, list_profiles,
+                               parse_config, setup_certificates,
+                               update_aws_credential_process,
+                               update_aws_profiles)
 from nlmfedcred.exceptions import ProfileNotFound
+from nlmfedcred.fedcred import Credentials
 
 from . import restore_env, setup_awsconfig
 
@@ -231,3 +238,86 @@ def test_setup_creds_initial(tmpdir):
     setup_certificates(testbundle)
 
     assert os.path.exists(testbundle)
+
+
+def test_list_profiles(tmpdir):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(REALISTIC_CONFIG)
+    assert list_profiles(str(inipath)) == ['default', 'NLM-QA', 'NLM-INT']
+
+
+def test_update_aws_credential_process(tmpdir):
+    awsconfig = setup_awsconfig(tmpdir)
+    update_aws_credential_process(['default', 'NLM-QA'], path=awsconfig)
+    config = ConfigParser()
+    config.read(awsconfig)
+    assert config['default']['credential_process'] == 'getawscreds --credential-process --profile default'
+    assert config['profile NLM-QA']['credential_process'] == 'getawscreds --credential-process --profile NLM-QA'
+
+
+def test_update_aws_profiles_keeps_comments(tmpdir):
+    credentials = tmpdir.join('credentials')
+    credentials.write('# hand-maintained\n[other]\naws_access_key_id = OTHER\n')
+    update_aws_profiles('us-east-1', [('default', Credentials('7777', '8888', '9999'))], path=str(credentials))
+    text = credentials.read()
+    assert text.startswith('# hand-maintained\n[other]\naws_access_key_id = OTHER\n')
+    config = ConfigParser()
+    config.read_string(text)
+    assert config['default']['aws_session_token'] == '9999'
+
+
+def test_snapshot_reused_until_file_changes(tmpdir, mocker):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(REALISTIC_CONFIG)
+    compile_config = mocker.spy(config_module, 'compile_config')
+
+    assert parse_config('NLM-QA', inipath=str(inipath)).account == '777777'
+    assert parse_config('NLM-INT', inipath=str(inipath)).duration == 14400
+    assert compile_config.call_count == 1
+
+    inipath.write(REALISTIC_CONFIG.replace('777777', '999999'))
+    os.utime(str(inipath), ns=(0, 0))
+    assert parse_config('NLM-QA', inipath=str(inipath)).account == '999999'
+    assert compile_config.call_count == 2
+
+
+def test_snapshot_shared_through_disk(tmpdir, mocker):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(REALISTIC_CONFIG)
+    assert list_profiles(str(inipath), use_cache=True) == ['default', 'NLM-QA', 'NLM-INT']
+
+    # as in a new process
+    mocker.patch.dict(config_module.CONFIG_SNAPSHOTS, clear=True)
+    compile_config = mocker.spy(config_module, 'compile_config')
+    assert parse_config('NLM-INT', inipath=str(inipath), use_cache=True).idp == 'auth8.nih.gov'
+    assert compile_config.call_count == 0
+
+
+def test_snapshot_not_on_disk_without_cache(tmpdir, mocker, cache_dir):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(REALISTIC_CONFIG)
+    mocker.patch.dict(config_module.CONFIG_SNAPSHOTS, clear=True)
+    assert list_profiles(str(inipath)) == ['default', 'NLM-QA', 'NLM-INT']
+    assert not cache_dir.exists() or not cache_dir.listdir('config-*')
+
+
+def test_expiration_saved_with_profile(tmpdir):
+    credentials = str(tmpdir.join('credentials'))
+    expiration = datetime(2030, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    role_arn = 'arn:aws:iam::070163433501:role/nlm_aws_users'
+    update_aws_profiles('us-east-1', [('default', Credentials('7777', '8888', '9999', expiration, role_arn))],
+                        path=credentials)
+    assert get_profile_expiration('default', credentials) == datetime(2030, 1, 2, 3, 4, 5)
+    assert get_profile_role_arn('default', credentials) == role_arn
+    assert get_profile_expiration('other', credentials) is None
+
+    update_aws_profiles('us-east-1', [('default', Credentials('7777', '8888', '9999'))], path=credentials)
+    assert get_profile_expiration('default', credentials) is None
+
+
+def test_duration_max(tmpdir):
+    inipath = tmpdir.join('config.ini')
+    inipath.write(JUST_DEFAULTS + '\n[longest]\nduration = max\n')
+    assert parse_config('longest', inipath=str(inipath)).duration == 'max'
+    assert parse_config(None, duration='MAX', inipath=str(inipath)).duration == 'max'
+    assert parse_config(None, duration='7200', inipath=str(inipath)).duration == 7200
@@ -0,0 +1,79 @@
+"""
+Test the credential store behind credential_process mode
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from nlmfedcred import credstore
+from nlmfedcred.fedcred import Credentials
+
+STORE_KEY = ('authtest.nih.gov', 'markfu', '070163433501', 'nlm_aws_users', 'us-east-1', 3600)
+
+
+def make_creds(expiration):
+    return Credentials('7777', '8888', '9999', expiration)
+
+
+def test_round_trip(cache_dir):
+    now = datetime(2020, 1, 1, 12, 0, 0)
+    credstore.save_credentials(*STORE_KEY, make_creds(now + timedelta(hours=1)))
+    creds = credstore.load_credentials(*STORE_KEY, now=now)
+    assert creds == make_creds(now + timedelta(hours=1))
+    assert credstore.load_credentials('authtest.nih.gov', 'markfu', '070163433501', 'nlm_aws_users', 'us-west-2',
+                                      3600, now=now) is None
+    assert credstore.load_credentials('authtest.nih.gov', 'markfu', '070163433501', 'nlm_aws_users', 'us-east-1',
+                                      43200, now=now) is None
+
+
+def test_expiring_soon_is_a_miss(cache_dir):
+    now = datetime(2020, 1, 1, 12, 0, 0)
+    credstore.save_credentials(*STORE_KEY, make_creds(now + timedelta(seconds=credstore.EXPIRY_MARGIN)))
+    assert credstore.load_credentials(*STORE_KEY, now=now) is None
+
+
+def test_saved_before_since_is_a_miss(cache_dir):
+    credstore.save_credentials(*STORE_KEY, make_creds(datetime.utcnow() + timedelta(hours=1)))
+    assert credstore.load_credentials(*STORE_KEY, since=time.time() - 60) is not None
+    assert credstore.load_credentials(*STORE_KEY, since=time.time() + 60) is None
+
+
+def test_without_expiration_is_not_saved(cache_dir):
+    credstore.save_credentials(*STORE_KEY, Credentials('7777', '8888', '9999'))
+    assert credstore.load_credentials(*STORE_KEY) is None
+
+
+def test_credential_process_json():
+    expiration = datetime(2020, 1, 1, 17, 0, 0, tzinfo=timezone(timedelta(hours=5)))
+    document = json.loads(credstore.credential_process_json(make_creds(expiration)))
+    assert document == {
+        'Version': 1,
+        'AccessKeyId': '7777',
+        'SecretAccessKey': '8888',
+        'SessionToken': '9999',
+        'Expiration': '2020-01-01T12:00:00Z',
+    }
+
+
+def test_cache_hit_avoids_heavy_imports(tmpdir, cache_dir):
+    credstore.save_credentials(*STORE_KEY, make_creds(datetime.utcnow() + timedelta(hours=1)))
+    script = '\n'.join([
+        'import sys',
+        'from nlmfedcred import cli',
+        "rc = cli.main(['getawscreds', '--credential-process', '--idp', 'authtest.nih.gov', '--username', 'markfu',"
+        " '--account', '070163433501', '--role', 'nlm_aws_users'])",
+        "heavy = sorted(m for m in ('boto3', 'bs4', 'lxml') if m in sys.modules)",
+        "sys.stderr.write('heavy=%s\\n' % ','.join(heavy))",
+        'sys.exit(rc)',
+    ])
+    env = dict(os.environ, HOME=str(tmpdir))
+    env.pop('APPDATA', None)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run([sys.executable, '-c', script], cwd=root, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout)['AccessKeyId'] == '7777'
+    assert 'heavy=\n' in result.stderr
@@ -0,0 +1,212 @@
+"""
+Test the background refresher's assertion reuse and scheduling
+"""
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from nlmfedcred import daemon
+from nlmfedcred.config import Config
+from nlmfedcred.exceptions import LockTimeout, LoginRequired
+from nlmfedcred.fedcred import Credentials, SamlAssertion
+from nlmfedcred.idp import DEFAULT_IDP
+
+# The sample assertions are valid until 2017-09-29T14:48:17Z
+FAKE_NOW = datetime(2017, 9, 29, 10, 48, 16)
+
+CONFIG = Config('070163433501', 'nlm_aws_users', 3600, None, 'markfu', None, None)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRefresher(object):
+    def __init__(self, profile, delay=100, error=None):
+        self.profile = profile
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def refresh(self):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return None
+
+    def next_refresh_delay(self, creds):
+        return self.delay
+
+
+def test_source_reuses_assertion(mocker, samldata):
+    login = mocker.Mock(return_value=samldata)
+    source = daemon.AssertionSource(DEFAULT_IDP, 'markfu', login)
+    first = source.get(now=FAKE_NOW)
+    second = source.get(now=FAKE_NOW + timedelta(hours=1))
+    assert first is second
+    assert login.call_count == 1
+
+
+def test_source_logs_in_when_expired(mocker, samldata):
+    login = mocker.Mock(return_value=samldata)
+    source = daemon.AssertionSource(DEFAULT_IDP, 'markfu', login)
+    source.get(now=FAKE_NOW)
+    with pytest.raises(LoginRequired):
+        source.get(now=FAKE_NOW + timedelta(hours=4))
+    assert login.call_count == 2
+
+
+def test_source_uses_disk_cache(mocker, samldata):
+    login = mocker.Mock(return_value=samldata)
+    daemon.AssertionSource(DEFAULT_IDP, 'markfu', login).get(now=FAKE_NOW)
+    daemon.AssertionSource(DEFAULT_IDP, 'markfu', login).get(now=FAKE_NOW)
+    assert login.call_count == 1
+
+
+def test_refresh_at_fraction_of_lifetime():
+    refresher = daemon.ProfileRefresher('prod', CONFIG, None, 'us-east-1')
+    creds = Credentials('7777', '8888', '9999', FAKE_NOW + timedelta(hours=10))
+    assert refresher.next_refresh_delay(creds, now=FAKE_NOW) == 8 * 3600
+    assert refresher.next_refresh_delay(Credentials('7777', '8888', '9999')) == 0.8 * 3600
+
+
+def test_profile_refresher_saves(mocker, samldata):
+    source = mocker.Mock(idp=DEFAULT_IDP, user='markfu')
+    source.get.return_value = SamlAssertion(samldata)
+    creds = Credentials('7777', '8888', '9999', datetime.utcnow() + timedelta(hours=1))
+    assume_role = mocker.patch('nlmfedcred.daemon.fedcred.assume_role_with_saml', return_value=creds)
+    update = mocker.patch('nlmfedcred.daemon.update_aws_credentials')
+
+    refresher = daemon.ProfileRefresher('prod', CONFIG, source, 'us-east-1')
+    assert refresher.refresh() == creds
+    assert assume_role.call_args[0][0] == 'arn:aws:iam::070163433501:role/nlm_aws_users'
+    update.assert_called_once_with('us-east-1', creds, 'prod', None)
+
+
+def test_scheduler_runs_due_profiles_in_order():
+    clock = FakeClock()
+    fast = FakeRefresher('fast', delay=100)
+    slow = FakeRefresher('slow', delay=1000)
+    scheduler = daemon.RefreshScheduler([fast, slow], clock=clock)
+
+    assert scheduler.run_pending() == 100
+    assert (fast.calls, slow.calls) == (1, 1)
+
+    clock.now += 100
+    assert scheduler.run_pending() == 100
+    assert (fast.calls, slow.calls) == (2, 1)
+
+    clock.now += 900
+    scheduler.run_pending()
+    assert (fast.calls, slow.calls) == (3, 2)
+
+
+def test_scheduler_notifies_and_retries():
+    clock = FakeClock()
+    notices = []
+    refresher = FakeRefresher('prod', error=LoginRequired('password needed'))
+    scheduler = daemon.RefreshScheduler([refresher], clock=clock, notify=lambda p, m: notices.append((p, m)))
+
+    assert scheduler.run_pending() == daemon.RETRY_DELAY
+    assert refresher.calls == 1
+    assert notices == [('prod', 'a new login is needed: password needed')]
+
+
+class FakeSource(object):
+    def __init__(self, barrier=None, error=None):
+        self.barrier = barrier
+        self.error = error
+        self.calls = 0
+
+    def get(self):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        if self.barrier and self.calls == 1:
+            # only passes when the other source is logging in at the same time
+            self.barrier.wait(timeout=5)
+
+
+class FakeAssumer(object):
+    def __init__(self, profile, source, saved, config=CONFIG):
+        self.profile = profile
+        self.source = source
+        self.config = config
+        self.region = 'us-east-1'
+        self.transport = 'requests'
+        self.saved = saved
+        self.clients = []
+
+    def make_sts_client(self):
+        return object()
+
+    def assume(self, client=None):
+        self.clients.append(client)
+        self.source.get()
+        return Credentials('7777', '8888', self.profile)
+
+    def save(self, creds):
+        if self.profile == 'locked':
+            raise LockTimeout('the credentials file is locked')
+        self.saved.append(creds.session_token)
+
+
+def test_refresh_all_logs_in_to_each_source_concurrently():
+    barrier = threading.Barrier(2)
+    int_source = FakeSource(barrier)
+    prod_source = FakeSource(barrier)
+    saved = []
+    refreshers = [
+        FakeAssumer('int', int_source, saved),
+        FakeAssumer('qa', int_source, saved),
+        FakeAssumer('prod', prod_source, saved),
+    ]
+    assert daemon.refresh_all(refreshers) == []
+    assert sorted(saved) == ['int', 'prod', 'qa']
+
+
+def test_refresh_all_shares_clients_by_ca_bundle():
+    source = FakeSource()
+    saved = []
+    refreshers = [
+        FakeAssumer('int', source, saved),
+        FakeAssumer('qa', source, saved),
+        FakeAssumer('prod', source, saved, CONFIG._replace(ca_bundle='interceptor.pem')),
+    ]
+    assert daemon.refresh_all(refreshers) == []
+    assert refreshers[0].clients == refreshers[1].clients
+    assert refreshers[0].clients != refreshers[2].clients
+
+
+def test_profile_refresher_verifies_with_its_bundle(mocker):
+    make_sts_client = mocker.patch('nlmfedcred.fedcred.make_sts_client')
+    refresher = daemon.ProfileRefresher('prod', CONFIG._replace(ca_bundle='interceptor.pem'), None, 'us-east-1')
+    refresher.make_sts_client()
+    make_sts_client.assert_called_once_with('us-east-1', 'boto3', cafile='interceptor.pem')
+
+
+def test_refresh_all_reports_failed_logins(mocker):
+    notify = mocker.Mock()
+    saved = []
+    refreshers = [
+        FakeAssumer('int', FakeSource(error=LoginRequired('no terminal')), saved),
+        FakeAssumer('prod', FakeSource(), saved),
+    ]
+    assert daemon.refresh_all(refreshers, notify=notify) == ['int']
+    assert saved == ['prod']
+    notify.assert_called_once_with('int', 'login failed: no terminal')
+
+
+def test_refresh_all_reports_failed_saves(mocker):
+    notify = mocker.Mock()
+    source = FakeSource()
+    saved = []
+    refreshers = [FakeAssumer('locked', source, saved), FakeAssumer('prod', source, saved)]
+    assert daemon.refresh_all(refreshers, notify=notify) == ['locked']
+    assert saved == ['prod']
+    notify.assert_called_once_with('locked', 'refresh failed: the credentials file is locked')
@@ -0,0 +1,52 @@
+"""
+Test the time budgets of network calls
+"""
+import pytest
+
+from nlmfedcred.deadline import CONNECT_TIMEOUT, READ_TIMEOUT, Deadline
+from nlmfedcred.exceptions import DeadlineExceeded
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_no_budget():
+    deadline = Deadline()
+    assert deadline.remaining() is None
+    assert deadline.timeout() == (CONNECT_TIMEOUT, READ_TIMEOUT)
+    assert deadline.split(0.5).remaining() is None
+
+
+def test_timeouts_bounded_by_time_left():
+    clock = FakeClock()
+    deadline = Deadline(20, clock)
+    assert deadline.timeout() == (CONNECT_TIMEOUT, 20)
+    clock.now += 15
+    assert deadline.timeout() == (5, 5)
+    clock.now += 5
+    with pytest.raises(DeadlineExceeded):
+        deadline.timeout()
+
+
+def test_split_leaves_time_for_later_phases():
+    clock = FakeClock()
+    deadline = Deadline(40, clock)
+    phase = deadline.split(0.75)
+    assert phase.remaining() == 30
+    clock.now += 30
+    with pytest.raises(DeadlineExceeded):
+        phase.check()
+    assert deadline.check() == 10
+
+
+def test_extend():
+    clock = FakeClock()
+    deadline = Deadline(10, clock)
+    clock.now += 60
+    deadline.extend(60)
+    assert deadline.remaining() == 10
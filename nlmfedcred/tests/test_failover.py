@@ -0,0 +1,94 @@
+"""
+Test logging in through whichever NIH Login endpoint answers first
+"""
+import threading
+
+import pytest
+
+from nlmfedcred import failover
+from nlmfedcred.idp import get_fqdn, make_idp
+
+IDPS = [make_idp('auth1.example.com'), make_idp('auth2.example.com')]
+
+
+class FakeSession(object):
+    '''
+    Answers each endpoint's GET as given: a status code, an exception, or an Event to wait for first
+    '''
+
+    def __init__(self, behavior):
+        self.behavior = behavior
+
+    def get(self, url):
+        action = self.behavior[url]
+        if isinstance(action, threading.Event):
+            action.wait(5)
+            action = 200
+        if isinstance(action, Exception):
+            raise action
+        return FakeResponse(action)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+
+def race(behavior, hedge_delay=0.05):
+    idp, session, r = failover.race_login_form(IDPS, lambda: FakeSession(behavior), hedge_delay=hedge_delay)
+    return get_fqdn(idp)
+
+
+def test_order_by_latency_and_failures():
+    stats = {}
+    assert failover.order_idps(IDPS, stats) == IDPS
+    failover.record_result(stats, 'auth1.example.com', 2.0)
+    failover.record_result(stats, 'auth2.example.com', 0.5)
+    assert failover.order_idps(IDPS, stats) == IDPS[::-1]
+
+    failover.record_result(stats, 'auth2.example.com', now=1000)
+    assert failover.order_idps(IDPS, stats, now=1001) == IDPS
+    # a failure stops counting after a while
+    assert failover.order_idps(IDPS, stats, now=1000 + failover.FAILURE_MEMORY) == IDPS[::-1]
+
+
+def test_moving_average():
+    stats = {}
+    failover.record_result(stats, 'auth1.example.com', 1.0)
+    failover.record_result(stats, 'auth1.example.com', 2.0)
+    assert stats['auth1.example.com']['latency'] == pytest.approx(1.0 + failover.LATENCY_WEIGHT)
+
+
+def test_slow_endpoint_is_hedged():
+    hang = threading.Event()
+    try:
+        assert race({IDPS[0].form_url: hang, IDPS[1].form_url: 200}) == 'auth2.example.com'
+    finally:
+        hang.set()
+    # the next run asks the endpoint that answered first
+    assert failover.order_idps(IDPS, failover.load_stats())[0] == IDPS[1]
+
+
+def test_failed_endpoint_falls_over_at_once():
+    behavior = {IDPS[0].form_url: IOError('connection refused'), IDPS[1].form_url: 200}
+    assert race(behavior, hedge_delay=10) == 'auth2.example.com'
+    assert failover.load_stats()['auth1.example.com']['failures'] == 1
+
+
+def test_fast_endpoint_asked_alone():
+    asked = []
+
+    class CountingSession(FakeSession):
+        def get(self, url):
+            asked.append(url)
+            return FakeResponse(200)
+
+    failover.race_login_form(IDPS, lambda: CountingSession({}), hedge_delay=10)
+    assert asked == [IDPS[0].form_url]
+
+
+def test_every_endpoint_failing():
+    behavior = {IDPS[0].form_url: 503, IDPS[1].form_url: IOError('connection refused')}
+    with pytest.raises(IOError):
+        race(behavior)
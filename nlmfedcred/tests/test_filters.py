@@ -5,6 +5,7 @@ from base64 import b64decode
 from datetime import datetime
 
 import pytest
+from lxml import etree
 
 from nlmfedcred import fedcred
 
@@ -31,6 +32,11 @@ def test_longest_duration_ok(samldata):
     assert duration == 13801
 
 
+def test_longest_duration_over_a_day(samldata):
+    fake_now = datetime.strptime('2017-09-27T10:48:16Z', '%Y-%m-%dT%H:%M:%SZ')
+    assert fedcred.get_longest_duration(samldata, fake_now) == 13801 + 2 * 86400
+
+
 def test_finds_all_roles(samldata):
     rolepairs = fedcred.get_role_pairs(samldata)
     assert isinstance(rolepairs, list)
@@ -90,3 +96,36 @@ def test_filter_on_account_role(samldata):
     assert len(rolepairs) == 1
     role = rolepairs[0][1]
     assert role == 'arn:aws:iam::070163433501:role/nlm_aws_admins'
+
+
+def test_assertion_parses_once(mocker, samldata_sysop):
+    fromstring = mocker.spy(etree, 'fromstring')
+    assertion = fedcred.SamlAssertion(samldata_sysop)
+    assert isinstance(assertion.deadline, datetime)
+    assert len(assertion.role_pairs) > 0
+    assertion.filter_role_pairs(account='626642342379')
+    assertion.filter_role_pairs(name='sysops_super')
+    assert assertion.xml.startswith(b'<')
+    assert fromstring.call_count == 1
+
+
+def test_free_functions_share_parse(mocker, samldata_wg):
+    fedcred.parse_saml_assertion.cache_clear()
+    fromstring = mocker.spy(etree, 'fromstring')
+    fedcred.get_deadline(samldata_wg)
+    fedcred.get_role_pairs(samldata_wg)
+    fedcred.get_filtered_role_pairs(samldata_wg, account='77')
+    assert fromstring.call_count == 1
+
+
+def test_assertion_role_pairs_are_copies(samldata):
+    assertion = fedcred.SamlAssertion(samldata)
+    pairs = assertion.role_pairs
+    pairs.clear()
+    assert len(assertion.role_pairs) == 6
+
+
+def test_free_functions_accept_assertion(samldata):
+    assertion = fedcred.SamlAssertion(samldata)
+    assert fedcred.get_role_pairs(assertion) == assertion.role_pairs
+    assert fedcred.get_deadline(assertion) == assertion.deadline
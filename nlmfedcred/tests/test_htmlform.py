@@ -0,0 +1,91 @@
+"""
+Test that the streaming form extractor agrees with BeautifulSoup on IdP pages
+"""
+import pytest
+from bs4 import BeautifulSoup
+
+from nlmfedcred import htmlform
+
+PAGES = ('login_page', 'saml_post_page', 'piv_redirect_page')
+
+
+def soup_form_inputs(html):
+    # what get_hidden_inputs did before htmlform
+    form = BeautifulSoup(html, 'lxml').find_all('form')[0]
+    form_data = {}
+    for i in form.find_all('input'):
+        if 'name' in i.attrs and 'value' in i.attrs:
+            form_data[i.attrs['name']] = i.attrs['value']
+    return form_data
+
+
+def soup_first_input_value(html):
+    # what get_saml_assertion did before htmlform
+    samlinput = BeautifulSoup(html, 'lxml').find('input')
+    return samlinput.attrs['value']
+
+
+def soup_find_target(html):
+    # what fedcred_win32.find_target did before htmlform
+    soup = BeautifulSoup(html, 'lxml')
+    target_input = soup.find('input', attrs={'name': 'TARGET'})
+    if not target_input:
+        target_input = soup.find('input', attrs={'name': 'target'})
+    return target_input.get('value') if target_input else None
+
+
+@pytest.mark.parametrize('page', PAGES)
+def test_form_inputs_match_soup(request, page):
+    html = request.getfixturevalue(page)
+    assert htmlform.get_form_inputs(html) == soup_form_inputs(html)
+
+
+@pytest.mark.parametrize('page', PAGES)
+def test_first_input_matches_soup(request, page):
+    html = request.getfixturevalue(page)
+    assert htmlform.get_first_input_value(html) == soup_first_input_value(html)
+
+
+@pytest.mark.parametrize('page', PAGES)
+def test_target_matches_soup(request, page):
+    html = request.getfixturevalue(page)
+    assert htmlform.find_target(html) == soup_find_target(html)
+
+
+def test_login_form_inputs(login_page):
+    inputs = htmlform.get_form_inputs(login_page)
+    assert inputs['SMLOCALE'] == 'US-EN'
+    assert inputs['target'].endswith('&appname-=NLM')
+    assert 'topic' not in inputs
+    assert htmlform.get_first_input_value(login_page) == 'US-EN'
+
+
+def test_saml_response(saml_post_page, samldata):
+    assert htmlform.get_first_input_value(saml_post_page) == samldata.decode('ascii').strip()
+
+
+def test_target_prefers_uppercase(piv_redirect_page):
+    assert htmlform.find_target(piv_redirect_page).startswith('-SM-HTTPS-:-/-/authtest.nih.gov-/affwebservices')
+    assert htmlform.find_target('<input name="target" value="lower">') == 'lower'
+    assert htmlform.find_target('<p>nothing here</p>') is None
+
+
+def test_stops_at_end_of_first_form():
+    html = '<form><input name="a" value="1"></form><form><input name="b" value="2"></form>'
+    assert htmlform.get_form_inputs(html) == {'a': '1'}
+
+
+def test_no_form():
+    with pytest.raises(ValueError):
+        htmlform.get_form_inputs('<p>No form</p>')
+    assert htmlform.get_first_input_value('<p>No input</p>') is None
+
+
+def test_entities_and_bare_values():
+    html = '<form><input name="q" value="a&amp;b"><input name="e" value><input name="n"></form>'
+    assert htmlform.get_form_inputs(html) == soup_form_inputs(html) == {'q': 'a&b', 'e': ''}
+
+
+def test_find_input_value(saml_post_page, login_page, samldata):
+    assert htmlform.find_input_value(saml_post_page, 'SAMLResponse') == samldata.decode('ascii').strip()
+    assert htmlform.find_input_value(login_page, 'SAMLResponse') is None
@@ -0,0 +1,99 @@
+"""
+Test the in-place section editor used for the AWS credentials and config files
+"""
+from collections import OrderedDict
+from configparser import ConfigParser
+
+from nlmfedcred.inifile import find_sections, update_sections
+
+CREDENTIALS = """# managed by hand, please keep this comment
+[default]
+region = us-east-1
+aws_access_key_id = OLDKEY
+aws_secret_access_key = OLDSECRET
+
+# the production account
+[prod]
+region = us-east-1
+aws_access_key_id = PRODKEY
+; keep me too
+aws_secret_access_key = PRODSECRET
+aws_session_token = PRODTOKEN
+"""
+
+NEW_ITEMS = [
+    ('region', 'us-west-2'),
+    ('aws_access_key_id', 'NEWKEY'),
+    ('aws_secret_access_key', 'NEWSECRET'),
+    ('aws_session_token', 'NEWTOKEN'),
+]
+
+
+def parse(text):
+    config = ConfigParser()
+    config.read_string(text)
+    return config
+
+
+def test_find_sections():
+    lines = CREDENTIALS.splitlines(True)
+    sections = find_sections(lines)
+    assert [s.name for s in sections] == ['default', 'prod']
+    assert (sections[0].start, sections[0].body_end, sections[0].end) == (1, 5, 7)
+    assert lines[sections[0].body_end:sections[0].end] == ['\n', '# the production account\n']
+    assert sections[1].end == len(lines)
+
+
+def test_replace_keeps_other_sections_and_comments():
+    text = update_sections(CREDENTIALS, {'default': NEW_ITEMS})
+    assert text.startswith('# managed by hand, please keep this comment\n[default]\n')
+    assert '# the production account\n[prod]' in text
+    assert text.endswith(CREDENTIALS[CREDENTIALS.index('\n# the production'):])
+    config = parse(text)
+    assert config.sections() == ['default', 'prod']
+    assert dict(config['default']) == dict(NEW_ITEMS)
+    assert config['prod']['aws_access_key_id'] == 'PRODKEY'
+
+
+def test_replace_drops_stale_keys_but_not_comments():
+    items = NEW_ITEMS[:3]
+    text = update_sections(CREDENTIALS, {'prod': items})
+    assert '; keep me too\n' in text
+    assert 'PRODTOKEN' not in text
+    assert dict(parse(text)['prod']) == dict(items)
+
+
+def test_merge_keeps_existing_keys():
+    text = update_sections(CREDENTIALS, {'prod': [('credential_process', 'getawscreds')]}, replace=False)
+    config = parse(text)
+    assert config['prod']['aws_session_token'] == 'PRODTOKEN'
+    assert config['prod']['credential_process'] == 'getawscreds'
+    # new keys go after the last existing key, before the blank line
+    assert text.endswith('aws_session_token = PRODTOKEN\ncredential_process = getawscreds\n')
+
+
+def test_replaced_key_drops_its_continuation_lines():
+    text = '[prod]\naws_session_token = OLD\n  CONTINUED\nregion = us-east-1\n'
+    for replace in (True, False):
+        updated = update_sections(text, {'prod': [('aws_session_token', 'NEWTOKEN')]}, replace=replace)
+        assert 'CONTINUED' not in updated
+        assert parse(updated)['prod']['aws_session_token'] == 'NEWTOKEN'
+    assert parse(updated)['prod']['region'] == 'us-east-1'
+
+
+def test_batch_appends_new_sections_in_order():
+    updates = OrderedDict([('qa', NEW_ITEMS), ('default', NEW_ITEMS), ('int', NEW_ITEMS)])
+    text = update_sections(CREDENTIALS, updates)
+    assert parse(text).sections() == ['default', 'prod', 'qa', 'int']
+    assert '\n\n[qa]\n' in text
+
+
+def test_empty_and_unterminated_files():
+    assert parse(update_sections('', {'default': NEW_ITEMS})).sections() == ['default']
+    text = update_sections('[a]\nx = 1', {'b': [('y', '2')]})
+    assert text == '[a]\nx = 1\n\n[b]\ny = 2\n'
+
+
+def test_duplicate_section_is_dropped():
+    text = update_sections('[a]\nx = 1\n[a]\nx = 2\n', {'a': [('x', '3')]})
+    assert text == '[a]\nx = 3\n'
@@ -0,0 +1,69 @@
+"""
+Test that concurrent updates of the credentials file neither block forever nor lose profiles
+"""
+import os
+import sys
+import threading
+from configparser import ConfigParser
+
+import pytest
+
+from nlmfedcred.config import update_aws_profiles
+from nlmfedcred.exceptions import LockTimeout
+from nlmfedcred.fedcred import Credentials
+from nlmfedcred.locking import FileLock, atomic_write
+
+
+def test_lock_wait_is_bounded(tmpdir):
+    path = str(tmpdir.join('credentials'))
+    with FileLock(path):
+        with pytest.raises(LockTimeout):
+            with FileLock(path, timeout=0.2):
+                pass
+    # released, so the next one gets it at once
+    with FileLock(path, timeout=0):
+        pass
+
+
+def test_concurrent_updates_keep_every_profile(tmpdir):
+    path = str(tmpdir.join('credentials'))
+
+    def update(n):
+        update_aws_profiles('us-east-1', [('profile%d' % n, Credentials('key%d' % n, 'secret', 'token'))], path)
+
+    threads = [threading.Thread(target=update, args=(n,)) for n in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    config = ConfigParser()
+    config.read(path)
+    assert sorted(config.sections()) == sorted('profile%d' % n for n in range(10))
+    assert config['profile7']['aws_access_key_id'] == 'key7'
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='POSIX permissions only')
+def test_atomic_write_keeps_mode(tmpdir):
+    path = str(tmpdir.join('credentials'))
+    atomic_write(path, 'first\n')
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    os.chmod(path, 0o640)
+    atomic_write(path, 'second\n')
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert open(path).read() == 'second\n'
+    assert [name for name in os.listdir(str(tmpdir)) if name.startswith('.tmp-')] == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='POSIX permissions only')
+def test_atomic_write_private_bytes(tmpdir):
+    path = str(tmpdir.join('cache.key'))
+    atomic_write(path, b'first', keep_mode=False, replace=False)
+    os.chmod(path, 0o644)
+    with pytest.raises(FileExistsError):
+        atomic_write(path, b'second', keep_mode=False, replace=False)
+    assert open(path, 'rb').read() == b'first'
+    atomic_write(path, b'third', keep_mode=False)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert open(path, 'rb').read() == b'third'
+    assert [name for name in os.listdir(str(tmpdir)) if name.startswith('.tmp-')] == []
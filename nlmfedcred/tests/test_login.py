@@ -3,6 +3,13 @@ Test that login sequence is correct using mocks
 """
 import pytest
 
+from nlmfedcred import cache, fedcred
+from nlmfedcred.exceptions import IdPError
+from nlmfedcred.htmlform import get_form_inputs
+from nlmfedcred.idp import DEFAULT_IDP, get_fqdn
+
+FQDN = get_fqdn(DEFAULT_IDP)
+
 
 @pytest.mark.skip(reason='Not yet implemented')
 def test_fail():
@@ -10,3 +17,79 @@ def test_fail():
     Fail for no tests
     """
     assert False
+
+
+@pytest.fixture
+def idp_session(mocker, login_page, saml_post_page):
+    '''
+    A session whose GET returns the login form and whose POST returns the SAML post page
+    '''
+    session = mocker.Mock()
+    session.get.return_value = mocker.Mock(ok=True, content=login_page)
+    session.post.return_value = mocker.Mock(ok=True, content=saml_post_page)
+    return session
+
+
+def login(session):
+    return fedcred.get_saml_assertion('someone', 'secret', DEFAULT_IDP, session=session, use_template=True)
+
+
+def test_template_skips_form(idp_session, samldata):
+    assert login(idp_session) == samldata.decode('ascii').strip()
+    assert idp_session.get.call_count == 1
+    assert login(idp_session) == samldata.decode('ascii').strip()
+    assert idp_session.get.call_count == 1
+    assert idp_session.post.call_count == 2
+    posted = idp_session.post.call_args[0][1]
+    assert posted['USER'] == 'someone'
+    assert posted['SMENC'] == 'ISO-8859-1'
+    assert cache.load_form_template_stats(FQDN) == {'hits': 1, 'misses': 1, 'rejected': 0}
+
+
+def test_changed_form_is_fetched_again(mocker, idp_session, login_page, samldata):
+    template = get_form_inputs(login_page)
+    template['smagentname'] = 'rotated'
+    cache.save_form_template(FQDN, template)
+    saml_page = idp_session.post.return_value
+    idp_session.post.side_effect = [mocker.Mock(ok=True, content=login_page), saml_page]
+
+    assert login(idp_session) == samldata.decode('ascii').strip()
+    assert idp_session.get.call_count == 1
+    assert idp_session.post.call_args_list[0][0][1]['smagentname'] == 'rotated'
+    assert idp_session.post.call_args_list[1][0][1]['smagentname'] != 'rotated'
+    assert cache.load_form_template_stats(FQDN)['rejected'] == 1
+
+
+def test_wrong_password_not_sent_twice(mocker, idp_session, login_page):
+    cache.save_form_template(FQDN, get_form_inputs(login_page))
+    idp_session.post.return_value = mocker.Mock(ok=True, content=login_page)
+
+    assert login(idp_session) == 'US-EN'
+    assert idp_session.get.call_count == 1
+    assert idp_session.post.call_count == 1
+    assert cache.load_form_template_stats(FQDN)['rejected'] == 1
+
+
+def test_rejected_template_is_dropped(mocker, idp_session, login_page):
+    cache.save_form_template(FQDN, get_form_inputs(login_page))
+    idp_session.post.return_value = mocker.Mock(ok=False, status_code=500)
+    idp_session.get.return_value = mocker.Mock(ok=False, status_code=503)
+
+    with pytest.raises(IdPError):
+        login(idp_session)
+    assert cache.load_form_template(FQDN) is None
+    assert cache.load_form_template_stats(FQDN)['rejected'] == 1
+
+
+def test_stale_template_error_page_is_fetched_again(mocker, idp_session, login_page, samldata):
+    template = get_form_inputs(login_page)
+    template['smagentname'] = 'rotated'
+    cache.save_form_template(FQDN, template)
+    saml_page = idp_session.post.return_value
+    idp_session.post.side_effect = [mocker.Mock(ok=True, content=b'<html><body>Error</body></html>'), saml_page]
+
+    assert login(idp_session) == samldata.decode('ascii').strip()
+    assert idp_session.get.call_count == 1
+    assert idp_session.post.call_args_list[1][0][1]['smagentname'] != 'rotated'
+    assert cache.load_form_template(FQDN) != template
+    assert cache.load_form_template_stats(FQDN)['rejected'] == 1
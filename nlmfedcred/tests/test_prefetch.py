@@ -0,0 +1,95 @@
+"""
+Test fetching the login form and setting up STS while the password is typed
+"""
+import threading
+
+from nlmfedcred import prefetch
+from nlmfedcred.deadline import Deadline
+from nlmfedcred.idp import DEFAULT_IDP
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_form_and_client_ready(mocker, login_page):
+    session = mocker.Mock()
+    session.get.return_value = mocker.Mock(ok=True, content=login_page)
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_session', return_value=session)
+    client = mocker.Mock()
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_sts_client', return_value=client)
+
+    fetch = prefetch.LoginPrefetch(DEFAULT_IDP, 'us-east-1', 'requests').start()
+    later = Deadline(30)
+    idp, form_session, form_data = fetch.form(later)
+    assert idp == DEFAULT_IDP
+    assert form_session is session
+    assert form_session.deadline is later
+    assert form_data['SMENC'] == 'ISO-8859-1'
+    assert fetch.sts_client(later) is client
+    assert client.deadline is later
+    session.get.assert_called_once_with(DEFAULT_IDP.form_url)
+
+
+def test_failed_fetch_leaves_login_to_do_it(mocker):
+    session = mocker.Mock()
+    session.get.side_effect = IOError('connection refused')
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_session', return_value=session)
+    client = mocker.Mock()
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_sts_client', return_value=client)
+
+    fetch = prefetch.LoginPrefetch(DEFAULT_IDP, 'us-east-1').start()
+    assert fetch.form() is None
+    assert fetch.sts_client() is client
+
+
+def test_old_form_not_used(mocker, login_page):
+    session = mocker.Mock()
+    session.get.return_value = mocker.Mock(ok=True, content=login_page)
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_session', return_value=session)
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_sts_client')
+    clock = FakeClock()
+
+    fetch = prefetch.LoginPrefetch(DEFAULT_IDP, 'us-east-1', clock=clock).start()
+    fetch.form_thread.join()
+    clock.now += prefetch.MAX_FORM_AGE + 1
+    assert fetch.form() is None
+
+
+def test_form_does_not_wait_for_sts(mocker, login_page):
+    session = mocker.Mock()
+    session.get.return_value = mocker.Mock(ok=True, content=login_page)
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_session', return_value=session)
+    loading = threading.Event()
+
+    def slow_client(*args):
+        loading.wait(timeout=5)
+        return mocker.Mock()
+
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_sts_client', side_effect=slow_client)
+    fetch = prefetch.LoginPrefetch(DEFAULT_IDP, 'us-east-1').start()
+    try:
+        assert fetch.form() is not None
+        assert fetch.sts_thread.is_alive()
+    finally:
+        loading.set()
+    assert fetch.sts_client() is not None
+
+
+def test_boto3_client_made_again_for_the_deadline(mocker):
+    session = mocker.Mock()
+    session.get.side_effect = IOError('connection refused')
+    mocker.patch('nlmfedcred.prefetch.fedcred.make_session', return_value=session)
+    early, late = mocker.Mock(), mocker.Mock()
+    make_sts_client = mocker.patch('nlmfedcred.prefetch.fedcred.make_sts_client', side_effect=[early, late])
+
+    fetch = prefetch.LoginPrefetch(DEFAULT_IDP, 'us-east-1', 'boto3').start()
+    later = Deadline(30)
+    assert fetch.sts_client(later) is late
+    assert make_sts_client.call_args[0] == ('us-east-1', 'boto3', later)
+    assert fetch.sts_client(Deadline()) is early
+    assert make_sts_client.call_count == 2
@@ -0,0 +1,84 @@
+"""
+Test selecting roles through the RoleIndex
+"""
+import pytest
+
+from nlmfedcred import fedcred, roles
+from nlmfedcred.roles import RoleArn, RoleIndex, parse_role_arn
+
+
+def principal(account):
+    return 'arn:aws:iam::%s:saml-provider/NIH' % account
+
+
+PAIRS = [
+    (principal('111111111111'), 'arn:aws:iam::111111111111:role/nlm_aws_users'),
+    (principal('111111111111'), 'arn:aws:iam::111111111111:role/nlm_aws_admins'),
+    (principal('222222222222'), 'arn:aws:iam::222222222222:role/nlm_aws_users'),
+    (principal('222222222222'), 'arn:aws:iam::222222222222:role/teams/data/loader'),
+    (principal('333333333333'), 'arn:aws:iam::333333333333:role/nlm_aws_sysops'),
+]
+
+
+def names(pairs):
+    return [pair[1].split(':')[4] + '/' + pair[1].rsplit('/', 1)[1] for pair in pairs]
+
+
+def test_parse_role_arn():
+    assert parse_role_arn('arn:aws:iam::222222222222:role/teams/data/loader') == \
+        RoleArn('222222222222', '/teams/data/', 'loader')
+    assert parse_role_arn('arn:aws:iam::111111111111:role/nlm_aws_users') == \
+        RoleArn('111111111111', '/', 'nlm_aws_users')
+    assert parse_role_arn('arn:aws:iam::111111111111:user/bob') is None
+
+
+@pytest.mark.parametrize('account,name,expected', [
+    (None, None, ['111111111111/nlm_aws_users', '111111111111/nlm_aws_admins', '222222222222/nlm_aws_users',
+                  '222222222222/loader', '333333333333/nlm_aws_sysops']),
+    ('111111111111,333333333333', None,
+     ['111111111111/nlm_aws_users', '111111111111/nlm_aws_admins', '333333333333/nlm_aws_sysops']),
+    ('!111111111111', 'users', ['222222222222/nlm_aws_users']),
+    ('2*', None, ['222222222222/nlm_aws_users', '222222222222/loader']),
+    ('1111', None, []),
+    (None, 'users,sysops', ['111111111111/nlm_aws_users', '222222222222/nlm_aws_users',
+                            '333333333333/nlm_aws_sysops']),
+    (None, 'glob:nlm_aws_*,!glob:*admins', ['111111111111/nlm_aws_users', '222222222222/nlm_aws_users',
+                                            '333333333333/nlm_aws_sysops']),
+    (None, 'sys.*', ['333333333333/nlm_aws_sysops']),
+    (None, 'glob:sys.*', []),
+    (None, 'user[s]{1,2},admins', ['111111111111/nlm_aws_users', '111111111111/nlm_aws_admins',
+                                   '222222222222/nlm_aws_users']),
+    (None, 'loader', ['222222222222/loader']),
+    (None, 'teams/data/loader', ['222222222222/loader']),
+    (['111111111111', '222222222222'], ['admins', 'loader'], ['111111111111/nlm_aws_admins', '222222222222/loader']),
+])
+def test_filter(account, name, expected):
+    assert names(RoleIndex(PAIRS).filter(account, name)) == expected
+
+
+def test_name_is_still_a_regular_expression(samldata):
+    pairs = fedcred.get_filtered_role_pairs(samldata, name='(admins|sysops)')
+    assert len(pairs) == 4
+
+
+def test_regex_with_glob_characters_is_not_a_glob(samldata):
+    pairs = fedcred.get_filtered_role_pairs(samldata, name='sys.*')
+    assert len(pairs) == 2
+    assert pairs == fedcred.get_filtered_role_pairs(samldata, name='nlm_aws_sysops')
+
+
+def test_matchers_are_cached():
+    roles.compile_name_filter.cache_clear()
+    index = RoleIndex(PAIRS)
+    index.filter(name='users,sysops')
+    index.filter(name='users,sysops')
+    info = roles.compile_name_filter.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+
+def test_assertion_indexes_once(mocker, samldata_sysop):
+    assertion = fedcred.SamlAssertion(samldata_sysop)
+    parse = mocker.spy(roles, 'parse_role_arn')
+    assert len(assertion.filter_role_pairs(account='626642342379,740347601350', name='sysops')) == 2
+    assert len(assertion.filter_role_pairs(name='glob:sysops*')) == 8
+    assert parse.call_count == len(assertion.role_pairs)
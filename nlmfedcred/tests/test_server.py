@@ -0,0 +1,135 @@
+"""
+Test the local container credentials endpoint
+"""
+import json
+import os
+import socket
+import stat
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from nlmfedcred import server
+from nlmfedcred.config import Config
+from nlmfedcred.fedcred import Credentials
+
+CONFIG = Config('070163433501', 'nlm_aws_users', 3600, None, 'markfu', None, None)
+
+
+class SlowRefresher(object):
+    def __init__(self, profile, lifetime=3600):
+        self.profile = profile
+        self.config = CONFIG
+        self.lifetime = lifetime
+        self.calls = 0
+
+    def assume(self):
+        self.calls += 1
+        time.sleep(0.05)
+        expiration = datetime.utcnow() + timedelta(seconds=self.lifetime)
+        return Credentials('7777', '8888', '9999-%d' % self.calls, expiration)
+
+
+@pytest.fixture
+def httpd():
+    refresher = SlowRefresher('prod')
+    provider = server.CredentialProvider([refresher])
+    httpd = server.make_server('127.0.0.1:0', provider, 'secret-token', 'prod')
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch(httpd, path, token='secret-token'):
+    host, port = httpd.server_address[:2]
+    request = Request('http://%s:%d%s' % (host, port, path), headers={'Authorization': token})
+    with urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def test_concurrent_requests_coalesce():
+    refresher = SlowRefresher('prod')
+    provider = server.CredentialProvider([refresher])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(provider.get('prod'))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert refresher.calls == 1
+    assert len(set(results)) == 1
+
+
+def test_renews_near_expiry():
+    refresher = SlowRefresher('prod', lifetime=server.REFRESH_MARGIN)
+    provider = server.CredentialProvider([refresher])
+    provider.get('prod')
+    provider.get('prod')
+    assert refresher.calls == 2
+
+
+def test_unknown_profile():
+    provider = server.CredentialProvider([SlowRefresher('prod')])
+    with pytest.raises(KeyError):
+        provider.get('qa')
+
+
+def test_serves_credentials(httpd):
+    document = fetch(httpd, '/')
+    assert document['AccessKeyId'] == '7777'
+    assert document['Token'] == '9999-1'
+    assert document['Expiration'].endswith('Z')
+    assert fetch(httpd, '/prod') == document
+
+
+def test_rejects_bad_token(httpd):
+    with pytest.raises(HTTPError) as excinfo:
+        fetch(httpd, '/', token='wrong')
+    assert excinfo.value.code == 401
+
+
+class BrokenRefresher(SlowRefresher):
+    def assume(self):
+        raise KeyError('Credentials')
+
+
+def test_refresh_key_error_is_not_missing_profile():
+    provider = server.CredentialProvider([BrokenRefresher('prod')])
+    httpd = server.make_server('127.0.0.1:0', provider, 'secret-token', 'prod')
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        with pytest.raises(HTTPError) as excinfo:
+            fetch(httpd, '/prod')
+        assert excinfo.value.code == 500
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.mark.skipif(server.ThreadingUnixCredentialsServer is None, reason='no Unix domain sockets')
+def test_unix_socket_is_private_and_replaces_stale(tmpdir):
+    path = str(tmpdir.join('creds.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    provider = server.CredentialProvider([SlowRefresher('prod')])
+    httpd = server.make_server('unix:' + path, provider, 'secret-token', 'prod')
+    try:
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    finally:
+        httpd.server_close()
+
+
+def test_missing_profile(httpd):
+    with pytest.raises(HTTPError) as excinfo:
+        fetch(httpd, '/qa')
+    assert excinfo.value.code == 404
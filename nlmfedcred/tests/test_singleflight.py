@@ -0,0 +1,78 @@
+"""
+Test that concurrent processes share one login through the single-flight lock
+"""
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from nlmfedcred.exceptions import LockTimeout, SharedLoginFailed
+from nlmfedcred.singleflight import SingleFlight
+
+
+def nothing_published():
+    return None
+
+
+def test_first_process_does_the_work(tmpdir):
+    path = str(tmpdir.join('flight'))
+    flight = SingleFlight(path)
+    assert flight.join(nothing_published) is None
+    assert tmpdir.join('flight').read() == flight.owner
+    flight.release()
+    assert not tmpdir.join('flight').exists()
+
+
+def test_waiter_reads_published_result(tmpdir):
+    path = str(tmpdir.join('flight'))
+    published = []
+    leader = SingleFlight(path)
+    assert leader.join(nothing_published) is None
+
+    def finish():
+        time.sleep(0.2)
+        published.append('creds')
+        leader.release()
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+    result = SingleFlight(path, timeout=5, poll=0.01).join(lambda: published[0] if published else None)
+    thread.join()
+    assert result == 'creds'
+
+
+def test_waiter_does_not_repeat_a_failed_login(tmpdir):
+    path = str(tmpdir.join('flight'))
+    leader = SingleFlight(path)
+    assert leader.join(nothing_published) is None
+    timer = threading.Timer(0.2, leader.release)
+    timer.start()
+    with pytest.raises(SharedLoginFailed):
+        SingleFlight(path, timeout=5, poll=0.01).join(nothing_published)
+    timer.join()
+    assert not tmpdir.join('flight').exists()
+
+
+def test_wait_is_bounded(tmpdir):
+    path = str(tmpdir.join('flight'))
+    assert SingleFlight(path).join(nothing_published) is None
+    with pytest.raises(LockTimeout):
+        SingleFlight(path, timeout=0.2, poll=0.01).join(nothing_published)
+
+
+def test_lock_of_dead_process_is_taken_over(tmpdir):
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    tmpdir.join('flight').write('%s %d' % (socket.gethostname(), proc.pid))
+    flight = SingleFlight(str(tmpdir.join('flight')), timeout=1)
+    assert flight.join(nothing_published) is None
+    assert tmpdir.join('flight').read() == flight.owner
+
+
+def test_lock_of_other_host_is_left_alone(tmpdir):
+    tmpdir.join('flight').write('some-other-host 1')
+    with pytest.raises(LockTimeout):
+        SingleFlight(str(tmpdir.join('flight')), timeout=0.2, poll=0.01).join(nothing_published)
@@ -0,0 +1,68 @@
+"""
+Keep the console entry points quick to start.
+
+Each entry point module is imported in a fresh interpreter under
+"python -X importtime", and must stay within a time budget without loading
+any of the heavy dependencies that only the network paths need. Set
+NLMFEDCRED_STARTUP_BUDGET_MS to tighten or relax the budget on slow hosts.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ENTRY_POINTS = {
+    'getawscreds': 'nlmfedcred.cli',
+    'smartcard': 'nlmfedcred.smartcard',
+}
+HEAVY_MODULES = ('boto3', 'botocore', 'requests', 'bs4', 'lxml', 'cryptography', 'PyKCS11')
+DEFAULT_BUDGET_MS = 200
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure_import(module, statement=''):
+    '''
+    Import module in a fresh interpreter, returning its cumulative import time in
+    microseconds and the heavy modules that were loaded along the way
+    '''
+    script = '\n'.join([
+        'import sys',
+        'import %s' % module,
+        statement,
+        'heavy = [m for m in %r if m in sys.modules]' % (HEAVY_MODULES,),
+        "sys.stderr.write('heavy:%s\\n' % ','.join(heavy))",
+    ])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=ROOT_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    cumulative = None
+    heavy = None
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[2].strip() == module:
+            cumulative = int(fields[1])
+        elif line.startswith('heavy:'):
+            heavy = [m for m in line[6:].split(',') if m]
+    assert cumulative is not None and heavy is not None, result.stderr
+    return cumulative, heavy
+
+
+@pytest.mark.parametrize('entry_point', sorted(ENTRY_POINTS))
+def test_startup_budget(entry_point):
+    budget_ms = int(os.environ.get('NLMFEDCRED_STARTUP_BUDGET_MS', DEFAULT_BUDGET_MS))
+    cumulative, heavy = measure_import(ENTRY_POINTS[entry_point])
+    assert heavy == []
+    assert cumulative / 1000.0 <= budget_ms, '%s took %.1fms to import' % (entry_point, cumulative / 1000.0)
+
+
+def test_help_is_light():
+    statement = '\n'.join([
+        'try:',
+        "    nlmfedcred.cli.main(['getawscreds', '-h'])",
+        'except SystemExit:',
+        '    pass',
+    ])
+    _, heavy = measure_import('nlmfedcred.cli', statement)
+    assert heavy == []
@@ -0,0 +1,145 @@
+"""
+Test the boto3-free AssumeRoleWithSAML transport
+"""
+from datetime import datetime
+
+import pytest
+
+from nlmfedcred import cache, fedcred, sts
+from nlmfedcred.exceptions import STSError
+
+ROLE_ARN = 'arn:aws:iam::070163433501:role/nlm_aws_users'
+PRINCIPAL_ARN = 'arn:aws:iam::070163433501:saml-provider/NIH_Login'
+
+SUCCESS = b'''<AssumeRoleWithSAMLResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleWithSAMLResult>
+    <Audience>https://signin.aws.amazon.com/saml</Audience>
+    <Credentials>
+      <AccessKeyId>ASIAEXAMPLE</AccessKeyId>
+      <SecretAccessKey>secret</SecretAccessKey>
+      <SessionToken>token</SessionToken>
+      <Expiration>2019-11-09T13:34:41.123Z</Expiration>
+    </Credentials>
+  </AssumeRoleWithSAMLResult>
+  <ResponseMetadata><RequestId>c6104cbe-af31-11e0-8154-cbc7ccf896c7</RequestId></ResponseMetadata>
+</AssumeRoleWithSAMLResponse>'''
+
+FAILURE = b'''<ErrorResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <Error>
+    <Type>Sender</Type>
+    <Code>ValidationError</Code>
+    <Message>The requested DurationSeconds exceeds the MaxSessionDuration set for this role.</Message>
+  </Error>
+  <RequestId>c6104cbe-af31-11e0-8154-cbc7ccf896c7</RequestId>
+</ErrorResponse>'''
+
+
+def make_session(mocker, status_code, content):
+    session = mocker.Mock()
+    session.post.return_value = mocker.Mock(ok=status_code < 400, status_code=status_code, content=content)
+    return session
+
+
+def test_sts_url():
+    assert sts.get_sts_url('us-east-1') == 'https://sts.us-east-1.amazonaws.com/'
+    assert sts.get_sts_url('cn-north-1') == 'https://sts.cn-north-1.amazonaws.com.cn/'
+
+
+def test_assume_role(mocker, samldata):
+    session = make_session(mocker, 200, SUCCESS)
+    creds = sts.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 7200, session=session)
+    assert creds == fedcred.Credentials('ASIAEXAMPLE', 'secret', 'token', datetime(2019, 11, 9, 13, 34, 41))
+
+    url = session.post.call_args[0][0]
+    data = session.post.call_args[1]['data']
+    assert url == 'https://sts.us-east-1.amazonaws.com/'
+    assert data['Action'] == 'AssumeRoleWithSAML'
+    assert data['RoleArn'] == ROLE_ARN
+    assert data['PrincipalArn'] == PRINCIPAL_ARN
+    assert data['SAMLAssertion'] == samldata.decode('ascii')
+    assert data['DurationSeconds'] == '7200'
+
+
+def test_error_response(mocker, samldata):
+    session = make_session(mocker, 400, FAILURE)
+    with pytest.raises(STSError) as excinfo:
+        sts.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', session=session)
+    assert excinfo.value.code == 'ValidationError'
+    assert 'MaxSessionDuration' in excinfo.value.message
+
+
+def test_unexpected_response(mocker, samldata):
+    session = make_session(mocker, 503, b'<html>Service Unavailable')
+    with pytest.raises(STSError) as excinfo:
+        sts.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', session=session)
+    assert excinfo.value.code == 'HTTP503'
+
+
+def test_selectable_from_fedcred(mocker, samldata):
+    session = make_session(mocker, 200, SUCCESS)
+    boto3_client = mocker.patch('nlmfedcred.fedcred.make_sts_client')
+    creds = fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1',
+                                          client=session, transport='requests')
+    assert creds.access_key == 'ASIAEXAMPLE'
+    assert boto3_client.call_count == 0
+
+
+def make_responses(mocker, *responses):
+    session = mocker.Mock()
+    session.post.side_effect = [mocker.Mock(ok=status_code < 400, status_code=status_code, content=content)
+                                for status_code, content in responses]
+    return session
+
+
+def posted_durations(session):
+    return [c[1]['data']['DurationSeconds'] for c in session.post.call_args_list]
+
+
+def test_max_duration_learns_ceiling(mocker, samldata):
+    mocker.patch('nlmfedcred.fedcred.get_longest_duration', return_value=50000)
+    session = make_responses(mocker, (400, FAILURE), (200, SUCCESS), (200, SUCCESS))
+    creds = fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 'max',
+                                          client=session, transport='requests')
+    assert creds.access_key == 'ASIAEXAMPLE'
+    assert posted_durations(session) == ['43200', '28800']
+    assert cache.load_duration_ceiling(ROLE_ARN) == 28800
+
+    fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 'max',
+                                  client=session, transport='requests')
+    assert posted_durations(session) == ['43200', '28800', '28800']
+
+
+def test_max_duration_falls_back_to_default(mocker, samldata):
+    mocker.patch('nlmfedcred.fedcred.get_longest_duration', return_value=50000)
+    session = make_responses(mocker, (400, FAILURE), (400, FAILURE), (200, SUCCESS))
+    fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 'max',
+                                  client=session, transport='requests')
+    assert posted_durations(session) == ['43200', '28800', '3600']
+    assert cache.load_duration_ceiling(ROLE_ARN) == 3600
+
+
+def test_max_duration_accepted_is_not_a_ceiling(mocker, samldata):
+    mocker.patch('nlmfedcred.fedcred.get_longest_duration', return_value=5000)
+    session = make_responses(mocker, (200, SUCCESS))
+    fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 'max',
+                                  client=session, transport='requests')
+    assert cache.load_duration_ceiling(ROLE_ARN) is None
+
+
+def test_max_duration_limited_by_assertion(mocker, samldata):
+    mocker.patch('nlmfedcred.fedcred.get_longest_duration', return_value=5000)
+    session = make_responses(mocker, (200, SUCCESS))
+    fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 'max',
+                                  client=session, transport='requests')
+    assert posted_durations(session) == ['5000']
+
+
+def test_max_duration_other_errors_not_retried(mocker, samldata):
+    mocker.patch('nlmfedcred.fedcred.get_longest_duration', return_value=50000)
+    denied = FAILURE.replace(b'ValidationError', b'AccessDenied')
+    session = make_responses(mocker, (403, denied), (200, SUCCESS))
+    with pytest.raises(STSError):
+        fedcred.assume_role_with_saml(ROLE_ARN, PRINCIPAL_ARN, samldata, 'us-east-1', 'max',
+                                      client=session, transport='requests')
+    assert posted_durations(session) == ['43200']
+    assert cache.load_duration_ceiling(ROLE_ARN) is None
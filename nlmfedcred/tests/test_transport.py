@@ -0,0 +1,205 @@
+"""
+Test that HTTPS sessions share one SSLContext per CA bundle, and that requests are bounded and retried
+"""
+import ipaddress
+import os
+import ssl
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from nlmfedcred import fedcred, transport
+from nlmfedcred.deadline import Deadline
+from nlmfedcred.exceptions import IdPError
+from nlmfedcred.idp import DEFAULT_IDP
+
+
+def make_server_cert(tmpdir):
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.utcnow()
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+                           critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256(), default_backend()))
+    certfile = tmpdir.join('server.pem')
+    certfile.write_binary(cert.public_bytes(serialization.Encoding.PEM))
+    keyfile = tmpdir.join('server.key')
+    keyfile.write_binary(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()))
+    return str(certfile), str(keyfile)
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def https_server(tmpdir):
+    certfile, keyfile = make_server_cert(tmpdir)
+    httpd = HTTPServer(('127.0.0.1', 0), OkHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'https://127.0.0.1:%d/' % httpd.server_address[1], certfile
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_context_cached_per_bundle_version(tmpdir, mocker):
+    certfile, _ = make_server_cert(tmpdir)
+    create = mocker.spy(transport, 'create_ssl_context')
+    first = transport.get_ssl_context(certfile)
+    assert transport.get_ssl_context(certfile) is first
+    assert create.call_count == 1
+
+    os.utime(certfile, ns=(0, 0))
+    assert transport.get_ssl_context(certfile) is not first
+    assert create.call_count == 2
+
+
+def test_sessions_share_the_context(https_server, mocker):
+    url, certfile = https_server
+    mocker.patch.dict(os.environ, {'REQUESTS_CA_BUNDLE': certfile})
+    create = mocker.spy(transport, 'create_ssl_context')
+    for _ in range(3):
+        session = transport.make_session()
+        r = session.get(url)
+        assert r.text == 'ok'
+        session.close()
+    assert create.call_count == 1
+
+
+def test_session_bundle_wins_over_environment(https_server, mocker):
+    url, certfile = https_server
+    mocker.patch.dict(os.environ, {'REQUESTS_CA_BUNDLE': requests.utils.DEFAULT_CA_BUNDLE_PATH})
+    session = transport.make_session(certfile)
+    assert session.get(url).text == 'ok'
+    session.close()
+
+
+def test_bundle_trusted_without_pool_key_hook(https_server, mocker):
+    url, certfile = https_server
+    mocker.patch.dict(os.environ, {'REQUESTS_CA_BUNDLE': certfile})
+
+    def get_connection(self, request, verify, proxies=None, cert=None):
+        # as requests before 2.32, which has no build_connection_pool_key_attributes
+        return self.poolmanager.connection_from_url(request.url)
+
+    mocker.patch.object(requests.adapters.HTTPAdapter, 'get_connection_with_tls_context', get_connection)
+    session = transport.make_session()
+    assert session.get(url).text == 'ok'
+    session.close()
+
+
+def test_other_bundle_is_not_trusted(https_server, mocker):
+    url, certfile = https_server
+    mocker.patch.dict(os.environ, {'REQUESTS_CA_BUNDLE': certfile})
+    session = transport.make_session()
+    with pytest.raises(requests.exceptions.SSLError):
+        # verify against the default bundle, which does not hold the test certificate
+        session.get(url, verify=requests.utils.DEFAULT_CA_BUNDLE_PATH)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    # the status of each response in turn, then 200
+    statuses = []
+    delay = 0
+    requests = 0
+
+    def respond(self):
+        cls = type(self)
+        cls.requests += 1
+        time.sleep(cls.delay)
+        status = cls.statuses.pop(0) if cls.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def flaky_server(mocker):
+    mocker.patch.object(FlakyHandler, 'statuses', [])
+    mocker.patch.object(FlakyHandler, 'delay', 0)
+    mocker.patch.object(FlakyHandler, 'requests', 0)
+    mocker.patch('nlmfedcred.transport.get_backoff', return_value=0)
+    httpd = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_get_retried_after_server_error(flaky_server):
+    FlakyHandler.statuses = [503, 502]
+    r = transport.make_session().get(flaky_server)
+    assert r.status_code == 200
+    assert FlakyHandler.requests == 3
+
+
+def test_retries_are_bounded(flaky_server):
+    FlakyHandler.statuses = [503] * 5
+    r = transport.make_session().get(flaky_server)
+    assert r.status_code == 503
+    assert FlakyHandler.requests == transport.MAX_ATTEMPTS
+
+
+def test_post_only_retried_when_idempotent(flaky_server):
+    session = transport.make_session()
+    FlakyHandler.statuses = [503]
+    assert session.post(flaky_server, data={'USER': 'someone'}).status_code == 503
+    assert FlakyHandler.requests == 1
+
+    FlakyHandler.statuses = [503]
+    assert session.post(flaky_server, data={}, idempotent=True).status_code == 200
+    assert FlakyHandler.requests == 3
+
+
+def test_deadline_bounds_a_hung_server(flaky_server):
+    FlakyHandler.delay = 1
+    session = transport.make_session(deadline=Deadline(0.2))
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        session.get(flaky_server)
+    assert time.monotonic() - started < 0.8
+
+
+def test_login_form_error_is_reported(flaky_server):
+    FlakyHandler.statuses = [404]
+    idp = DEFAULT_IDP._replace(form_url=flaky_server)
+    with pytest.raises(IdPError) as excinfo:
+        fedcred.get_hidden_inputs(transport.make_session(), idp)
+    assert 'HTTP 404' in str(excinfo.value)
@@ -0,0 +1,203 @@
+"""
+HTTP sessions for talking to NIH Login and AWS STS.
+
+Behind the SSL interceptor, REQUESTS_CA_BUNDLE points at a large PEM bundle,
+and urllib3 would load it into a fresh SSLContext for every new connection.
+Sessions made here instead share one SSLContext per bundle, built the first
+time the bundle is needed and again only when the bundle file changes, so
+the trust store is parsed once per process.
+
+Every request has connect and read timeouts, bounded by the session's
+Deadline, and idempotent requests are tried again after connection errors,
+timeouts and 5xx responses, with jittered exponential backoff.
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .deadline import CONNECT_TIMEOUT, READ_TIMEOUT, Deadline
+
+__all__ = (
+    'Session',
+    'get_ca_bundle',
+    'get_ssl_context',
+    'make_session',
+)
+
+logger = logging.getLogger(__name__)
+
+# SSLContexts by (bundle path, size, mtime)
+SSL_CONTEXTS = {}
+SSL_CONTEXTS_LOCK = threading.Lock()
+
+# How many times to try an idempotent request, and the base of the backoff between tries
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+RETRY_STATUSES = frozenset((500, 502, 503, 504))
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+# Connections kept alive per host; enough for every worker assuming roles at once
+POOL_SIZE = 10
+
+
+def get_ca_bundle():
+    '''
+    Return the CA bundle that requests would use
+    '''
+    path = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE')
+    if path:
+        return path
+    from requests.utils import DEFAULT_CA_BUNDLE_PATH
+    return DEFAULT_CA_BUNDLE_PATH
+
+
+def create_ssl_context(cafile):
+    from urllib3.util.ssl_ import create_urllib3_context
+    context = create_urllib3_context()
+    context.load_verify_locations(cafile=cafile)
+    return context
+
+
+def uses_shared_context(conn):
+    '''
+    Whether the connection pool verifies servers with one of the shared SSLContexts
+    '''
+    context = getattr(conn, 'conn_kw', {}).get('ssl_context')
+    if context is None:
+        return False
+    with SSL_CONTEXTS_LOCK:
+        return any(context is shared for shared in SSL_CONTEXTS.values())
+
+
+def get_ssl_context(cafile=None):
+    '''
+    Return the shared SSLContext that trusts the certificates in cafile
+    '''
+    if cafile is None:
+        cafile = get_ca_bundle()
+    st = os.stat(cafile)
+    key = (cafile, st.st_size, st.st_mtime_ns)
+    with SSL_CONTEXTS_LOCK:
+        context = SSL_CONTEXTS.get(key)
+        if context is None:
+            context = create_ssl_context(cafile)
+            # a changed bundle replaces the context for the old one
+            for old_key in [k for k in SSL_CONTEXTS if k[0] == cafile]:
+                del SSL_CONTEXTS[old_key]
+            SSL_CONTEXTS[key] = context
+        return context
+
+
+class SSLContextAdapter(HTTPAdapter):
+    '''
+    Verifies servers with a shared SSLContext when requests would verify them against its CA bundle.
+
+    The context is handed to urllib3 through build_connection_pool_key_attributes,
+    which requests calls from version 2.32. Older versions never call it, and
+    verify against the CA bundle as usual.
+    '''
+
+    def __init__(self, cafile, **kwargs):
+        self.cafile = cafile
+        super().__init__(**kwargs)
+
+    def uses_context(self, verify):
+        return verify is True or verify == self.cafile
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        if host_params.get('scheme') == 'https' and self.uses_context(verify):
+            pool_kwargs.pop('ca_certs', None)
+            pool_kwargs.pop('ca_cert_dir', None)
+            pool_kwargs['ssl_context'] = get_ssl_context(self.cafile)
+        return host_params, pool_kwargs
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if url.lower().startswith('https') and self.uses_context(verify) and uses_shared_context(conn):
+            # the context already holds these certificates, so urllib3 must not load them again
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+
+def get_backoff(attempt, base=BACKOFF_BASE):
+    '''
+    Seconds to wait after the given failed attempt, with full jitter
+    '''
+    return random.uniform(0, base * 2 ** attempt)
+
+
+class Session(requests.Session):
+    '''
+    Bounds each request by the deadline and tries idempotent requests again.
+
+    A POST is only tried again when it is made with idempotent=True, as the call
+    to STS is; the login POST is not, since a retried password may count twice.
+    '''
+
+    def __init__(self, deadline=None):
+        super().__init__()
+        self.deadline = deadline if deadline is not None else Deadline()
+
+    def merge_environment_settings(self, url, proxies, stream, verify, cert):
+        if verify is None and self.verify is not True:
+            # a CA bundle given to the session wins over $REQUESTS_CA_BUNDLE
+            verify = self.verify
+        return super().merge_environment_settings(url, proxies, stream, verify, cert)
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = MAX_ATTEMPTS if idempotent else 1
+        timeout = kwargs.pop('timeout', None) or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        for attempt in range(1, attempts + 1):
+            kwargs['timeout'] = self.deadline.timeout(*timeout)
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                delay = self.get_retry_delay(attempt, attempts)
+                if delay is None:
+                    raise
+                logger.debug('%s %s failed, trying again: %s', method, url, e)
+            else:
+                delay = None
+                if response.status_code in RETRY_STATUSES:
+                    delay = self.get_retry_delay(attempt, attempts)
+                if delay is None:
+                    return response
+                logger.debug('%s %s returned HTTP %d, trying again', method, url, response.status_code)
+                response.close()
+            time.sleep(delay)
+
+    def get_retry_delay(self, attempt, attempts):
+        '''
+        Return how long to wait before trying again, or None if there are no attempts or time left
+        '''
+        if attempt >= attempts:
+            return None
+        delay = get_backoff(attempt)
+        remaining = self.deadline.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+
+def make_session(cafile=None, deadline=None, pool_maxsize=POOL_SIZE):
+    '''
+    Make a session whose HTTPS connections share the SSLContext for cafile.
+
+    Connections are kept alive, so the login POST reuses the connection of the
+    form GET before it, and the pool holds enough of them for concurrent calls to STS.
+    '''
+    session = Session(deadline)
+    if cafile is None:
+        cafile = get_ca_bundle()
+    else:
+        session.verify = cafile
+    session.mount('https://', SSLContextAdapter(cafile, pool_maxsize=pool_maxsize))
+    return session
@@ -0,0 +1,53 @@
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nlmfedcred import htmlform  # noqa
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'nlmfedcred', 'tests', 'data')
+PAGES = ['idp-login-form.html', 'idp-saml-post.html', 'idp-piv-redirect.html']
+
+
+def soup_form_inputs(html):
+    form = BeautifulSoup(html, 'lxml').find_all('form')[0]
+    return dict((i.attrs['name'], i.attrs['value']) for i in form.find_all('input')
+                if 'name' in i.attrs and 'value' in i.attrs)
+
+
+def soup_first_input_value(html):
+    return BeautifulSoup(html, 'lxml').find('input').attrs['value']
+
+
+def create_parser(prog_name):
+    parser = ArgumentParser(prog=prog_name, description='Compare BeautifulSoup with htmlform on IdP pages')
+    parser.add_argument('--number', metavar='COUNT', type=int, default=200,
+                        help='how many times to parse each page, default 200')
+    parser.add_argument('pages', metavar='PATH', nargs='*',
+                        help='captured IdP pages, default the pages in nlmfedcred/tests/data')
+    return parser
+
+
+def main():
+    opts = create_parser(sys.argv[0]).parse_args(sys.argv[1:])
+    paths = opts.pages if opts.pages else [os.path.join(DATA_DIR, p) for p in PAGES]
+    print('%-28s %-18s %10s %10s %8s' % ('page', 'operation', 'bs4 (us)', 'ours (us)', 'speedup'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            html = f.read()
+        for name, soup_func, our_func in [
+            ('form inputs', soup_form_inputs, htmlform.get_form_inputs),
+            ('first input', soup_first_input_value, htmlform.get_first_input_value),
+        ]:
+            soup_time = timeit.timeit(lambda: soup_func(html), number=opts.number) / opts.number * 1e6
+            our_time = timeit.timeit(lambda: our_func(html), number=opts.number) / opts.number * 1e6
+            print('%-28s %-18s %10.1f %10.1f %7.1fx' % (os.path.basename(path), name, soup_time, our_time,
+                                                      soup_time / our_time))
+
+
+if __name__ == '__main__':
+    main()
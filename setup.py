@@ -44,9 +44,7 @@ setup(
     scripts=['bin/getawscreds.py', 'bin/awscreds.cmd', 'bin/awscreds-func.sh'],
     install_requires=[
         'boto3',
-        'bs4',
         'requests',
-        'beautifulsoup4',
         'lxml',
         'cryptography',
         "pywin32; sys_platform=='win32'",
@@ -55,6 +53,7 @@ setup(
         'smartcard': ['PyKCS11'],
     },
     tests_require=[
+        'beautifulsoup4',
         'pytest',
         'pytest-cov',
         'pytest-pythonpath',